@@ -0,0 +1,109 @@
+import asyncio
+import os
+import pickle
+from collections import OrderedDict
+
+from .database.config import user_collection
+
+# Memory bound of the statistics cache, in bytes
+STATS_CACHE_MAX_BYTES = int(os.getenv("STATS_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+
+class StatisticsCache:
+    """LRU cache of the statistics computed on the log collections, bounded in memory
+        The keys are (collection, generation, statistic, parameters): a statistic computed before the
+        collection changed is never served, since the generation of the collection is part of its key
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.pending = {}
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def set(self, key, value) -> None:
+        # The size of the pickled value is a cheap estimation of its size in memory
+        size = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        self.entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def invalidate(self, collection: str) -> None:
+        """Drop the statistics of a collection, they can't be served anymore once its generation changed"""
+        for key in [key for key in self.entries if key[0] == collection]:
+            self.size -= self.entries.pop(key)[1]
+
+
+statistics_cache = StatisticsCache(STATS_CACHE_MAX_BYTES)
+
+
+async def get_generation(collection: str) -> int:
+    """Get the generation of a collection, increased each time its content changes"""
+    document = await user_collection.find_one(
+        {"collections.name": collection},
+        {"collections.$": 1, "_id": 0})
+    if not document:
+        return 0
+    return document["collections"][0].get("generation") or 0
+
+
+async def bump_generation(collection: str) -> None:
+    """Mark the content of a collection as changed, the statistics cached for it become stale"""
+    await user_collection.update_one(
+        {"collections.name": collection},
+        {"$inc": {"collections.$.generation": 1}},
+    )
+    statistics_cache.invalidate(collection)
+
+
+async def cached_statistic(collection: str, statistic: str, parameters: tuple, compute):
+    """Return a statistic of a collection from the cache, or compute it and cache it
+
+    Args:
+        collection (str): name of the collection
+        statistic (str): name of the statistic
+        parameters (tuple): the parameters of the statistic (must be hashable)
+        compute: coroutine function computing the statistic when it is not cached
+
+    Returns:
+        the statistic
+    """
+    key = (collection, await get_generation(collection), statistic, parameters)
+    entry = statistics_cache.get(key)
+    if entry is not None:
+        return entry[0]
+
+    # The same statistic requested while it is computed (e.g. a dashboard loading) waits for the first request
+    if key in statistics_cache.pending:
+        return await asyncio.shield(statistics_cache.pending[key])
+    future = asyncio.get_running_loop().create_future()
+    statistics_cache.pending[key] = future
+    try:
+        value = await compute()
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        # Retrieve the exception so it is not reported as never retrieved when nobody waits for it
+        future.exception()
+        raise
+    else:
+        future.set_result(value)
+        statistics_cache.set(key, value)
+        return value
+    finally:
+        del statistics_cache.pending[key]
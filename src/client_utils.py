@@ -1,7 +1,17 @@
 from fastapi.encoders import jsonable_encoder
+from pymongo import ASCENDING, UpdateOne
 
 from parser.models.client import Client_Model
 
+from .utils import to_utc_datetime
+
+# Indexes of a log collection: the upserts match on client_id,
+# the date routes run range queries on the (multikey) request time
+CLIENT_INDEXES = [
+    [("client_id", ASCENDING)],
+    [("sessions.requests.request_time", ASCENDING)],
+]
+
 
 async def get_clients_from_collection(collection) -> list[Client_Model]:
     """Function to get all the clients from a collection(database)
@@ -18,6 +28,29 @@ async def get_clients_from_collection(collection) -> list[Client_Model]:
     return list_client
 
 
+def encode_clients(list_clients) -> list[dict]:
+    """Function to encode a list of clients as they are stored in a collection(database)
+        The request times are stored as BSON dates (in UTC) and not as strings
+
+    Args:
+        list_clients (list[Client_Model] | list[dict]): list of clients
+
+    Returns:
+        list[dict]: the encoded clients
+    """
+    clients = jsonable_encoder(list_clients)
+    for client in clients:
+        for session in client.get("sessions") or []:
+            for request in session.get("requests") or []:
+                request["request_time"] = to_utc_datetime(request.get("request_time"))
+    return clients
+
+
+async def ensure_client_indexes(collection_db) -> None:
+    for keys in CLIENT_INDEXES:
+        await collection_db.create_index(keys)
+
+
 async def post_clients_in_collection(
     list_clients: list[Client_Model], collection_db
 ) -> None:
@@ -27,4 +60,145 @@ async def post_clients_in_collection(
         list_clients (list[Client_Model]): list of clients to post in the collection
         collection (collection_object): collection(database) to post the clients in
     """
-    await collection_db.insert_many(jsonable_encoder(list_clients))
+    await ensure_client_indexes(collection_db)
+    await collection_db.insert_many(encode_clients(list_clients))
+
+
+def last_session_id(sessions: list[dict]) -> int:
+    return max((session.get("session_id") or 0 for session in sessions), default=0)
+
+
+def renumber_request(request_id, session_id: int, position: int):
+    """Id "<session_id>.<position>" of a request, with the type the parser gave it"""
+    if isinstance(request_id, (float, str)):
+        return type(request_id)(f"{session_id}.{position}")
+    return request_id
+
+
+def renumber_sessions(sessions: list[dict], last: int) -> list[dict]:
+    """Function to number the sessions of a client after its session last
+        The parser numbers the sessions of each client from 1 on every parse, and each request
+        "<session_id>.<position>": the sessions of a client parsed from several files would repeat their ids
+
+    Args:
+        sessions (list[dict]): sessions (encoded as json) of the client, numbered from 1
+        last (int): id of the last session already known of the client
+
+    Returns:
+        list[dict]: the sessions numbered from last + 1
+    """
+    if not last:
+        return sessions
+    renumbered = []
+    for session_id, session in enumerate(sessions, start=last + 1):
+        session = {**session, "session_id": session_id}
+        if session.get("requests"):
+            session["requests"] = [
+                {**request, "request_id": renumber_request(request.get("request_id"), session_id, position)}
+                for position, request in enumerate(session["requests"], start=1)
+            ]
+        renumbered.append(session)
+    return renumbered
+
+
+async def upsert_clients_in_collection(
+    list_clients: list[dict], collection_db
+) -> int:
+    """Function to merge a list of clients in a collection(database) without rewriting it
+        The sessions of a client already stored are pushed at the end of its document, numbered after
+        its stored sessions, the unknown clients are inserted. Only the stored clients of the list are read.
+        The clients of the list are renumbered in place, so their events get the same session ids:
+        the ingestions of a collection must not write at the same time
+
+    Args:
+        list_clients (list[dict]): list of clients (encoded as json) parsed from the new files
+        collection_db (collection_object): collection(database) to merge the clients in
+
+    Returns:
+        int: number of new clients inserted in the collection
+    """
+    if not list_clients:
+        return 0
+    # The upserts match on client_id, without an index each of them is a collection scan
+    await ensure_client_indexes(collection_db)
+    last_sessions = {}
+    async for document in collection_db.aggregate([
+        {"$match": {"client_id": {"$in": [client["client_id"] for client in list_clients]}}},
+        {"$project": {"_id": 0, "client_id": 1, "last": {"$max": "$sessions.session_id"}}},
+    ]):
+        last_sessions[document["client_id"]] = document.get("last") or 0
+    for client in list_clients:
+        client["sessions"] = renumber_sessions(client.get("sessions") or [],
+                                               last_sessions.get(client["client_id"], 0))
+
+    operations = []
+    for client in encode_clients(list_clients):
+        sessions = client.pop("sessions", None) or []
+        operations.append(
+            UpdateOne(
+                {"client_id": client["client_id"]},
+                {
+                    "$setOnInsert": client,
+                    "$push": {"sessions": {"$each": sessions}},
+                },
+                upsert=True,
+            )
+        )
+    result = await collection_db.bulk_write(operations, ordered=False)
+    return result.upserted_count
+
+
+def merge_clients(lists_clients: list[list[dict]]) -> list[dict]:
+    """Function to merge the clients parsed from several files in one list
+        The sessions of a client found in several files are concatenated in the order of the files,
+        each file's sessions numbered after the ones of the previous files, and the other fields are
+        taken from the first file where the client appears
+
+    Args:
+        lists_clients (list[list[dict]]): the clients (encoded as json) of each file
+
+    Returns:
+        list[dict]: one client per client_id
+    """
+    merged = {}
+    for list_clients in lists_clients:
+        for client in list_clients:
+            if client["client_id"] not in merged:
+                merged[client["client_id"]] = {**client, "sessions": list(client.get("sessions") or [])}
+            else:
+                sessions = merged[client["client_id"]]["sessions"]
+                sessions.extend(renumber_sessions(client.get("sessions") or [], last_session_id(sessions)))
+    return list(merged.values())
+
+
+async def normalize_request_times(collection_db) -> int:
+    """Function to convert the request times still stored as strings in a collection(database) to BSON dates
+        The conversion runs on the server with $dateFromString, the documents never leave MongoDB
+
+    Args:
+        collection_db (collection_object): collection(database) to convert
+
+    Returns:
+        int: number of clients converted
+    """
+    to_date = {
+        "$cond": [
+            {"$eq": [{"$type": "$$request.request_time"}, "string"]},
+            {"$dateFromString": {"dateString": "$$request.request_time"}},
+            "$$request.request_time",
+        ]
+    }
+    result = await collection_db.update_many(
+        {"sessions.requests.request_time": {"$type": "string"}},
+        [{"$set": {"sessions": {"$map": {
+            "input": "$sessions",
+            "as": "session",
+            "in": {"$mergeObjects": ["$$session", {"requests": {"$map": {
+                "input": "$$session.requests",
+                "as": "request",
+                "in": {"$mergeObjects": ["$$request", {"request_time": to_date}]},
+            }}}]},
+        }}}}],
+    )
+    await ensure_client_indexes(collection_db)
+    return result.modified_count
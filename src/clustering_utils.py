@@ -13,6 +13,8 @@ from parser.models.session import Session_Model
 from .client_utils import get_clients_from_collection, post_clients_in_collection
 from .collection_utils import collection_exists, get_hashed_files, purge_collection
 from .database.config import user_collection
+from .cache_utils import bump_generation
+from .events_utils import maintain_events
 from .models.users import User_Model
 from .security import get_current_active_user
 from .users_utils import user_exists
@@ -87,6 +89,8 @@ async def post_clusters(
 
             # Add the clients to the collection
             await post_clients_in_collection(list_client, collection_db)  # type: ignore
+            await maintain_events(current_user.username, collection)
+            await bump_generation(collection)
             os.remove(file)
 
             clustering_approach = col_parameters['clustering approach']
@@ -254,9 +258,57 @@ def create_csv_file(documents: List[Dict], cluster_id: int) -> str:
     return output.getvalue()
 
 
-def create_zip_file(file_paths: List[str]) -> str:
-    """Create a zip file containing the CSV files."""
-    temp_dir = tempfile.mkdtemp()
+async def create_csv_files_from_events(events_db: Any, directory: str) -> List[str]:
+    """Create one CSV file per cluster from the events collection"""
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    else:
+        empty_directory(directory)
+
+    file_paths = []
+    cluster_id, file, writer = None, None, None
+    async for event in events_db.find(
+            {"cluster_id": {"$ne": None}},
+            {"_id": 0, "client_id": 1, "action": 1, "time": 1, "cluster_id": 1}
+    ).sort([("cluster_id", 1), ("client_id", 1), ("session_id", 1), ("position", 1)]):
+        # The events are sorted by cluster, so only one file is open at a time
+        if event["cluster_id"] != cluster_id:
+            if file is not None:
+                file.close()
+            cluster_id = event["cluster_id"]
+            file = open(os.path.join(directory, f"cluster_{cluster_id}.csv"), "w", newline='')
+            writer = csv.writer(file, delimiter=";")
+            writer.writerow(["client_id", "action", "timestamp"])
+            file_paths.append(file.name)
+        writer.writerow([event["client_id"], event["action"], event["time"]])
+    if file is not None:
+        file.close()
+
+    if not file_paths:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Collection is empty"
+        )
+    return file_paths
+
+
+async def create_csv_file_from_events(events_db: Any, cluster_id: int) -> str:
+    """Create CSV data of a cluster from the events collection"""
+    output = io.StringIO()
+    writer = csv.writer(output, delimiter=";")
+    async for event in events_db.find(
+            {"cluster_id": cluster_id},
+            {"_id": 0, "client_id": 1, "action": 1, "time": 1}
+    ).sort([("client_id", 1), ("session_id", 1), ("position", 1)]):
+        if not output.tell():
+            writer.writerow(["client_id", "action", "timestamp"])
+        writer.writerow([event["client_id"], event["action"], event["time"]])
+    return output.getvalue()
+
+
+def create_zip_file(file_paths: List[str], directory: str | None = None) -> str:
+    """Create a zip file containing the CSV files,
+    in directory (e.g. the workspace of the request) or else in a new temporary directory."""
+    temp_dir = directory or tempfile.mkdtemp()
     zip_file_path = os.path.join(temp_dir, "clusters.zip")
 
     with zipfile.ZipFile(zip_file_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
@@ -7,3 +7,7 @@ client = motor.motor_asyncio.AsyncIOMotorClient(MONGO_DETAILS)
 database = client.trace_logs
 
 user_collection = database.get_collection("users")
+
+job_collection = database.get_collection("jobs")
+
+discovery_job_collection = database.get_collection("discovery_jobs")
@@ -1,59 +1,1123 @@
 import os
 import io
-import glob
+import hashlib
+import pickle
+import shutil
+import time
+from collections import Counter
 import zipfile
 from typing import List
 
+import graphviz
+import numpy as np
 import pandas as pd
 import tempfile
 import pm4py
 import json
+from pm4py.algo.conformance.alignments.petri_net import algorithm as alignments
+from pm4py.algo.conformance.tokenreplay.variants import token_replay
+from pm4py.algo.discovery.alpha.variants import classic as alpha_miner
+from pm4py.algo.discovery.heuristics.variants import classic as heuristics_miner
+from pm4py.algo.evaluation.precision.variants import align_etconformance
+from pm4py.algo.evaluation.replay_fitness.variants import alignment_based as alignment_fitness
+from pm4py.algo.evaluation.replay_fitness.variants import token_replay as token_replay_fitness
+from pm4py.algo.evaluation.simplicity import algorithm as simplicity_evaluator
+from pm4py.objects.log.obj import Event, EventLog, Trace
+from pm4py.objects.petri_net.utils import check_soundness
+from pm4py.objects.petri_net.utils.align_utils import get_visible_transitions_eventually_enabled_by_marking
+from pm4py.objects.conversion.heuristics_net import converter as heuristics_net_converter
+from pm4py.visualization.petri_net import visualizer as petri_net_visualizer
+from pymongo import MongoClient
 
+from .database.config import MONGO_DETAILS, database
+from .models.discover import Quality_Type
+from .utils import CACHE_DIR, private_directory
 
-async def read_csv(file):
-    dataframe = pd.read_csv(file, sep=";")
 
-    # renaming the col ending with _id
-    dataframe.rename(columns=lambda x: 'case:concept:name' if x.endswith('_id') else x, inplace=True)
-    dataframe.rename(columns=lambda x: 'time:timestamp' if x.endswith('timestamp') else x, inplace=True)
-    dataframe.rename(columns={'action': 'concept:name'}, inplace=True)
+def create_zip_file(file_paths: List[str], directory: str | None = None) -> str:
+    """Create a zip file containing the provided files and directories,
+    in directory (e.g. the workspace of the request) or else in a new temporary directory."""
+    temp_dir = directory or tempfile.mkdtemp()
+    zip_file_path = os.path.join(temp_dir, "clusters.zip")
 
-    # Convert timestamp column to datetime and handle mixed format
-    dataframe['time:timestamp'] = pd.to_datetime(dataframe['time:timestamp'], format='mixed')
+    with zipfile.ZipFile(zip_file_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for file_path in file_paths:
+            if os.path.isdir(file_path):
+                for root, _, files in os.walk(file_path):
+                    for file in files:
+                        full_path = os.path.join(root, file)
+                        arcname = os.path.join("process_animation_files", os.path.relpath(full_path, start=file_path))
+                        zip_file.write(full_path, arcname)
+            else:
+                zip_file.write(file_path, os.path.basename(file_path))
+    return zip_file_path
 
-    return dataframe
+# Algorithms of the discovery jobs, all of them produce a petri net whose quality can be measured
+PETRI_NET_ALGORITHMS = ("alpha", "alpha_plus", "heuristic", "inductive", "dfg")
+# Files written in the result directory of a discovery job
+DISCOVERY_RESULT_FILES = ("model.png", "model.pnml", "quality.json")
+# Directory of the parsed logs cache, and its size limit in bytes
+PARSED_LOG_CACHE_DIR = os.getenv("PARSED_LOG_CACHE_DIR", os.path.join(CACHE_DIR, "parsed_logs"))
+PARSED_LOG_CACHE_MAX_BYTES = int(os.getenv("PARSED_LOG_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+# Directory of the discovered models cache, its size limit in bytes and the age (in seconds) of its oldest entries
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR", os.path.join(CACHE_DIR, "discovered_models"))
+MODEL_CACHE_MAX_BYTES = int(os.getenv("MODEL_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+MODEL_CACHE_MAX_AGE = int(os.getenv("MODEL_CACHE_MAX_AGE", str(7 * 24 * 3600)))
+# Kinds of the models returned as JSON, and the formats they are rendered in
+MODEL_KINDS = ("dfg", "heuristics_net", "petri_net")
+MODEL_IMAGE_FORMATS = ("svg", "png")
+# Number of events fetched from MongoDB in one batch when a log is read from a collection
+COLLECTION_LOG_BATCH_SIZE = 10000
+# Default number of variants replayed or aligned by the approximate quality measures
+QUALITY_SAMPLE_VARIANTS = int(os.getenv("QUALITY_SAMPLE_VARIANTS", "200"))
+# Number of traces drawn at once by the approximate quality measures
+QUALITY_SAMPLE_BLOCK = 256
+# Number of bootstrap resamples giving the confidence intervals of the approximate quality measures
+QUALITY_BOOTSTRAP_RESAMPLES = 1000
 
 
-async def read_files(file_path):
+def read_event_log(file_path: str, case_name: str, concept_name: str, timestamp: str, separator: str) -> pd.DataFrame:
+    """Read a csv or xes log file as a pm4py dataframe
+
+    Args:
+        file_path (str): path of the log file
+        separator, timestamp, concept_name, case_name: columns of the csv file (ignored for a xes file)
+
+    Returns:
+        pd.DataFrame: the log, with the case, activity and timestamp columns named as pm4py expects them
+    """
     extension = os.path.splitext(file_path)[1].lower()
     if extension == '.csv':
-        dataframe = await read_csv(file_path)
-        return dataframe
+        dataframe = pd.read_csv(file_path, sep=separator)
+        dataframe[timestamp] = pd.to_datetime(dataframe[timestamp], format='mixed')
+        return pm4py.format_dataframe(dataframe, case_id=case_name, activity_key=concept_name, timestamp_key=timestamp)
     elif extension == '.xes':
-        log = pm4py.read_xes(file_path)
-        return log
+        return pm4py.read_xes(file_path)
+    raise ValueError("The log file must be a csv or a xes file")
 
 
-def latest_image():
-    tmp_dir = os.path.expanduser('/tmp')
-    list_of_files = glob.glob(os.path.join(tmp_dir, '*'))
-    latest_image = max(list_of_files, key=os.path.getctime)
+def read_collection_log(source: dict) -> pd.DataFrame:
+    """Read the events of a log collection as a pm4py dataframe, streamed from MongoDB, run in a discovery process
+        As in the csv exported by /stats/clients_actions/, the cases are the clients and the activities
+        are the tags of the requests (their url when they are not tagged), without the outliers
 
-    return latest_image
+    Args:
+        source (dict): the collection, its events collection (None if the event layout is not enabled)
+            and the optional cluster_id and tags filters
 
-def create_zip_file(file_paths: List[str]) -> str:
-    """Create a zip file containing the provided files and directories."""
-    temp_dir = tempfile.mkdtemp()
-    zip_file_path = os.path.join(temp_dir, "clusters.zip")
+    Returns:
+        pd.DataFrame: the log, with the case, activity and timestamp columns named as pm4py expects them
+    """
+    if source["events_collection"]:
+        match = {"tag": {"$ne": "Outliers"}}
+        if source.get("cluster_id") is not None:
+            match["cluster_id"] = source["cluster_id"]
+        pipeline = [
+            {"$match": match},
+            {"$sort": {"client_id": 1, "session_id": 1, "position": 1}},
+            {"$project": {"_id": 0, "client_id": 1, "activity": {"$ifNull": ["$tag", "$action"]}, "time": 1}},
+        ]
+    else:
+        match = {"sessions.requests.request_tag": {"$ne": "Outliers"}}
+        if source.get("cluster_id") is not None:
+            match["sessions.requests.cluster_id"] = source["cluster_id"]
+        pipeline = [
+            {"$unwind": "$sessions"},
+            {"$unwind": "$sessions.requests"},
+            {"$match": match},
+            {"$project": {
+                "_id": 0,
+                "client_id": 1,
+                "activity": {"$ifNull": ["$sessions.requests.request_tag", "$sessions.requests.request_url"]},
+                "time": "$sessions.requests.request_time",
+            }},
+        ]
+    if source.get("tags"):
+        pipeline.append({"$match": {"activity": {"$in": source["tags"]}}})
 
-    with zipfile.ZipFile(zip_file_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
-        for file_path in file_paths:
-            if os.path.isdir(file_path):
-                for root, _, files in os.walk(file_path):
-                    for file in files:
-                        full_path = os.path.join(root, file)
-                        arcname = os.path.join("process_animation_files", os.path.relpath(full_path, start=file_path))
-                        zip_file.write(full_path, arcname)
+    client = MongoClient(MONGO_DETAILS)
+    try:
+        collection_db = client[database.name][source["events_collection"] or source["collection"]]
+        columns = {"client_id": [], "action": [], "timestamp": []}
+        for event in collection_db.aggregate(pipeline, allowDiskUse=True, batchSize=COLLECTION_LOG_BATCH_SIZE):
+            columns["client_id"].append(event["client_id"])
+            columns["action"].append(event["activity"])
+            columns["timestamp"].append(event["time"])
+    finally:
+        client.close()
+    if not columns["client_id"]:
+        raise ValueError("No events found in the collection")
+
+    dataframe = pd.DataFrame(columns)
+    dataframe["timestamp"] = pd.to_datetime(dataframe["timestamp"], format='mixed', utc=True)
+    return pm4py.format_dataframe(dataframe, case_id="client_id", activity_key="action", timestamp_key="timestamp")
+
+
+def parsed_log_key(source: dict) -> str:
+    """Key of a parsed log in the cache
+        For a file: its content and the settings used to parse it.
+        For a collection: its name, its generation (increased each time it changes) and the filters
+
+    Args:
+        source (dict): file_path, file_hash and columns of a log file,
+            or the collection, events_collection, generation, cluster_id and tags of a log collection
+    """
+    if "collection" in source:
+        key = ["collection", source["collection"], source["generation"], bool(source["events_collection"]),
+               source.get("cluster_id"), sorted(source.get("tags") or [])]
+    else:
+        extension = os.path.splitext(source["file_path"])[1].lower()
+        # The columns of a xes file are not settings, pm4py reads its standard attributes
+        settings = {} if extension == '.xes' else source["columns"]
+        key = [source["file_hash"], extension, settings]
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def evict_parsed_logs(max_bytes: int = PARSED_LOG_CACHE_MAX_BYTES) -> None:
+    """Delete the least recently used parsed logs until the cache fits in max_bytes"""
+    entries = []
+    with os.scandir(PARSED_LOG_CACHE_DIR) as scan:
+        for entry in scan:
+            if entry.name.endswith(".pkl"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def read_cache_file(cache_path: str):
+    """Load an object of the parsed logs cache, None if it is not cached"""
+    # The cached objects are pickled, they are only loaded from a directory private to the API
+    private_directory(PARSED_LOG_CACHE_DIR)
+    try:
+        with open(cache_path, "rb") as cache_file:
+            value = pickle.load(cache_file)
+    except FileNotFoundError:
+        return None
+    # The modification time orders the entries for the eviction
+    os.utime(cache_path)
+    return value
+
+
+def write_cache_file(cache_path: str, value) -> None:
+    """Save an object in the parsed logs cache"""
+    private_directory(PARSED_LOG_CACHE_DIR)
+    # Written aside then renamed, so a concurrent process never reads a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=PARSED_LOG_CACHE_DIR, suffix=".tmp")
+    with os.fdopen(fd, "wb") as tmp_file:
+        pickle.dump(value, tmp_file, protocol=5)
+    os.replace(tmp_path, cache_path)
+    evict_parsed_logs()
+
+
+def load_event_log(source: dict) -> pd.DataFrame:
+    """Read a log file or a log collection through the parsed logs cache, run in a discovery process
+        The normalized dataframe is kept on disk (pickled, its columns are stored as raw numpy blocks),
+        keyed by parsed_log_key: mining the same log again with another algorithm loads it
+        without parsing the csv or xes file, or reading the collection
+
+    Args:
+        source (dict): the log file or the log collection, as described in parsed_log_key
+
+    Returns:
+        pd.DataFrame: the log, as returned by read_event_log or read_collection_log
+    """
+    cache_path = os.path.join(PARSED_LOG_CACHE_DIR, parsed_log_key(source) + ".pkl")
+    log = read_cache_file(cache_path)
+    if log is None:
+        if "collection" in source:
+            log = read_collection_log(source)
+        else:
+            log = read_event_log(source["file_path"], **source["columns"])
+        write_cache_file(cache_path, log)
+    return log
+
+
+def count_values(values) -> dict:
+    labels, counts = np.unique(values, return_counts=True)
+    return {label: int(count) for label, count in zip(labels.tolist(), counts.tolist())}
+
+
+def count_tuples(*columns) -> dict:
+    """Count the rows of aligned arrays, e.g. the (source, target) pairs of the directly-follows relation"""
+    if not len(columns[0]):
+        return {}
+    counts = pd.DataFrame({i: column for i, column in enumerate(columns)}).value_counts(sort=False)
+    return {tuple(key): int(count) for key, count in counts.items()}
+
+
+class LogAbstraction:
+    """Abstraction of a log computed in one pass: the activities, the directly-follows relation
+        (with its performance), the footprints and the variants.
+        The miners working on the directly-follows graph (alpha, heuristic, DFG) and the DFG images
+        are built on it instead of scanning the log again
+    """
+
+    def __init__(self, log: pd.DataFrame):
+        sort_keys = ["case:concept:name", "time:timestamp"] + (["@@index"] if "@@index" in log else [])
+        log = log.sort_values(sort_keys, kind="stable")
+        cases = log["case:concept:name"].to_numpy()
+        activities = log["concept:name"].to_numpy(dtype=object)
+        seconds = log["time:timestamp"].to_numpy(dtype="datetime64[ns]").astype(np.int64) / 1e9
+
+        # The events followed by an event of the same case, and by two events of the same case
+        new_case = np.r_[True, cases[1:] != cases[:-1]]
+        follows = ~np.r_[new_case[1:], True]
+        follows_2 = follows & np.r_[follows[1:], False]
+        index = np.flatnonzero(follows)
+        index_2 = np.flatnonzero(follows_2)
+
+        self.activities = count_values(activities)
+        self.start_activities = count_values(activities[new_case])
+        self.end_activities = count_values(activities[np.r_[new_case[1:], True]])
+        self.dfg = count_tuples(activities[index], activities[index + 1])
+        self.dfg_window_2 = count_tuples(activities[index_2], activities[index_2 + 2])
+        self.freq_triples = count_tuples(activities[index_2], activities[index_2 + 1], activities[index_2 + 2])
+
+        # Performance of the directly-follows relation: time (in seconds) between the two activities
+        durations = pd.DataFrame({
+            "source": activities[index], "target": activities[index + 1], "duration": seconds[index + 1] - seconds[index]
+        }).groupby(["source", "target"])["duration"].agg(["mean", "median", "max", "min", "sum", "std"]).fillna(0)
+        self.performance_dfg = {
+            key: {"mean": row["mean"], "median": row["median"], "max": row["max"], "min": row["min"],
+                  "sum": row["sum"], "stdev": row["std"]}
+            for key, row in durations.iterrows()
+        }
+
+        self.variants = Counter(tuple(trace) for trace in np.split(activities, np.flatnonzero(new_case)[1:]))
+        self.footprints = {
+            "dfg": self.dfg,
+            "sequence": {(a, b) for a, b in self.dfg if (b, a) not in self.dfg},
+            "parallel": {(a, b) for a, b in self.dfg if (b, a) in self.dfg},
+            "activities": set(self.activities),
+            "start_activities": set(self.start_activities),
+            "end_activities": set(self.end_activities),
+            "min_trace_length": min((len(variant) for variant in self.variants), default=0),
+        }
+
+
+def load_log_abstraction(source: dict, log: pd.DataFrame | None = None) -> LogAbstraction:
+    """Get the abstraction of a log, cached along the parsed log
+
+    Args:
+        source (dict): the log file or the log collection, as described in parsed_log_key
+        log (pd.DataFrame): the log when it is already loaded
+
+    Returns:
+        LogAbstraction: the abstraction of the log
+    """
+    cache_path = os.path.join(PARSED_LOG_CACHE_DIR, parsed_log_key(source) + ".abstraction.pkl")
+    abstraction = read_cache_file(cache_path)
+    if abstraction is None:
+        abstraction = LogAbstraction(log if log is not None else load_event_log(source))
+        write_cache_file(cache_path, abstraction)
+    return abstraction
+
+
+def model_cache_key(*parts) -> str:
+    """Key of a discovered model in the cache: the log (its hash) and everything the model depends on,
+        e.g. the algorithm, its thresholds and the quality approaches
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_cached_model(key: str) -> str | None:
+    """Return the directory of a cached model, or None if it is not cached"""
+    # The cached models are served as they are, they are only taken from a directory private to the API
+    path = os.path.join(private_directory(MODEL_CACHE_DIR), key)
+    if not os.path.isdir(path):
+        return None
+    # The modification time orders the entries for the eviction
+    os.utime(path)
+    return path
+
+
+def store_cached_model(key: str, file_paths: list[str]) -> str:
+    """Copy the files of a discovered model (model, PNML, images, quality JSON, zip...) in the cache
+
+    Returns:
+        str: the directory of the cached model
+    """
+    path = os.path.join(private_directory(MODEL_CACHE_DIR), key)
+    # Filled aside then renamed, so a model is never served before all its files are copied
+    tmp_path = tempfile.mkdtemp(dir=MODEL_CACHE_DIR, suffix=".tmp")
+    for file_path in file_paths:
+        shutil.copy(file_path, tmp_path)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # The same model was cached meanwhile
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    evict_cached_models()
+    return path
+
+
+def evict_cached_models(max_bytes: int = MODEL_CACHE_MAX_BYTES, max_age: int = MODEL_CACHE_MAX_AGE) -> None:
+    """Delete the cached models unused for max_age seconds, then the least recently used ones
+        until the cache fits in max_bytes
+    """
+    entries = []
+    with os.scandir(MODEL_CACHE_DIR) as scan:
+        for entry in scan:
+            if entry.is_dir() and not entry.name.endswith(".tmp"):
+                size = sum(os.path.getsize(os.path.join(entry.path, name)) for name in os.listdir(entry.path))
+                entries.append((entry.stat().st_mtime, size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    oldest = time.time() - max_age
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes and mtime >= oldest:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def discover_heuristics_net(abstraction: LogAbstraction, dependency_threshold: float = 0.5,
+                            and_threshold: float = 0.65, loop_two_threshold: float = 0.5):
+    """Discover a heuristics net from the abstraction of a log, as pm4py does from the log itself"""
+    parameters = {
+        heuristics_miner.Parameters.DEPENDENCY_THRESH: dependency_threshold,
+        heuristics_miner.Parameters.AND_MEASURE_THRESH: and_threshold,
+        heuristics_miner.Parameters.LOOP_LENGTH_TWO_THRESH: loop_two_threshold,
+    }
+    return heuristics_miner.apply_heu_dfg(
+        abstraction.dfg, activities=list(abstraction.activities), activities_occurrences=abstraction.activities,
+        start_activities=abstraction.start_activities, end_activities=abstraction.end_activities,
+        dfg_window_2=abstraction.dfg_window_2, freq_triples=abstraction.freq_triples, parameters=parameters,
+    )
+
+
+def discover_petri_net(source: dict, algorithm: str, parameters: dict, log: pd.DataFrame | None = None):
+    """Discover a petri net from a log
+        The alpha, heuristic and DFG miners only need the abstraction of the log, the log itself is not read
+        when its abstraction is cached
+
+    Args:
+        source (dict): the log file or the log collection, as described in parsed_log_key
+        algorithm (str): one of PETRI_NET_ALGORITHMS
+        parameters (dict): parameters of the algorithm (noise_threshold for the inductive miner,
+            dependency_threshold, and_threshold and loop_two_threshold for the heuristic miner)
+        log (pd.DataFrame): the log when it is already loaded
+
+    Returns:
+        the petri net, its initial marking and its final marking
+    """
+    if algorithm in ("alpha", "heuristic", "dfg"):
+        abstraction = load_log_abstraction(source, log)
+        if algorithm == "alpha":
+            return alpha_miner.apply_dfg_sa_ea(abstraction.dfg, abstraction.start_activities,
+                                               abstraction.end_activities)
+        elif algorithm == "heuristic":
+            return heuristics_net_converter.apply(discover_heuristics_net(abstraction, **parameters))
+        return pm4py.convert_to_petri_net(abstraction.dfg, abstraction.start_activities, abstraction.end_activities)
+
+    log = log if log is not None else load_event_log(source)
+    if algorithm == "alpha_plus":
+        return pm4py.discover_petri_net_alpha_plus(log)
+    elif algorithm == "inductive":
+        return pm4py.discover_petri_net_inductive(log, **parameters)
+    raise ValueError(f"Unknown discovery algorithm {algorithm}")
+
+
+def variant_trace(variant: tuple) -> Trace:
+    return Trace([Event({"concept:name": activity}) for activity in variant])
+
+
+def alignments_cache_path(model_key: str) -> str:
+    return os.path.join(PARSED_LOG_CACHE_DIR, model_key + ".alignments.pkl")
+
+
+def align_variants(variants: dict, net, initial_marking, final_marking, model_key: str | None = None) -> dict:
+    """Align each variant of a log once on a petri net
+        The alignments are cached per (model, variant) along the parsed logs. The key of the model includes the
+        log it was discovered from: measuring the quality of the same model again (e.g. with the other precision
+        approach, or exactly after an approximation) only aligns the variants never aligned before, while another
+        log sharing the variants gets its own model and alignments
+
+    Args:
+        variants (dict): the variants of the log (tuples of activities) and their number of traces
+        model_key (str): key of the model, as built by model_cache_key, the alignments are not cached without it
+
+    Returns:
+        dict: the alignment of each variant
+    """
+    cached = (read_cache_file(alignments_cache_path(model_key)) if model_key else None) or {}
+    missing = [variant for variant in variants if variant not in cached]
+    if missing:
+        # The cost of the worst alignment is the same for all the variants, pm4py computes it once per log too
+        best_worst_cost = alignments.DEFAULT_VARIANT.value.get_best_worst_cost(net, initial_marking, final_marking)
+        parameters = {alignments.Parameters.BEST_WORST_COST_INTERNAL: best_worst_cost}
+        for variant in missing:
+            cached[variant] = alignments.apply_trace(variant_trace(variant), net, initial_marking, final_marking,
+                                                     parameters=dict(parameters))
+        if model_key:
+            write_cache_file(alignments_cache_path(model_key), cached)
+    return {variant: cached[variant] for variant in variants}
+
+
+def replay_variants(variants: dict, net, initial_marking, final_marking) -> list[dict]:
+    """Replay each variant of a log once on a petri net with the token-based replay"""
+    parameters = {
+        token_replay.Parameters.CONSIDER_REMAINING_IN_FITNESS: True,
+        token_replay.Parameters.SHOW_PROGRESS_BAR: False,
+    }
+    log = EventLog([variant_trace(variant) for variant in variants])
+    return token_replay.apply(log, net, initial_marking, final_marking, parameters=parameters)
+
+
+def repeat_results(results: list, counts) -> list:
+    """Repeat the result of each variant for each of its traces, as if each trace had been replayed"""
+    return [result for result, count in zip(results, counts) for _ in range(count)]
+
+
+def compute_fitness(variants: dict, net, initial_marking, final_marking, approach: str,
+                    model_key: str | None = None, replayed: list[dict] | None = None) -> dict:
+    """Fitness of a petri net on a log, each variant being replayed or aligned once and weighted by its traces
+
+    Args:
+        variants (dict): the variants of the log and their number of traces
+        approach (str): value of Quality_Type
+        model_key (str): key of the model, caching its alignments
+        replayed (list[dict]): the token-based replay of the variants when it is already computed
+
+    Returns:
+        dict: the fitness, as computed by pm4py on the whole log
+    """
+    if approach == Quality_Type.align.value:
+        aligned = align_variants(variants, net, initial_marking, final_marking, model_key)
+        return alignment_fitness.evaluate(repeat_results(aligned.values(), variants.values()))
+    if replayed is None:
+        replayed = replay_variants(variants, net, initial_marking, final_marking)
+    return token_replay_fitness.evaluate(repeat_results(replayed, variants.values()))
+
+
+def variant_prefixes(variants: dict) -> tuple[dict, Counter]:
+    """The prefixes of the traces of a log, the activities following them and their number of traces"""
+    prefixes = {}
+    prefix_count = Counter()
+    for variant, count in variants.items():
+        for i in range(1, len(variant)):
+            prefixes.setdefault(variant[:i], set()).add(variant[i])
+            prefix_count[variant[:i]] += count
+    return prefixes, prefix_count
+
+
+def prefix_activations(prefixes: list[tuple], net, initial_marking, final_marking, approach: str) -> list:
+    """Replay or align each prefix once, and get the visible transitions enabled once it is replayed
+
+    Returns:
+        list: the labels of the transitions activated by each prefix, None when the prefix does not fit the model
+    """
+    fake_log = EventLog([variant_trace(prefix) for prefix in prefixes])
+    if approach == Quality_Type.align.value:
+        if not check_soundness.check_easy_soundness_net_in_fin_marking(net, initial_marking, final_marking):
+            raise ValueError("The alignments need an easy sound petri net")
+        stop_markings = align_etconformance.transform_markings_from_sync_to_original_net(
+            align_etconformance.align_fake_log_stop_marking(fake_log, net, initial_marking, final_marking,
+                                                            parameters={"show_progress_bar": False}), net)
+        return [
+            None if markings is None else {
+                transition.label for marking in markings
+                for transition in get_visible_transitions_eventually_enabled_by_marking(net, marking)
+                if transition.label is not None
+            }
+            for markings in stop_markings
+        ]
+    parameters = {
+        token_replay.Parameters.CONSIDER_REMAINING_IN_FITNESS: False,
+        token_replay.Parameters.TRY_TO_REACH_FINAL_MARKING_THROUGH_HIDDEN: False,
+        token_replay.Parameters.STOP_IMMEDIATELY_UNFIT: True,
+        token_replay.Parameters.WALK_THROUGH_HIDDEN_TRANS: True,
+        token_replay.Parameters.SHOW_PROGRESS_BAR: False,
+    }
+    return [
+        {transition.label for transition in result["enabled_transitions_in_marking"]
+         if transition.label is not None} if result["trace_is_fit"] else None
+        for result in token_replay.apply(fake_log, net, initial_marking, final_marking, parameters=parameters)
+    ]
+
+
+def initially_enabled(net, initial_marking) -> set:
+    return {transition.label for transition in
+            get_visible_transitions_eventually_enabled_by_marking(net, initial_marking)}
+
+
+def compute_precision(variants: dict, net, initial_marking, final_marking, approach: str) -> float:
+    """ETConformance precision of a petri net on a log, as computed by pm4py on an EventLog
+        The prefixes are counted from the variants, and each distinct prefix is replayed or aligned once.
+        The empty prefix counts once per trace (pm4py counts it once per event when it is given a dataframe)
+
+    Args:
+        variants (dict): the variants of the log and their number of traces
+        approach (str): value of Quality_Type
+
+    Returns:
+        float: the precision
+    """
+    prefixes, prefix_count = variant_prefixes(variants)
+    activations = prefix_activations(list(prefixes), net, initial_marking, final_marking, approach)
+
+    # The empty prefix: the transitions enabled in the initial marking which never start a trace escape
+    traces = sum(variants.values())
+    start_activities = {variant[0] for variant in variants if variant}
+    enabled_initially = initially_enabled(net, initial_marking)
+    sum_activated = traces * len(enabled_initially)
+    sum_escaping = traces * len(enabled_initially - start_activities)
+    for (prefix, following), activated in zip(prefixes.items(), activations):
+        if activated is not None:
+            sum_activated += len(activated) * prefix_count[prefix]
+            sum_escaping += len(activated - following) * prefix_count[prefix]
+    return 1 - sum_escaping / sum_activated if sum_activated > 0 else 1.0
+
+
+def compute_generalization(variants: dict, net, replayed: list[dict]) -> float:
+    """Generalization of a petri net from the token-based replay of the variants of a log, as computed by pm4py"""
+    occurrences = Counter()
+    for result, count in zip(replayed, variants.values()):
+        for transition in result["activated_transitions"]:
+            occurrences[transition] += count
+    inverse_sum = sum(1 / np.sqrt(occurrence) for occurrence in occurrences.values())
+    inverse_sum += sum(1 for transition in net.transitions if transition not in occurrences)
+    return 1 - inverse_sum / len(net.transitions) if net.transitions else 1.0
+
+
+def variant_contributions(chunk: list[tuple], net, initial_marking, final_marking, fitness_approach: str,
+                          precision_approach: str, following: dict, start_activities: set, activations: dict,
+                          model_key: str | None = None) -> np.ndarray:
+    """Contribution of one trace of each variant to the sums the quality measures are computed from:
+        its fitness (counted, fitting, fitness, then the cost and best worst cost of its alignment or the
+        missing, consumed, remaining and produced tokens of its replay), the transitions activated and escaping
+        after its prefixes (precision) and the occurrences of each transition of the net in its replay
+        (generalization)
+
+    Args:
+        chunk (list[tuple]): the variants
+        following (dict): the activities following each prefix in the whole log
+        start_activities (set): the start activities of the whole log
+        activations (dict): the transitions activated by the prefixes already replayed or aligned, completed
+
+    Returns:
+        np.ndarray: one row per variant
+    """
+    transitions = {transition: 9 + i for i, transition in enumerate(net.transitions)}
+    contributions = np.zeros((len(chunk), 9 + len(transitions)))
+    replayed = replay_variants(dict.fromkeys(chunk), net, initial_marking, final_marking)
+    if fitness_approach == Quality_Type.align.value:
+        aligned = align_variants(dict.fromkeys(chunk), net, initial_marking, final_marking, model_key)
+    prefixes = list({variant[:i] for variant in chunk for i in range(1, len(variant))} - activations.keys())
+    activations.update(zip(prefixes, prefix_activations(prefixes, net, initial_marking, final_marking,
+                                                        precision_approach)))
+    enabled_initially = initially_enabled(net, initial_marking)
+
+    for row, (variant, result) in enumerate(zip(chunk, replayed)):
+        if fitness_approach == Quality_Type.align.value:
+            alignment = aligned[variant]
+            if alignment is not None:
+                contributions[row, :5] = (1, alignment["fitness"] == 1.0, alignment["fitness"],
+                                          alignment["cost"], alignment["bwc"])
+        else:
+            contributions[row, :7] = (1, result["trace_is_fit"], result["trace_fitness"], result["missing_tokens"],
+                                      result["consumed_tokens"], result["remaining_tokens"],
+                                      result["produced_tokens"])
+        activated = len(enabled_initially)
+        escaping = len(enabled_initially - start_activities)
+        for i in range(1, len(variant)):
+            if activations[variant[:i]] is not None:
+                activated += len(activations[variant[:i]])
+                escaping += len(activations[variant[:i]] - following[variant[:i]])
+        contributions[row, 7:9] = (activated, escaping)
+        for transition in result["activated_transitions"]:
+            contributions[row, transitions[transition]] += 1
+    return contributions
+
+
+def quality_measures(totals: np.ndarray, fitness_approach: str) -> dict:
+    """The quality measures from the sums of the contributions of the traces, as pm4py computes them
+
+    Args:
+        totals (np.ndarray): the sums of the columns of variant_contributions, one row per estimation
+
+    Returns:
+        dict: the value of each measure, one per row
+    """
+    counted, fitting, fitness = totals[:, 0], totals[:, 1], totals[:, 2]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if fitness_approach == Quality_Type.align.value:
+            valid = counted > 0
+            log_fitness = np.where(valid, 1 - np.where(totals[:, 4] > 0, totals[:, 3] / totals[:, 4], 0), 0)
+        else:
+            valid = (counted > 0) & (totals[:, 4] > 0) & (totals[:, 6] > 0)
+            log_fitness = np.where(valid, 0.5 * (1 - totals[:, 3] / totals[:, 4])
+                                   + 0.5 * (1 - totals[:, 5] / totals[:, 6]), 0)
+        occurrences = totals[:, 9:]
+        inverse_sum = np.where(occurrences > 0, 1 / np.sqrt(occurrences), 1).sum(axis=1)
+        return {
+            "log_fitness": log_fitness,
+            "average_trace_fitness": np.where(valid, fitness / counted, 0),
+            "percentage_of_fitting_traces": np.where(valid, 100 * fitting / counted, 0),
+            "precision": np.where(totals[:, 7] > 0, 1 - totals[:, 8] / totals[:, 7], 1),
+            "generalization": 1 - inverse_sum / occurrences.shape[1] if occurrences.shape[1] else np.ones(len(totals)),
+        }
+
+
+def estimate_quality(variants: dict, net, initial_marking, final_marking, fitness_approach: str,
+                     precision_approach: str, sample_variants: int = QUALITY_SAMPLE_VARIANTS,
+                     time_limit: float | None = None, confidence_level: float = 0.95,
+                     model_key: str | None = None, seed: int = 0) -> dict:
+    """Estimate the fitness, precision and generalization of a petri net on a sample of the variants of a log
+        The log is split in two strata: the most frequent variants are all evaluated (their traces are exact),
+        the traces of the other variants are drawn at random (a variant with more traces is drawn more often)
+        until sample_variants variants are evaluated or the time limit is reached.
+        The measures are computed from the sums of the contributions of the traces, the sums of the sampled
+        stratum being extrapolated to all its traces, and their confidence intervals are bootstrapped
+        from the draws. When the log has at most sample_variants variants, the measures are exact.
+        The generalization is underestimated when rare transitions of the net are never fired in the sample
+
+    Args:
+        variants (dict): the variants of the log and their number of traces
+        fitness_approach, precision_approach (str): values of Quality_Type
+        sample_variants (int): maximum number of variants replayed or aligned
+        time_limit (float): time (in seconds) after which no more variants are evaluated,
+            at least one block of frequent variants and one block of draws are evaluated anyway
+        confidence_level (float): level of the confidence intervals
+        model_key (str): key of the model, caching its alignments
+        seed (int): seed of the draws, the same sample is drawn for the same log
+
+    Returns:
+        dict: the Fitness (as computed by pm4py), Precision and Generalization estimates, and the Approximation:
+            the confidence intervals of the measures and the size of the sample
+    """
+    started = time.monotonic()
+    rng = np.random.default_rng(seed)
+    following = variant_prefixes(variants)[0]
+    start_activities = {variant[0] for variant in variants if variant}
+    activations = {}
+
+    def evaluate(chunk):
+        return variant_contributions(chunk, net, initial_marking, final_marking, fitness_approach,
+                                     precision_approach, following, start_activities, activations, model_key)
+
+    # The frequent variants are evaluated by blocks, the ones left when the time limit is reached are sampled
+    ordered = sorted(variants, key=variants.get, reverse=True)
+    head_size = len(ordered) if len(ordered) <= sample_variants else sample_variants // 2
+    head = []
+    totals = np.zeros(9 + len(net.transitions))
+    for start in range(0, head_size, QUALITY_SAMPLE_BLOCK):
+        if head and time_limit is not None and time.monotonic() - started > time_limit:
+            break
+        chunk = ordered[start:min(start + QUALITY_SAMPLE_BLOCK, head_size)]
+        totals += np.array([variants[variant] for variant in chunk], dtype=float) @ evaluate(chunk)
+        head.extend(chunk)
+    tail = ordered[len(head):]
+    head_traces = sum(variants[variant] for variant in head)
+
+    sampled = {}
+    draws = Counter()
+    if tail:
+        tail_weights = np.array([variants[variant] for variant in tail], dtype=float)
+        tail_traces = tail_weights.sum()
+        budget = sample_variants - len(head)
+        full = False
+        while not full and draws.total() < tail_traces:
+            accepted, new = [], {}
+            for index in rng.choice(len(tail), size=QUALITY_SAMPLE_BLOCK, p=tail_weights / tail_traces).tolist():
+                if draws.total() + len(accepted) >= tail_traces:
+                    break
+                if index not in sampled and index not in new:
+                    # The sample stops before the draw exceeding the budget: it is the beginning of the draws
+                    if len(sampled) + len(new) >= budget:
+                        full = True
+                        break
+                    new[index] = None
+                accepted.append(index)
+            if new:
+                sampled.update(zip(new, evaluate([tail[index] for index in new])))
+            draws.update(accepted)
+            if time_limit is not None and time.monotonic() - started > time_limit:
+                break
+
+    if draws:
+        indexes = list(sampled)
+        contributions = np.array([sampled[index] for index in indexes])
+        counts = np.array([draws[index] for index in indexes], dtype=float)
+        scale = tail_traces / draws.total()
+        estimates = quality_measures((totals + scale * counts @ contributions)[None, :], fitness_approach)
+        # Bootstrap: the draws are drawn again from the sample, the frequent variants stay exact
+        resampled = rng.multinomial(draws.total(), counts / draws.total(), size=QUALITY_BOOTSTRAP_RESAMPLES)
+        bootstrapped = quality_measures(totals + scale * resampled @ contributions, fitness_approach)
+        quantiles = [(1 - confidence_level) / 2, (1 + confidence_level) / 2]
+        intervals = {name: np.quantile(values, quantiles).tolist() for name, values in bootstrapped.items()}
+    else:
+        estimates = quality_measures(totals[None, :], fitness_approach)
+        intervals = {name: [values[0], values[0]] for name, values in estimates.items()}
+    estimates = {name: float(values[0]) for name, values in estimates.items()}
+
+    fitness = {
+        "perc_fit_traces": estimates["percentage_of_fitting_traces"],
+        "average_trace_fitness": estimates["average_trace_fitness"],
+        "log_fitness": estimates["log_fitness"],
+        "percentage_of_fitting_traces": estimates["percentage_of_fitting_traces"],
+    }
+    if fitness_approach == Quality_Type.align.value:
+        fitness.update({"percFitTraces": fitness["perc_fit_traces"],
+                        "averageFitness": fitness["average_trace_fitness"]})
+    return {
+        "Fitness": fitness,
+        "Precision": estimates["precision"],
+        "Generalization": estimates["generalization"],
+        "Approximation": {
+            "confidence_level": confidence_level,
+            "intervals": intervals,
+            "traces": sum(variants.values()),
+            "variants": len(variants),
+            "exact_traces": head_traces,
+            "sampled_traces": head_traces + draws.total(),
+            "sampled_variants": len(head) + len(sampled),
+        },
+    }
+
+
+def run_quality_pipeline(source: dict, output_dir: str, algorithm: str, parameters: dict,
+                         fitness_approach: str, precision_approach: str, sampling: dict | None = None,
+                         progress=None) -> dict:
+    """Discover a petri net from a log, measure its quality and save the results, run in a discovery process
+
+    Args:
+        source (dict): the log file or the log collection, as described in parsed_log_key
+        output_dir (str): directory receiving the files of DISCOVERY_RESULT_FILES
+        algorithm (str): one of PETRI_NET_ALGORITHMS
+        parameters (dict): parameters of the algorithm
+        fitness_approach, precision_approach (str): values of Quality_Type
+        sampling (dict): sample_variants, time_limit and confidence_level of the approximate quality
+            (see estimate_quality), the quality is exact when it is None
+        progress: called with the name of each phase (read, mine, fitness, precision, render,
+            or read, mine, sample, render for the approximate quality)
+
+    Returns:
+        dict: the quality of the model, as in the quality.json file
+    """
+    progress = progress or (lambda phase: None)
+
+    progress("read")
+    # The log is only read when its abstraction is not cached, or by the miners needing the traces
+    variants = load_log_abstraction(source).variants
+
+    progress("mine")
+    net, initial_marking, final_marking = discover_petri_net(source, algorithm, parameters)
+    model_key = model_cache_key(parsed_log_key(source), "petri_net", algorithm, parameters)
+
+    if sampling:
+        progress("sample")
+        quality = estimate_quality(variants, net, initial_marking, final_marking, fitness_approach,
+                                   precision_approach, model_key=model_key, **sampling)
+    else:
+        progress("fitness")
+        # The token-based replay of the variants also gives the generalization
+        replayed = replay_variants(variants, net, initial_marking, final_marking)
+        fitness = compute_fitness(variants, net, initial_marking, final_marking, fitness_approach, model_key,
+                                  replayed)
+
+        progress("precision")
+        precision = compute_precision(variants, net, initial_marking, final_marking, precision_approach)
+        quality = {
+            "Fitness": fitness,
+            "Precision": precision,
+            "Generalization": compute_generalization(variants, net, replayed),
+        }
+
+    progress("render")
+    quality["Simplicity"] = simplicity_evaluator.apply(net)
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, "quality.json"), "w") as quality_file:
+        json.dump(quality, quality_file, indent=2, default=float)
+    pm4py.write_pnml(net, initial_marking, final_marking, os.path.join(output_dir, "model.pnml"))
+    pm4py.save_vis_petri_net(net, initial_marking, final_marking, os.path.join(output_dir, "model.png"))
+    return json.loads(json.dumps(quality, default=float))
+
+
+def quality_model_zip(source: dict, output_dir: str, algorithm: str, parameters: dict,
+                      fitness_approach: str, precision_approach: str, sampling: dict | None = None) -> str:
+    """Run the quality pipeline and zip its files, for the *_quality routes, run in a discovery process
+
+    Returns:
+        str: path of the zip file, containing the quality JSON, the PNML file and the png of the petri net
+    """
+    run_quality_pipeline(source, output_dir, algorithm, parameters, fitness_approach, precision_approach, sampling)
+    zip_path = os.path.join(output_dir, "Model_Quality.zip")
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for filename in DISCOVERY_RESULT_FILES:
+            zip_file.write(os.path.join(output_dir, filename), filename)
+    return zip_path
+
+
+def render_petri_net(source: dict, output_dir: str, algorithm: str, parameters: dict) -> str:
+    """Discover a petri net from a log and save its image, run in a discovery process
+
+    Returns:
+        str: path of the png file
+    """
+    net, initial_marking, final_marking = discover_petri_net(source, algorithm, parameters)
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, "model.png")
+    pm4py.save_vis_petri_net(net, initial_marking, final_marking, output_path)
+    return output_path
+
+
+def render_dfg(source: dict, output_dir: str) -> str:
+    """Save the image of the directly-follows graph of a log, run in a discovery process
+
+    Returns:
+        str: path of the png file
+    """
+    abstraction = load_log_abstraction(source)
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, "dfg.png")
+    pm4py.save_vis_dfg(abstraction.dfg, abstraction.start_activities, abstraction.end_activities, output_path)
+    return output_path
+
+
+def render_performance_dfg(source: dict, output_dir: str) -> str:
+    """Save the image of the directly-follows graph of a log annotated with the mean time between the activities
+
+    Returns:
+        str: path of the png file
+    """
+    abstraction = load_log_abstraction(source)
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, "performance_dfg.png")
+    pm4py.save_vis_performance_dfg(abstraction.performance_dfg, abstraction.start_activities,
+                                   abstraction.end_activities, output_path)
+    return output_path
+
+
+def render_heuristics_net(source: dict, output_dir: str, dependency_threshold: float, and_threshold: float,
+                          loop_two_threshold: float) -> str:
+    """Save the image of the heuristics net of a log
+
+    Returns:
+        str: path of the png file
+    """
+    heuristics_net = discover_heuristics_net(load_log_abstraction(source), dependency_threshold, and_threshold,
+                                             loop_two_threshold)
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, "heuristics_net.png")
+    pm4py.save_vis_heuristics_net(heuristics_net, output_path)
+    return output_path
+
+
+def render_frequency_alpha(source: dict, output_dir: str) -> str:
+    """Save the image of the alpha miner petri net of a log, decorated with the frequency of the activities
+        The net is mined from the abstraction, the frequencies are replayed on the log
+
+    Returns:
+        str: path of the png file
+    """
+    log = load_event_log(source)
+    net, initial_marking, final_marking = discover_petri_net(source, "alpha", {}, log)
+    gviz = petri_net_visualizer.apply(net, initial_marking, final_marking, log=log,
+                                      variant=petri_net_visualizer.Variants.FREQUENCY,
+                                      parameters={"format": "png"})
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, "frequency_alpha.png")
+    petri_net_visualizer.save(gviz, output_path)
+    return output_path
+
+
+def dfg_model(abstraction: LogAbstraction) -> dict:
+    """The directly-follows graph of a log as JSON: its activities (with their number of occurrences, as start
+        and as end activity) and its arcs (with their frequency and the time between the two activities)
+    """
+    return {
+        "kind": "dfg",
+        "nodes": [
+            {"id": str(activity), "label": str(activity), "frequency": count,
+             "start": abstraction.start_activities.get(activity, 0), "end": abstraction.end_activities.get(activity, 0)}
+            for activity, count in sorted(abstraction.activities.items(), key=lambda item: str(item[0]))
+        ],
+        "arcs": [
+            {"source": str(source), "target": str(target), "frequency": count,
+             "performance": {name: float(value)
+                             for name, value in abstraction.performance_dfg[(source, target)].items()}}
+            for (source, target), count in sorted(abstraction.dfg.items(), key=lambda item: str(item[0]))
+        ],
+    }
+
+
+def heuristics_net_model(heuristics_net) -> dict:
+    """A heuristics net as JSON: its activities and its arcs, with their frequency and dependency"""
+    start_activities = {activity: count for activities in heuristics_net.start_activities
+                        for activity, count in activities.items()}
+    end_activities = {activity: count for activities in heuristics_net.end_activities
+                      for activity, count in activities.items()}
+    return {
+        "kind": "heuristics_net",
+        "nodes": [
+            {"id": str(name), "label": str(name), "frequency": node.node_occ,
+             "start": start_activities.get(name, 0), "end": end_activities.get(name, 0)}
+            for name, node in sorted(heuristics_net.nodes.items(), key=lambda item: str(item[0]))
+        ],
+        "arcs": [
+            {"source": str(name), "target": str(target.node_name), "frequency": edge.dfg_value,
+             "dependency": edge.dependency_value}
+            for name, node in sorted(heuristics_net.nodes.items(), key=lambda item: str(item[0]))
+            for target, edges in node.output_connections.items()
+            for edge in edges
+        ],
+    }
+
+
+def petri_net_model(net, initial_marking, final_marking, activities: dict) -> dict:
+    """A petri net as JSON: its places (with their tokens in the initial and final markings), its transitions
+        (with the number of occurrences of their activity, the silent transitions have no label) and its arcs
+    """
+    places = [
+        {"id": place.name, "type": "place", "initial": initial_marking[place], "final": final_marking[place]}
+        for place in sorted(net.places, key=lambda place: place.name)
+    ]
+    transitions = [
+        {"id": transition.name, "type": "transition", "label": transition.label,
+         "frequency": activities.get(transition.label) if transition.label is not None else None}
+        for transition in sorted(net.transitions, key=lambda transition: transition.name)
+    ]
+    return {
+        "kind": "petri_net",
+        "nodes": places + transitions,
+        "arcs": sorted(({"source": arc.source.name, "target": arc.target.name, "weight": arc.weight}
+                        for arc in net.arcs), key=lambda arc: (arc["source"], arc["target"])),
+    }
+
+
+def discover_model(source: dict, output_dir: str, kind: str, algorithm: str, parameters: dict) -> str:
+    """Discover a model from a log and save it as JSON, run in a discovery process
+        The image of the model is not rendered, see render_model
+
+    Args:
+        source (dict): the log file or the log collection, as described in parsed_log_key
+        output_dir (str): directory receiving the model.json file
+        kind (str): one of MODEL_KINDS
+        algorithm (str): one of PETRI_NET_ALGORITHMS, for the petri nets
+        parameters (dict): parameters of the algorithm (or of the heuristic miner for the heuristics nets)
+
+    Returns:
+        str: path of the JSON file
+    """
+    abstraction = load_log_abstraction(source)
+    if kind == "dfg":
+        model = dfg_model(abstraction)
+    elif kind == "heuristics_net":
+        model = heuristics_net_model(discover_heuristics_net(abstraction, **parameters))
+    elif kind == "petri_net":
+        model = petri_net_model(*discover_petri_net(source, algorithm, parameters), abstraction.activities)
+        model["algorithm"] = algorithm
+    else:
+        raise ValueError(f"Unknown model kind {kind}")
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, "model.json")
+    with open(output_path, "w") as model_file:
+        json.dump(model, model_file, default=float)
+    return output_path
+
+
+def prune_arcs(model: dict, min_frequency: int = 0, max_arcs: int | None = None) -> dict:
+    """Drop the arcs of a model less frequent than min_frequency, then keep the max_arcs most frequent ones
+        The arcs without frequency (the arcs of a petri net) are kept
+    """
+    arcs = [arc for arc in model["arcs"] if arc.get("frequency") is None or arc["frequency"] >= min_frequency]
+    if max_arcs is not None:
+        weighted = sorted((arc for arc in arcs if arc.get("frequency") is not None),
+                          key=lambda arc: arc["frequency"], reverse=True)
+        arcs = [arc for arc in arcs if arc.get("frequency") is None] + weighted[:max_arcs]
+    return {**model, "arcs": arcs}
+
+
+def format_duration(seconds: float) -> str:
+    for unit, length in (("d", 86400), ("h", 3600), ("m", 60)):
+        if seconds >= length:
+            return f"{seconds / length:.1f}{unit}"
+    return f"{seconds:.0f}s"
+
+
+def model_graph(model: dict, performance: bool = False) -> graphviz.Digraph:
+    """Draw a model returned by discover_model with graphviz
+        The nodes are named by their index, the ids of a model (activities, urls...) may contain the ':' of ports
+
+    Args:
+        model (dict): the model
+        performance (bool): label the arcs of a DFG with the mean time between the activities instead of
+            their frequency
+    """
+    graph = graphviz.Digraph(graph_attr={"rankdir": "LR"}, node_attr={"fontsize": "12"})
+    names = {node["id"]: f"n{i}" for i, node in enumerate(model["nodes"])}
+    if model["kind"] == "petri_net":
+        for node in model["nodes"]:
+            if node["type"] == "place":
+                graph.node(names[node["id"]], label="•" if node["initial"] else "", shape="circle",
+                           style="filled", fillcolor="orange" if node["final"] else "white")
+            elif node["label"] is None:
+                graph.node(names[node["id"]], label="", shape="box", style="filled", fillcolor="black", width="0.2")
             else:
-                zip_file.write(file_path, os.path.basename(file_path))
-    return zip_file_path
\ No newline at end of file
+                label = node["label"] if node["frequency"] is None else f"{node['label']} ({node['frequency']})"
+                graph.node(names[node["id"]], label=label, shape="box")
+        for arc in model["arcs"]:
+            graph.edge(names[arc["source"]], names[arc["target"]],
+                       label=str(arc["weight"]) if arc["weight"] != 1 else None)
+        return graph
+
+    graph.node("start", label="", shape="circle", style="filled", fillcolor="green")
+    graph.node("end", label="", shape="circle", style="filled", fillcolor="orange")
+    for node in model["nodes"]:
+        graph.node(names[node["id"]], label=f"{node['label']} ({node['frequency']})", shape="box")
+        if node["start"]:
+            graph.edge("start", names[node["id"]], label=str(node["start"]))
+        if node["end"]:
+            graph.edge(names[node["id"]], "end", label=str(node["end"]))
+    max_frequency = max((arc["frequency"] for arc in model["arcs"]), default=1)
+    for arc in model["arcs"]:
+        if performance and "performance" in arc:
+            label = format_duration(arc["performance"]["mean"])
+        elif "dependency" in arc:
+            label = f"{arc['dependency']:.2f} ({arc['frequency']})"
+        else:
+            label = str(arc["frequency"])
+        graph.edge(names[arc["source"]], names[arc["target"]], label=label,
+                   penwidth=str(1 + 4 * arc["frequency"] / max_frequency))
+    return graph
+
+
+def model_render_path(model_dir: str, image_format: str, min_frequency: int, max_arcs: int | None,
+                      performance: bool) -> str:
+    return os.path.join(model_dir, f"render-{min_frequency}-{max_arcs}-{int(performance)}.{image_format}")
+
+
+def render_model(model_dir: str, image_format: str, min_frequency: int = 0, max_arcs: int | None = None,
+                 performance: bool = False) -> str:
+    """Render the image of a cached model, run in a discovery process
+        The image is saved along the model in the models cache, it is rendered once per format and pruning
+
+    Args:
+        model_dir (str): directory of the model in the models cache
+        image_format (str): one of MODEL_IMAGE_FORMATS
+        min_frequency, max_arcs: pruning of the arcs, see prune_arcs
+        performance (bool): label the arcs of a DFG with their performance
+
+    Returns:
+        str: path of the image
+    """
+    output_path = model_render_path(model_dir, image_format, min_frequency, max_arcs, performance)
+    if os.path.exists(output_path):
+        return output_path
+    with open(os.path.join(model_dir, "model.json")) as model_file:
+        model = json.load(model_file)
+    image = model_graph(prune_arcs(model, min_frequency, max_arcs), performance).pipe(format=image_format)
+    # Written aside then renamed, so a concurrent request never serves a partial image
+    fd, tmp_path = tempfile.mkstemp(dir=model_dir, suffix=".tmp")
+    with os.fdopen(fd, "wb") as tmp_file:
+        tmp_file.write(image)
+    os.replace(tmp_path, output_path)
+    return output_path
@@ -0,0 +1,379 @@
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from rapidfuzz.distance import Levenshtein
+from rapidfuzz.process import cdist
+from scipy import sparse
+
+from .utils import CACHE_DIR, private_directory
+
+# Directory of the distance matrices cache, and its size limit in bytes
+DISTANCE_CACHE_DIR = os.getenv("DISTANCE_CACHE_DIR", os.path.join(CACHE_DIR, "distance_matrices"))
+DISTANCE_CACHE_MAX_BYTES = int(os.getenv("DISTANCE_CACHE_MAX_BYTES", str(4 * 1024 * 1024 * 1024)))
+# Age in seconds after which the files of a distance matrix whose computation never finished are deleted
+DISTANCE_TMP_MAX_AGE = int(os.getenv("DISTANCE_TMP_MAX_AGE", str(24 * 3600)))
+# Maximum number of distinct items (variants or vectors) of a log clustered with its distance matrix:
+# the clustering holds the square matrix of the items, about 12 * n_items² bytes
+DISTANCE_MATRIX_MAX_ITEMS = int(os.getenv("DISTANCE_MATRIX_MAX_ITEMS", "15000"))
+# Maximum number of processes computing the distance matrices, for all the users
+DISTANCE_WORKERS = int(os.getenv("DISTANCE_WORKERS", str(os.cpu_count() or 1)))
+# Number of blocks of a distance matrix per worker, the blocks have the same number of distances
+DISTANCE_BLOCKS_PER_WORKER = 4
+# Distance measures of the clustering: edit distance between the variants, or distances between their vectors
+DISTANCE_MEASURES = ("levenshtein", "jaccard", "hamming", "cosine", "euclidean")
+# Vector representations of the traces of the feature based clustering (values of VectorRepresentation, lowered)
+VECTOR_REPRESENTATIONS = ("binary representation", "frequency representation", "relative frequency representation")
+# Directory of the action vocabularies of the collections
+VOCABULARY_DIR = os.path.join(DISTANCE_CACHE_DIR, "vocabularies")
+
+_distance_pool = None
+
+
+def read_cluster_log(file_path: str) -> pd.DataFrame:
+    """Read a log file of the clustering routes (client_id;action;timestamp csv file),
+        its events ordered by client then timestamp (the order of the file is kept for equal timestamps)
+    """
+    log = pd.read_csv(file_path, sep=";", dtype={"client_id": str, "action": str, "timestamp": str})
+    order = pd.to_datetime(log["timestamp"], format="mixed")
+    log = log.assign(order=order).sort_values(["client_id", "order"], kind="mergesort")
+    return log.drop(columns="order").reset_index(drop=True)
+
+
+def intern_actions(scope: str, actions) -> dict:
+    """Vocabulary of a collection: the id of each of its actions, cached on disk (a JSON list of the actions,
+        in the order of their ids)
+        New actions are appended, so the ids of the actions of a collection never change and the logs clustered
+        in the collection share their feature columns. Two concurrent requests may each append their actions:
+        the last one wins, which only changes the ids given to the next logs
+
+    Args:
+        scope (str): the collection
+        actions: actions of the log
+
+    Returns:
+        dict: id of each action of the vocabulary
+    """
+    path = os.path.join(VOCABULARY_DIR, hashlib.sha256(scope.encode()).hexdigest() + ".json")
+    try:
+        with open(path) as vocabulary_file:
+            vocabulary = {action: i for i, action in enumerate(json.load(vocabulary_file))}
+    except FileNotFoundError:
+        vocabulary = {}
+    new_actions = [action for action in actions if action not in vocabulary]
+    if new_actions:
+        for action in new_actions:
+            vocabulary[action] = len(vocabulary)
+        private_directory(os.path.dirname(VOCABULARY_DIR))
+        fd, tmp_path = tempfile.mkstemp(dir=private_directory(VOCABULARY_DIR), suffix=".tmp")
+        with os.fdopen(fd, "w") as tmp_file:
+            json.dump(list(vocabulary), tmp_file)
+        os.replace(tmp_path, path)
+    return vocabulary
+
+
+def trace_variants(clients: np.ndarray, actions: np.ndarray) -> tuple[list[tuple], np.ndarray, np.ndarray]:
+    """Group the traces (sequences of actions of a client) of a log by variant
+
+    Args:
+        clients (np.ndarray): client of each event, the events of a client are consecutive
+        actions (np.ndarray): id of the action of each event
+
+    Returns:
+        list[tuple]: the variants (tuples of action ids), ordered by their first trace
+        np.ndarray: number of traces of each variant
+        np.ndarray: variant of each event of the log
+    """
+    starts = np.flatnonzero(np.r_[True, clients[1:] != clients[:-1]])
+    actions = actions.tolist()
+    bounds = np.r_[starts, len(actions)]
+    traces = [tuple(actions[start:end]) for start, end in zip(bounds[:-1], bounds[1:])]
+
+    variant_ids = {}
+    trace_variant = np.fromiter((variant_ids.setdefault(trace, len(variant_ids)) for trace in traces),
+                                dtype=np.int64, count=len(traces))
+    counts = np.bincount(trace_variant, minlength=len(variant_ids))
+    return list(variant_ids), counts, np.repeat(trace_variant, np.diff(bounds))
+
+
+def vector_items(variants: list[tuple], counts: np.ndarray, representation: str, n_actions: int
+                 ) -> tuple[sparse.csr_matrix, np.ndarray, np.ndarray]:
+    """Group the variants by vector: variants with the same actions (binary representation), or the same
+        action counts (frequency), or the same action proportions (relative frequency) have the same vector
+        The vectors are the rows of a CSR matrix, its memory grows with the actions of each vector and not
+        with the size of the vocabulary
+
+    Args:
+        variants (list[tuple]): the variants, as tuples of action ids
+        counts (np.ndarray): number of traces of each variant
+        representation (str): one of VECTOR_REPRESENTATIONS
+        n_actions (int): size of the vocabulary (number of columns)
+
+    Returns:
+        sparse.csr_matrix: the distinct vectors
+        np.ndarray: number of traces of each vector
+        np.ndarray: vector of each variant
+    """
+    item_ids = {}
+    variant_item = np.empty(len(variants), dtype=np.int64)
+    for i, variant in enumerate(variants):
+        if representation == "binary representation":
+            item = tuple((action, 1.0) for action in sorted(set(variant)))
+        elif representation == "frequency representation":
+            item = tuple((action, float(count)) for action, count in sorted(Counter(variant).items()))
+        else:
+            item = tuple((action, count / len(variant)) for action, count in sorted(Counter(variant).items()))
+        variant_item[i] = item_ids.setdefault(item, len(item_ids))
+
+    indptr = np.r_[0, np.cumsum([len(item) for item in item_ids])]
+    entries = np.array([entry for item in item_ids for entry in item], dtype=np.float64).reshape(-1, 2)
+    vectors = sparse.csr_matrix((entries[:, 1].copy(), entries[:, 0].astype(np.int64), indptr),
+                                shape=(len(item_ids), n_actions))
+    return vectors, np.bincount(variant_item, weights=counts, minlength=len(item_ids)).astype(np.int64), \
+        variant_item
+
+
+def log_items(log: pd.DataFrame | str, representation: str | None = None, vocabulary: str | None = None
+              ) -> tuple[list[tuple] | sparse.csr_matrix, np.ndarray, np.ndarray]:
+    """Distinct items clustered in place of the traces of a log: its variants, or their distinct vectors
+
+    Args:
+        log: the log, or the path of its file, as read by read_cluster_log
+        representation (str): vector representation of the traces, None for the variants
+        vocabulary (str): collection whose interned vocabulary gives the ids of the actions,
+            None for ids local to the log
+
+    Returns:
+        the items: list of variants (tuples of action ids), or CSR matrix of the vectors
+        np.ndarray: number of traces of each item
+        np.ndarray: item of each event of the log
+    """
+    if isinstance(log, str):
+        log = read_cluster_log(log)
+    if vocabulary is None:
+        actions, names = pd.factorize(log["action"])
+        n_actions = len(names)
+    else:
+        ids = intern_actions(vocabulary, log["action"].unique())
+        actions = log["action"].map(ids).to_numpy()
+        n_actions = len(ids)
+    variants, counts, event_variant = trace_variants(log["client_id"].to_numpy(), actions)
+    if representation is None:
+        return variants, counts, event_variant
+    items, counts, variant_item = vector_items(variants, counts, representation, n_actions)
+    return items, counts, variant_item[event_variant]
+
+
+def condensed_size(n: int) -> int:
+    return n * (n - 1) // 2
+
+
+def row_offset(i: int, n: int) -> int:
+    """Position of the distance (i, i + 1) in a condensed matrix of n elements"""
+    return i * n - i * (i + 1) // 2
+
+
+def distance_matrix_key(log_hash: str, measure: str, settings=None) -> str:
+    """Key of a distance matrix in the cache: the log (its hash), the distance measure and its settings"""
+    return hashlib.sha256(json.dumps([log_hash, measure, settings], sort_keys=True).encode()).hexdigest()
+
+
+def remove_cache_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def evict_distance_matrices(max_bytes: int = DISTANCE_CACHE_MAX_BYTES, max_tmp_age: int = DISTANCE_TMP_MAX_AGE
+                            ) -> None:
+    """Delete the least recently used distance matrices until the cache fits in max_bytes
+        The files of the matrices being computed count in the size of the cache, the ones left by a computation
+        that never finished (older than max_tmp_age seconds) are deleted
+    """
+    now = time.time()
+    entries = []
+    total = 0
+    with os.scandir(DISTANCE_CACHE_DIR) as scan:
+        for entry in scan:
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            stat = entry.stat()
+            if entry.name.endswith((".tmp", ".tmp.items")) and now - stat.st_mtime > max_tmp_age:
+                remove_cache_file(entry.path)
+                continue
+            total += stat.st_size
+            if entry.name.endswith(".f32"):
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        remove_cache_file(path)
+        total -= size
+
+
+def load_distance_matrix(key: str, n: int) -> np.memmap | None:
+    """Map a cached condensed distance matrix of n variants in memory (read only), None if it is not cached"""
+    path = os.path.join(DISTANCE_CACHE_DIR, key + ".f32")
+    try:
+        if os.path.getsize(path) != condensed_size(n) * 4:
+            return None
+    except FileNotFoundError:
+        return None
+    # The modification time orders the entries for the eviction
+    os.utime(path)
+    if n < 2:
+        return np.zeros(0, dtype=np.float32)
+    return np.memmap(path, dtype=np.float32, mode="r")
+
+
+def variant_strings(variants: list[tuple]) -> list[str]:
+    """Map the actions to characters, so the edit distances of the variants are computed on strings"""
+    codes = {}
+    return ["".join(chr(codes.setdefault(action, len(codes))) for action in variant) for variant in variants]
+
+
+def value_patterns(vectors: sparse.csr_matrix) -> sparse.csr_matrix:
+    """Binary matrix of the (action, value) pairs of the vectors: the product of two rows counts the actions
+        the vectors share with the same value
+    """
+    pairs = np.unique(np.stack([vectors.indices, vectors.data]), axis=1, return_inverse=True)[1].ravel()
+    return sparse.csr_matrix((np.ones(len(pairs)), pairs, vectors.indptr), shape=(vectors.shape[0], pairs.max() + 1))
+
+
+def sparse_distances(vectors: sparse.csr_matrix, measure: str, rows, columns) -> np.ndarray:
+    """Distances between the vectors of rows and the vectors of columns (slices or arrays of indices), computed
+        from sparse products (as scipy computes them on the dense vectors, over the actions of the log)
+    """
+    if measure in ("cosine", "euclidean"):
+        row_vectors, column_vectors = vectors[rows], vectors[columns]
+        dots = (row_vectors @ column_vectors.T).toarray()
+        row_norms = np.asarray(row_vectors.multiply(row_vectors).sum(axis=1)).ravel()
+        column_norms = np.asarray(column_vectors.multiply(column_vectors).sum(axis=1)).ravel()
+        if measure == "cosine":
+            return np.clip(1 - dots / np.sqrt(np.outer(row_norms, column_norms)), 0, 2)
+        return np.sqrt(np.maximum(row_norms[:, None] + column_norms[None, :] - 2 * dots, 0))
+
+    presence = vectors.copy()
+    presence.data[:] = 1
+    shared = (presence[rows] @ presence[columns].T).toarray()
+    sizes = np.diff(vectors.indptr)
+    union = sizes[rows][:, None] + sizes[columns][None, :] - shared
+    if measure == "jaccard":
+        # On the actions of the vectors, whatever their values
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.nan_to_num((union - shared) / union)
+    patterns = value_patterns(vectors)
+    equal = (patterns[rows] @ patterns[columns].T).toarray()
+    # Hamming: share of the actions of the log on which the vectors differ
+    return (union - equal) / len(np.unique(vectors.indices))
+
+
+def distance_rows(items: list[tuple] | sparse.csr_matrix, measure: str, start: int, stop: int) -> np.ndarray:
+    """Condensed distances between the items start to stop and the items following each of them"""
+    if measure == "levenshtein":
+        strings = variant_strings(items)
+        block = cdist(strings[start:stop], strings[start + 1:], scorer=Levenshtein.distance, dtype=np.int32)
+    else:
+        block = sparse_distances(items, measure, slice(start, stop), slice(start + 1, None))
+    # Row i of the block starts at the item start + 1, its distances to the following items start at column i
+    return np.concatenate([block[row, row:] for row in range(stop - start)]).astype(np.float32)
+
+
+def write_items(items: list[tuple] | sparse.csr_matrix, items_file) -> None:
+    """Write the items of a log in a npz file read by the distance pool: data only, nothing is unpickled"""
+    if sparse.issparse(items):
+        sparse.save_npz(items_file, items, compressed=False)
+    else:
+        np.savez(items_file, actions=np.fromiter((action for item in items for action in item), dtype=np.int64),
+                 lengths=np.fromiter((len(item) for item in items), dtype=np.int64, count=len(items)))
+
+
+def read_items(items_path: str) -> list[tuple] | sparse.csr_matrix:
+    with np.load(items_path, allow_pickle=False) as data:
+        if "lengths" not in data:
+            return sparse.load_npz(items_path)
+        actions = data["actions"].tolist()
+        bounds = np.r_[0, np.cumsum(data["lengths"])].tolist()
+    return [tuple(actions[start:end]) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def distance_block(matrix_path: str, items_path: str, n: int, start: int, stop: int, measure: str) -> None:
+    """Compute the rows start to stop of a condensed distance matrix, in a process of the distance pool,
+        and write them in the memory mapped matrix (each process writes its own slice of the file)
+    """
+    items = read_items(items_path)
+    rows = np.memmap(matrix_path, dtype=np.float32, mode="r+", offset=row_offset(start, n) * 4,
+                     shape=(row_offset(stop, n) - row_offset(start, n),))
+    rows[:] = distance_rows(items, measure, start, stop)
+    rows.flush()
+
+
+def row_blocks(n: int, count: int) -> list[tuple[int, int]]:
+    """Split the rows of a condensed matrix of n items into at most count blocks with as many distances"""
+    if n < 2:
+        return []
+    offsets = row_offset(np.arange(n, dtype=np.int64), n)
+    targets = np.linspace(0, condensed_size(n), count + 1)[1:-1]
+    bounds = np.unique(np.r_[0, np.searchsorted(offsets, targets), n - 1])
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def get_distance_pool() -> ProcessPoolExecutor:
+    """Return the process pool computing the distance matrices, created on first use
+        The workers are forked from a clean server process and not from the API process
+    """
+    global _distance_pool
+    if _distance_pool is None:
+        _distance_pool = ProcessPoolExecutor(
+            max_workers=DISTANCE_WORKERS,
+            mp_context=multiprocessing.get_context("forkserver"),
+        )
+    return _distance_pool
+
+
+def distance_matrix_cached(key: str) -> bool:
+    return os.path.exists(os.path.join(DISTANCE_CACHE_DIR, key + ".f32"))
+
+
+async def compute_distance_matrix(key: str, items: list[tuple] | sparse.csr_matrix, measure: str) -> None:
+    """Compute the condensed distance matrix of the items of a log, stored as float32 in the cache
+        The matrix is split in blocks computed in parallel by the distance pool, each block is written in
+        the memory mapped file by its process: the matrix does not need to fit in memory while it is computed,
+        and only the distinct items are compared (n_items², not n_traces²). Clustering the items then expands it
+        into a square matrix, about 12 * n_items² bytes, see DISTANCE_MATRIX_MAX_ITEMS
+
+    Args:
+        key (str): key of the matrix, see distance_matrix_key
+        items: the variants (levenshtein) or the CSR matrix of the vectors, as returned by log_items
+        measure (str): one of DISTANCE_MEASURES
+    """
+    n = items.shape[0] if sparse.issparse(items) else len(items)
+    private_directory(DISTANCE_CACHE_DIR)
+    # Written aside then renamed, so a concurrent process never maps a partial matrix
+    fd, tmp_path = tempfile.mkstemp(dir=DISTANCE_CACHE_DIR, suffix=".tmp")
+    items_path = tmp_path + ".items"
+    try:
+        with os.fdopen(fd, "wb") as matrix_file:
+            matrix_file.truncate(condensed_size(n) * 4)
+        with open(items_path, "wb") as items_file:
+            write_items(items, items_file)
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(
+            loop.run_in_executor(get_distance_pool(), distance_block, tmp_path, items_path, n, start, stop, measure)
+            for start, stop in row_blocks(n, DISTANCE_WORKERS * DISTANCE_BLOCKS_PER_WORKER)
+        ))
+        os.replace(tmp_path, os.path.join(DISTANCE_CACHE_DIR, key + ".f32"))
+    finally:
+        for path in (tmp_path, items_path):
+            if os.path.exists(path):
+                os.remove(path)
+    evict_distance_matrices()
@@ -0,0 +1,114 @@
+from pymongo import ASCENDING, IndexModel
+
+from .database.config import database, user_collection
+from .utils import to_utc_datetime
+
+# The events of a log collection are stored in the collection "<name>_events"
+EVENTS_SUFFIX = "_events"
+# Number of events sent to MongoDB in one insert
+EVENTS_BATCH_SIZE = 10000
+
+EVENT_INDEXES = [
+    IndexModel([("client_id", ASCENDING), ("session_id", ASCENDING), ("position", ASCENDING)]),
+    IndexModel([("action", ASCENDING)]),
+    IndexModel([("tag", ASCENDING)]),
+    IndexModel([("time", ASCENDING)]),
+    IndexModel([("cluster_id", ASCENDING)]),
+]
+
+
+def events_collection_name(collection: str) -> str:
+    return collection + EVENTS_SUFFIX
+
+
+async def event_layout_enabled(username: str, collection: str) -> bool:
+    """Check if the event layout is maintained for a collection of a user"""
+    document = await user_collection.find_one(
+        {"username": username, "collections.name": collection},
+        {"collections.$": 1, "_id": 0})
+    return bool(document and document["collections"][0].get("event_layout"))
+
+
+async def get_events_collection(username: str, collection: str):
+    """Function to get the events collection of a log collection
+
+    Args:
+        username (str): owner of the collection
+        collection (str): name of the log collection
+
+    Returns:
+        collection_object: the events collection, None if the event layout is not enabled for the collection
+    """
+    if await event_layout_enabled(username, collection):
+        return database.get_collection(events_collection_name(collection))
+    return None
+
+
+def client_to_events(client: dict) -> list[dict]:
+    """Flatten a client document in one event per request
+        An event is identified by its (client_id, session_id, position): the session ids of a client are
+        unique, its sessions parsed from other files are numbered after the ones already known (renumber_sessions)
+
+    Args:
+        client (dict): client (encoded as json) with its sessions and requests
+
+    Returns:
+        list[dict]: the events of the client, in the order of its sessions and requests
+    """
+    events = []
+    for session in client.get("sessions") or []:
+        for position, request in enumerate(session.get("requests") or []):
+            events.append({
+                "client_id": client["client_id"],
+                "session_id": session.get("session_id"),
+                "position": position,
+                "action": request.get("request_url"),
+                "tag": request.get("request_tag"),
+                "time": to_utc_datetime(request.get("request_time")),
+                "cluster_id": request.get("cluster_id"),
+            })
+    return events
+
+
+async def insert_events(list_clients: list[dict], events_db) -> None:
+    """Add the events of a list of clients in the events collection"""
+    batch = []
+    for client in list_clients:
+        batch.extend(client_to_events(client))
+        if len(batch) >= EVENTS_BATCH_SIZE:
+            await events_db.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        await events_db.insert_many(batch, ordered=False)
+
+
+async def rebuild_events(collection_db, events_db) -> None:
+    """Rebuild the events collection from the client documents of a log collection"""
+    await events_db.drop()
+    await events_db.create_indexes(EVENT_INDEXES)
+    batch = []
+    async for client in collection_db.find({}, {"_id": 0}):
+        batch.append(client)
+        if len(batch) >= EVENTS_BATCH_SIZE:
+            await insert_events(batch, events_db)
+            batch = []
+    await insert_events(batch, events_db)
+
+
+async def maintain_events(username: str, collection: str, list_clients: list[dict] | None = None) -> None:
+    """Keep the events collection in line with the client documents, if the event layout is enabled
+
+    Args:
+        username (str): owner of the collection
+        collection (str): name of the log collection
+        list_clients (list[dict]): the sessions which were appended to the collection,
+            None if the collection was rewritten and the events have to be rebuilt
+    """
+    events_db = await get_events_collection(username, collection)
+    if events_db is None:
+        return
+    if list_clients is None:
+        await rebuild_events(database.get_collection(collection), events_db)
+    else:
+        await events_db.create_indexes(EVENT_INDEXES)
+        await insert_events(list_clients, events_db)
@@ -0,0 +1,159 @@
+import asyncio
+import inspect
+import multiprocessing
+import os
+import threading
+
+from fastapi import HTTPException, status
+
+# Maximum number of discovery processes running at the same time, for all the users
+DISCOVERY_WORKERS = int(os.getenv("DISCOVERY_WORKERS", "2"))
+# Maximum number of discovery processes running at the same time for one user
+DISCOVERY_USER_LIMIT = int(os.getenv("DISCOVERY_USER_LIMIT", "1"))
+# Time (in seconds) after which a discovery process is stopped
+DISCOVERY_TIMEOUT = float(os.getenv("DISCOVERY_TIMEOUT", "1800"))
+
+_context = multiprocessing.get_context("forkserver")
+# The processes are forked from a server which already imported the mining libraries
+_context.set_forkserver_preload(["pm4py", "discover.main"])
+
+
+def run_in_process(connection, function, args, kwargs, result_index, with_progress):
+    """Entry point of a discovery process: run the function and send its result through the pipe
+        The messages are ("progress", phase), then ("result", value) or ("error", exception)
+    """
+    try:
+        if with_progress:
+            kwargs = {**kwargs, "progress": lambda phase: connection.send(("progress", phase))}
+        result = function(*args, **kwargs)
+        if inspect.isawaitable(result):
+            result = asyncio.run(result)
+        if result_index is not None:
+            result = result[result_index]
+        connection.send(("result", result))
+    except BaseException as e:
+        try:
+            # Raised again in the API process, e.g. a FileNotFoundError answers 404
+            connection.send(("error", e))
+        except Exception:
+            # The exception is not picklable
+            connection.send(("error", RuntimeError(f"{type(e).__name__}: {e}")))
+    finally:
+        connection.close()
+
+
+class DiscoveryExecutor:
+    """Bounded pool of processes running the discovery algorithms out of the event loop
+        Each call runs in its own process (forked from the forkserver), so a call exceeding its timeout
+        or cancelled (e.g. its job is cancelled) is stopped by terminating its process
+    """
+
+    def __init__(self, max_workers: int, user_limit: int, timeout: float):
+        self.max_workers = max_workers
+        self.user_limit = user_limit
+        self.timeout = timeout
+        self.slots = None
+        # Semaphore and number of running or waiting calls of each user, dropped when the user has no call
+        self.user_slots = {}
+        self.user_calls = {}
+
+    async def run(self, username: str, function, *args, timeout: float | None = None,
+                  result_index: int | None = None, on_progress=None, wait: bool = False, **kwargs):
+        """Run a discovery function in a process of the pool
+
+        Args:
+            username (str): the user running the function, limited to user_limit calls at the same time
+            function: module level function (or coroutine function) to run
+            timeout (float): time limit of the call in seconds, DISCOVERY_TIMEOUT by default
+            result_index (int): only send back this element of the returned tuple
+                (the logs and models returned along the output files are not needed by the routes)
+            on_progress: called (or awaited) with the name of each phase reported by the function,
+                which then receives a `progress` keyword argument
+            wait (bool): wait for a call of the user to finish instead of answering 429
+                when the user already runs user_limit calls (the background jobs wait)
+
+        Returns:
+            the result of the function
+        """
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_workers)
+        user_slots = self.user_slots.get(username)
+        if user_slots is None:
+            user_slots = self.user_slots[username] = asyncio.Semaphore(self.user_limit)
+        if not wait and user_slots.locked():
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many discoveries running for this user, please wait for them to finish",
+            )
+
+        self.user_calls[username] = self.user_calls.get(username, 0) + 1
+        try:
+            async with user_slots, self.slots:
+                return await asyncio.wait_for(
+                    self.run_process(function, args, kwargs, result_index, on_progress),
+                    timeout or self.timeout,
+                )
+        except asyncio.TimeoutError:
+            raise HTTPException(
+                status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                detail="The discovery took too much time and has been stopped",
+            )
+        finally:
+            self.user_calls[username] -= 1
+            if not self.user_calls[username]:
+                del self.user_calls[username]
+                del self.user_slots[username]
+
+    async def run_process(self, function, args, kwargs, result_index, on_progress):
+        loop = asyncio.get_running_loop()
+        receiver, sender = _context.Pipe(duplex=False)
+        process = _context.Process(
+            target=run_in_process,
+            args=(sender, function, args, kwargs, result_index, on_progress is not None),
+            daemon=True,
+        )
+        process.start()
+        sender.close()
+
+        messages = asyncio.Queue()
+
+        def read_messages():
+            # The messages are read (and unpickled) in a thread, a large result (e.g. a model or the cluster logs)
+            # does not block the event loop while it is received
+            while True:
+                try:
+                    message = receiver.recv()
+                except (EOFError, OSError):
+                    message = ("error", RuntimeError("The discovery process stopped unexpectedly"))
+                loop.call_soon_threadsafe(messages.put_nowait, message)
+                if message[0] != "progress":
+                    return
+
+        # A thread of its own: a discovery can run for hours, it would hold a thread of the default executor
+        reader = threading.Thread(target=read_messages, daemon=True)
+        reader.start()
+        try:
+            while True:
+                kind, value = await messages.get()
+                if kind == "progress":
+                    result = on_progress(value)
+                    if inspect.isawaitable(result):
+                        await result
+                elif kind == "result":
+                    return value
+                else:
+                    raise value
+        finally:
+            # Stop the process if the call was cancelled or timed out, the reader then gets the end of the pipe
+            if process.is_alive():
+                process.terminate()
+            await loop.run_in_executor(None, process.join)
+            await loop.run_in_executor(None, reader.join)
+            receiver.close()
+
+
+discovery_executor = DiscoveryExecutor(DISCOVERY_WORKERS, DISCOVERY_USER_LIMIT, DISCOVERY_TIMEOUT)
+
+
+async def run_discovery(username: str, function, *args, **kwargs):
+    return await discovery_executor.run(username, function, *args, **kwargs)
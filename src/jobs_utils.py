@@ -0,0 +1,457 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import pandas as pd
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from parser.main import parser, csv_parser
+from parser.models.client import Client_Model
+from parser.models.csv_parameters import CsvParameters
+from parser.models.parameters import Parameters
+
+from .cache_utils import bump_generation
+from .client_utils import merge_clients, post_clients_in_collection, upsert_clients_in_collection
+from .collection_utils import purge_collection
+from .database.config import database, discovery_job_collection, job_collection, user_collection
+from .discover_utils import (DISCOVERY_RESULT_FILES, get_cached_model, model_cache_key, parsed_log_key,
+                             run_quality_pipeline, store_cached_model)
+from .events_utils import maintain_events
+from .executor_utils import run_discovery
+from .models.jobs import Discovery_Job_Model, Ingestion_Job_Model, JobStatus
+from .workspace_utils import hold_scratch_file, release_scratch_file
+
+# Maximum number of log files parsed at the same time, for all the users
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", "2"))
+# Directory keeping the models and the quality of the discovery jobs
+DISCOVERY_RESULTS_DIR = os.getenv("DISCOVERY_RESULTS_DIR", os.path.join(tempfile.gettempdir(), "discovery_jobs"))
+# Time (in seconds) after which a discovery job is stopped, the conformance checking can run for hours
+DISCOVERY_JOB_TIMEOUT = float(os.getenv("DISCOVERY_JOB_TIMEOUT", str(6 * 3600)))
+# Time (in seconds) the files of a finished discovery job are kept, the janitor deletes them afterwards
+DISCOVERY_RESULTS_MAX_AGE = int(os.getenv("DISCOVERY_RESULTS_MAX_AGE", str(7 * 24 * 3600)))
+
+logger = logging.getLogger(__name__)
+
+_ingestion_pool = None
+# Keep a reference on the running jobs, asyncio only keeps weak references on its tasks
+_running_jobs = set()
+# Running discovery jobs by job_id, to cancel them
+_discovery_tasks = {}
+# Lock of each collection, its ingestion jobs write one at a time
+_collection_locks = {}
+
+
+def get_ingestion_pool() -> ProcessPoolExecutor:
+    """Return the process pool parsing the log files, created on first use
+        The workers are forked from a clean server process and not from the API process
+        which holds the event loop and the MongoDB client threads
+    """
+    global _ingestion_pool
+    if _ingestion_pool is None:
+        _ingestion_pool = ProcessPoolExecutor(
+            max_workers=INGESTION_WORKERS,
+            mp_context=multiprocessing.get_context("forkserver"),
+        )
+    return _ingestion_pool
+
+
+def collection_lock(collection: str) -> asyncio.Lock:
+    """Lock held by an ingestion job while it writes in a collection: the new sessions of a client are numbered
+        after its stored ones, and a full rewrite reads the whole collection
+    """
+    return _collection_locks.setdefault(collection, asyncio.Lock())
+
+
+def parse_log_file(file_path: str, parameters: dict, clients: list[dict]) -> list[dict]:
+    """Parse a web server log file, run in a worker process
+
+    Args:
+        file_path (str): path of the log file
+        parameters (dict): Parameters of the log parser
+        clients (list[dict]): clients already known, their sessions can be extended by the file
+
+    Returns:
+        list[dict]: the clients (encoded as json) found in the file
+    """
+    list_client = [Client_Model(**client) for client in clients]
+    list_client = asyncio.run(
+        parser(file=file_path, collection=list_client, parameters=Parameters(**parameters))  # type: ignore
+    )
+    return jsonable_encoder(list_client)
+
+
+def parse_csv_file(file_path: str, parameters: dict, clients: list[dict]) -> list[dict]:
+    """Validate and parse a csv log file, run in a worker process
+
+    Args:
+        file_path (str): path of the csv file
+        parameters (dict): CsvParameters of the csv parser
+        clients (list[dict]): clients already known, their sessions can be extended by the file
+
+    Returns:
+        list[dict]: the clients (encoded as json) found in the file
+    """
+    try:
+        # Read only the timestamp column of the CSV file
+        df = pd.read_csv(file_path, sep=parameters["separator"], usecols=[parameters["timestamp_column"]])
+        # Validate the date format
+        pd.to_datetime(df[parameters["timestamp_column"]], format=parameters["timestamp_format"])
+    except ValueError:
+        raise ValueError("Date format or column name error")
+    except Exception as e:
+        raise ValueError(f"Error reading CSV file, wrong separator. {e}")
+
+    list_client = [Client_Model(**client) for client in clients]
+    list_client = csv_parser(
+        file=file_path, collection=list_client, parameters=CsvParameters(**parameters)  # type: ignore
+    )
+    return jsonable_encoder(list_client)
+
+
+async def create_ingestion_job(
+        username: str, collection: str, files: list[tuple[str, str, str]], files_already_in_collection: list[str]
+) -> Ingestion_Job_Model:
+    """Register a new ingestion job in the database
+
+    Args:
+        username (str): owner of the job
+        collection (str): name of the collection receiving the clients
+        files (list[tuple[str, str, str]]): (name, path, hash) of each file to parse
+        files_already_in_collection (list[str]): names of the files skipped because already parsed
+
+    Returns:
+        Ingestion_Job_Model: the job created
+    """
+    job = Ingestion_Job_Model(
+        job_id=uuid.uuid4().hex,
+        username=username,
+        collection=collection,
+        created_at=datetime.strftime(datetime.now(), "%d/%m/%Y %H:%M:%S"),
+        files=[name for name, _, _ in files],
+        files_already_in_collection=files_already_in_collection,
+        bytes_total=sum(os.path.getsize(path) for _, path, _ in files),
+    )
+    await job_collection.insert_one(jsonable_encoder(job))
+    return job
+
+
+async def get_ingestion_job(username: str, job_id: str) -> dict | None:
+    return await job_collection.find_one({"job_id": job_id, "username": username}, {"_id": 0})
+
+
+async def add_files_to_collection(job: Ingestion_Job_Model, files: list[tuple[str, str, str]],
+                                  collection_fields: dict | None = None) -> None:
+    """Save the hashes of the files added to the collection, so they are not parsed twice"""
+    await user_collection.update_one(
+        {"username": job.username, "collections.name": job.collection},
+        {
+            "$push": {"collections.$.files_hash": {"$each": [file_hash for _, _, file_hash in files]}},
+            "$set": {"collections.$.file_name": files[-1][0],
+                     **{f"collections.$.{key}": value for key, value in (collection_fields or {}).items()}},
+        },
+        upsert=False
+    )
+
+
+async def ingest_files_batch(job: Ingestion_Job_Model, files: list[tuple[str, str, str]],
+                             parse_function, parameters: dict, collection_fields: dict | None = None) -> int:
+    """Parse all the files of a job in parallel and merge their clients in the collection with one bulk write
+
+    Returns:
+        int: number of files added to the collection
+    """
+    collection_db = database.get_collection(job.collection)
+    loop = asyncio.get_running_loop()
+
+    async def parse(filename, file_path):
+        file_size = os.path.getsize(file_path)
+        try:
+            return await loop.run_in_executor(get_ingestion_pool(), parse_function, file_path, parameters, [])
+        except Exception as e:
+            await job_collection.update_one({"job_id": job.job_id}, {"$push": {"errors": f"{filename}: {e}"}})
+            return None
+        finally:
+            await job_collection.update_one({"job_id": job.job_id}, {"$inc": {"bytes_processed": file_size}})
+
+    results = await asyncio.gather(*[parse(filename, file_path) for filename, file_path, _ in files])
+    parsed_files = [file for file, list_client in zip(files, results) if list_client is not None]
+    if not parsed_files:
+        return 0
+
+    # Merge the clients of all the files in memory, then write them at once
+    list_client = merge_clients([list_client for list_client in results if list_client is not None])
+    async with collection_lock(job.collection):
+        try:
+            clients_created = await upsert_clients_in_collection(list_client, collection_db)
+        except Exception as e:
+            await job_collection.update_one({"job_id": job.job_id}, {"$push": {"errors": f"Database: {e}"}})
+            return 0
+
+        try:
+            # The clients are in the collection: the hashes of the files are saved first, so a retry of the same
+            # upload is skipped instead of adding their requests twice
+            await add_files_to_collection(job, parsed_files, collection_fields)
+            await job_collection.update_one(
+                {"job_id": job.job_id},
+                {
+                    "$push": {"files_added": {"$each": [filename for filename, _, _ in parsed_files]}},
+                    "$inc": {"clients_created": clients_created},
+                },
+            )
+            await bump_generation(job.collection)
+            # The sessions were renumbered by the upsert, their events get the same session ids
+            await maintain_events(job.username, job.collection, list_client)
+        except Exception as e:
+            await job_collection.update_one({"job_id": job.job_id}, {"$push": {"errors": f"Database: {e}"}})
+    return len(parsed_files)
+
+
+async def ingest_files_sequential(job: Ingestion_Job_Model, files: list[tuple[str, str, str]],
+                                  parse_function, parameters: dict, collection_fields: dict | None = None) -> int:
+    """Parse the files of a job one after another against the whole collection, then rewrite the collection
+        This lets the parser extend the stored sessions, at the cost of a full rewrite per file
+
+    Returns:
+        int: number of files added to the collection
+    """
+    collection_db = database.get_collection(job.collection)
+    loop = asyncio.get_running_loop()
+
+    files_added = 0
+    for filename, file_path, file_hash in files:
+        file_size = os.path.getsize(file_path)
+        try:
+            async with collection_lock(job.collection):
+                clients = [doc async for doc in collection_db.find({}, {"_id": 0})]
+                list_client = await loop.run_in_executor(
+                    get_ingestion_pool(), parse_function, file_path, parameters, clients
+                )
+                # Remove the old clients from the collection
+                await purge_collection(collection_db)
+                # Add the client (old and new) to the collection
+                if list_client:
+                    await post_clients_in_collection(list_client, collection_db)  # type: ignore
+                await maintain_events(job.username, job.collection)
+                await bump_generation(job.collection)
+
+            await add_files_to_collection(job, [(filename, file_path, file_hash)], collection_fields)
+            files_added += 1
+            await job_collection.update_one(
+                {"job_id": job.job_id},
+                {
+                    "$push": {"files_added": filename},
+                    "$inc": {"bytes_processed": file_size, "clients_created": len(list_client) - len(clients)},
+                },
+            )
+        except Exception as e:
+            await job_collection.update_one(
+                {"job_id": job.job_id},
+                {"$push": {"errors": f"{filename}: {e}"}, "$inc": {"bytes_processed": file_size}},
+            )
+    return files_added
+
+
+async def run_ingestion_job(
+        job: Ingestion_Job_Model,
+        files: list[tuple[str, str, str]],
+        parse_function,
+        parameters: dict,
+        incremental: bool = True,
+        collection_fields: dict | None = None,
+) -> None:
+    """Parse the files of a job in the process pool and save the clients in the collection
+        The progress (bytes processed, clients created, errors) is saved in the job document
+
+    Args:
+        job (Ingestion_Job_Model): the job to run
+        files (list[tuple[str, str, str]]): (name, path, hash) of each file to parse
+        parse_function: parse_log_file or parse_csv_file
+        parameters (dict): parameters of the parser
+        incremental (bool): parse the files in parallel and only upsert their clients,
+            instead of parsing them one by one against the whole collection
+        collection_fields (dict): extra fields to set on the user's collection once a file is added
+    """
+    files_added = 0
+    update = {}
+    try:
+        await job_collection.update_one({"job_id": job.job_id}, {"$set": {"status": JobStatus.running.value}})
+        if incremental:
+            files_added = await ingest_files_batch(job, files, parse_function, parameters, collection_fields)
+        else:
+            files_added = await ingest_files_sequential(job, files, parse_function, parameters, collection_fields)
+    except Exception as e:
+        update["$push"] = {"errors": f"Job: {e}"}
+    finally:
+        for _, file_path, _ in files:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            release_scratch_file(file_path)
+        # The job always ends done or failed, it never stays running
+        update["$set"] = {
+            "status": (JobStatus.done if files_added else JobStatus.failed).value,
+            "finished_at": datetime.strftime(datetime.now(), "%d/%m/%Y %H:%M:%S"),
+        }
+        try:
+            await job_collection.update_one({"job_id": job.job_id}, update)
+        except Exception as e:
+            logger.error(f"Ingestion job {job.job_id}: its status could not be saved: {e}")
+
+
+def start_ingestion_job(job: Ingestion_Job_Model, files: list[tuple[str, str, str]], *args, **kwargs) -> None:
+    """Run an ingestion job in the background of the event loop, its files are kept from the janitor
+        until the job removes them"""
+    for _, file_path, _ in files:
+        hold_scratch_file(file_path)
+    task = asyncio.create_task(run_ingestion_job(job, files, *args, **kwargs))
+    _running_jobs.add(task)
+    task.add_done_callback(_running_jobs.discard)
+
+
+def discovery_job_dir(job_id: str) -> str:
+    return os.path.join(DISCOVERY_RESULTS_DIR, job_id)
+
+
+async def create_discovery_job(username: str, algorithm: str, parameters: dict, fitness_approach: str,
+                               precision_approach: str, collection: str | None = None,
+                               sampling: dict | None = None) -> Discovery_Job_Model:
+    """Register a new discovery job in the database
+
+    Args:
+        username (str): owner of the job
+        algorithm (str): discovery algorithm, one of PETRI_NET_ALGORITHMS
+        parameters (dict): parameters of the algorithm
+        fitness_approach, precision_approach (str): values of Quality_Type
+        collection (str): the log collection mined, None when the log is an uploaded file
+        sampling (dict): settings of the approximate quality, None for the exact quality
+
+    Returns:
+        Discovery_Job_Model: the job created
+    """
+    job = Discovery_Job_Model(
+        job_id=uuid.uuid4().hex,
+        username=username,
+        algorithm=algorithm,
+        parameters=parameters,
+        fitness_approach=fitness_approach,
+        precision_approach=precision_approach,
+        collection=collection,
+        sampling=sampling,
+        created_at=datetime.utcnow(),
+    )
+    os.makedirs(discovery_job_dir(job.job_id), exist_ok=True)
+    await discovery_job_collection.insert_one(job.dict())
+    return job
+
+
+async def get_discovery_job(username: str, job_id: str) -> dict | None:
+    """Get a discovery job of a user, with the time elapsed since it started"""
+    job = await discovery_job_collection.find_one({"job_id": job_id, "username": username}, {"_id": 0})
+    if job and job.get("started_at"):
+        job["elapsed_seconds"] = ((job.get("finished_at") or datetime.utcnow()) - job["started_at"]).total_seconds()
+    return job
+
+
+async def run_discovery_job(job: Discovery_Job_Model, source: dict) -> None:
+    """Discover the model of a job in the discovery executor, measure its quality and keep the results
+        The phase of the job (read, mine, fitness, precision or sample, render) is saved in the job document.
+        A model already discovered from the same log with the same settings is taken from the models cache
+
+    Args:
+        job (Discovery_Job_Model): the job to run
+        source (dict): the log file (removed once the job is finished) or the log collection,
+            as described in parsed_log_key
+    """
+    async def save_phase(phase: str):
+        now = datetime.utcnow()
+        update = {"$set": {"phase": phase}, "$push": {"phases": {"phase": phase, "started_at": now}}}
+        if phase == "read":
+            update["$set"].update({"status": JobStatus.running.value, "started_at": now})
+        await discovery_job_collection.update_one({"job_id": job.job_id}, update)
+
+    job_dir = discovery_job_dir(job.job_id)
+    cache_key = model_cache_key(parsed_log_key(source), job.algorithm, job.parameters,
+                                job.fitness_approach, job.precision_approach, job.sampling)
+    result = {}
+    try:
+        cached_path = get_cached_model(cache_key)
+        if cached_path:
+            # The same model was already discovered from the same log, its files are copied in the job
+            for filename in DISCOVERY_RESULT_FILES:
+                shutil.copy(os.path.join(cached_path, filename), job_dir)
+            with open(os.path.join(job_dir, "quality.json")) as quality_file:
+                result["quality"] = json.load(quality_file)
+            result.update({"cached": True, "started_at": datetime.utcnow()})
+        else:
+            result["quality"] = await run_discovery(
+                job.username, run_quality_pipeline, source, job_dir, job.algorithm,
+                job.parameters, job.fitness_approach, job.precision_approach, job.sampling,
+                timeout=DISCOVERY_JOB_TIMEOUT, on_progress=save_phase, wait=True,
+            )
+            store_cached_model(cache_key, [os.path.join(job_dir, filename) for filename in DISCOVERY_RESULT_FILES])
+        result["files"] = list(DISCOVERY_RESULT_FILES)
+        result["status"] = JobStatus.done.value
+    except asyncio.CancelledError:
+        result["status"] = JobStatus.cancelled.value
+        raise
+    except HTTPException as e:
+        result.update({"status": JobStatus.failed.value, "error": e.detail})
+    except Exception as e:
+        result.update({"status": JobStatus.failed.value, "error": str(e)})
+    finally:
+        if "file_path" in source and os.path.exists(source["file_path"]):
+            os.remove(source["file_path"])
+        await discovery_job_collection.update_one(
+            {"job_id": job.job_id},
+            {"$set": {**result, "phase": None, "finished_at": datetime.utcnow()}},
+        )
+
+
+def start_discovery_job(job: Discovery_Job_Model, *args, **kwargs) -> None:
+    """Run a discovery job in the background of the event loop, it goes on if the client disconnects"""
+    task = asyncio.create_task(run_discovery_job(job, *args, **kwargs))
+    _discovery_tasks[job.job_id] = task
+    task.add_done_callback(lambda _: _discovery_tasks.pop(job.job_id, None))
+
+
+async def cancel_discovery_job(job_id: str) -> None:
+    """Stop a discovery job if it is running (its process is terminated) and delete its files"""
+    task = _discovery_tasks.get(job_id)
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    else:
+        # The job is not running in this API process anymore (e.g. the API restarted)
+        await discovery_job_collection.update_one(
+            {"job_id": job_id, "status": {"$in": [JobStatus.pending.value, JobStatus.running.value]}},
+            {"$set": {"status": JobStatus.cancelled.value, "phase": None, "finished_at": datetime.utcnow()}},
+        )
+    shutil.rmtree(discovery_job_dir(job_id), ignore_errors=True)
+    await discovery_job_collection.update_one({"job_id": job_id}, {"$set": {"files": []}})
+
+
+async def expire_discovery_jobs() -> None:
+    """Delete the files of the discovery jobs finished for more than DISCOVERY_RESULTS_MAX_AGE seconds,
+        and the directories of the jobs unknown to the database (e.g. created before a crash)"""
+    finished_before = datetime.utcnow() - timedelta(seconds=DISCOVERY_RESULTS_MAX_AGE)
+    async for job in discovery_job_collection.find(
+            {"finished_at": {"$lt": finished_before}, "files": {"$ne": []}}, {"job_id": 1}):
+        shutil.rmtree(discovery_job_dir(job["job_id"]), ignore_errors=True)
+        await discovery_job_collection.update_one({"job_id": job["job_id"]}, {"$set": {"files": []}})
+
+    if os.path.isdir(DISCOVERY_RESULTS_DIR):
+        job_ids = set(os.listdir(DISCOVERY_RESULTS_DIR)) - set(_discovery_tasks)
+        known = {job["job_id"] async for job in discovery_job_collection.find(
+            {"job_id": {"$in": list(job_ids)}, "files": {"$ne": []}}, {"job_id": 1})}
+        for job_id in job_ids - known:
+            path = discovery_job_dir(job_id)
+            # A job just created is in the database before its first file is written
+            if os.path.getmtime(path) < time.time() - DISCOVERY_RESULTS_MAX_AGE:
+                shutil.rmtree(path, ignore_errors=True)
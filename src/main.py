@@ -1,7 +1,9 @@
 from fastapi import Depends, FastAPI
 
-from src.routers import client, collection, files, request, stats, tags, token, users, discover, clustering, session
+from src.routers import client, collection, files, request, stats, tags, token, users, discover, clustering, session, jobs
+from src.jobs_utils import expire_discovery_jobs
 from src.security import oauth2_scheme
+from src.workspace_utils import start_janitor
 from fastapi.middleware.cors import CORSMiddleware
 
 
@@ -24,10 +26,18 @@ app.add_middleware(
 
 oauth2_scheme = Depends(oauth2_scheme)
 
+
+# Delete the scratch files left behind and the expired results of the discovery jobs in the background
+@app.on_event("startup")
+async def start_scratch_janitor():
+    start_janitor(expire_discovery_jobs)
+
+
 app.include_router(token.router)
 app.include_router(users.router)
 app.include_router(collection.router)
 app.include_router(files.router)
+app.include_router(jobs.router)
 app.include_router(tags.router)
 app.include_router(client.router)
 app.include_router(request.router)
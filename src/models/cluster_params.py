@@ -9,6 +9,12 @@ class ClusteringMethod(str, Enum):
     DBSCAN = "DBSCAN"
 
 
+class ScalableClusteringMethod(str, Enum):
+    MiniBatchKMeans = "MiniBatchKMeans"
+    Birch = "Birch"
+    DBSCAN = "DBSCAN"
+
+
 class ClusteringMethodFss(str, Enum):
     Agglomerative = "Agglomerative"
     DBSCAN = "DBSCAN"
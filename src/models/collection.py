@@ -7,6 +7,7 @@ class Collection_Base_Model(Base_model):
     name: str
     description: str | None = None
     log_collection: bool | None = None
+    event_layout: bool | None = None
 
 
 class Collection_Model(Collection_Base_Model):
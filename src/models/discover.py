@@ -7,8 +7,29 @@ class MiningResult(Base_model):
     Precision: float
     Generalization: float
     Simplicity: float
+    # Confidence intervals and sample size of the approximate quality
+    Approximation: dict | None = None
 
 
 class Quality_Type(str, Enum):
     token = "Token based"
     align = "Alignement"
+
+
+class Discovery_Algorithm(str, Enum):
+    alpha = "alpha"
+    alpha_plus = "alpha_plus"
+    heuristic = "heuristic"
+    inductive = "inductive"
+    dfg = "dfg"
+
+
+class Model_Kind(str, Enum):
+    dfg = "dfg"
+    heuristics_net = "heuristics_net"
+    petri_net = "petri_net"
+
+
+class Image_Format(str, Enum):
+    svg = "svg"
+    png = "png"
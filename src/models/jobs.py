@@ -0,0 +1,55 @@
+from datetime import datetime
+from enum import Enum
+
+from ..base import Base_model
+
+
+class JobStatus(str, Enum):
+    pending = "pending"
+    running = "running"
+    done = "done"
+    failed = "failed"
+    cancelled = "cancelled"
+
+
+class Ingestion_Job_Model(Base_model):
+    job_id: str
+    username: str
+    collection: str
+    status: JobStatus = JobStatus.pending
+    created_at: str | None = None
+    finished_at: str | None = None
+    files: list[str] = []
+    files_added: list[str] = []
+    files_already_in_collection: list[str] = []
+    bytes_total: int = 0
+    bytes_processed: int = 0
+    clients_created: int = 0
+    errors: list[str] = []
+
+
+class Discovery_Phase_Model(Base_model):
+    phase: str
+    started_at: datetime
+
+
+class Discovery_Job_Model(Base_model):
+    job_id: str
+    username: str
+    algorithm: str
+    parameters: dict = {}
+    fitness_approach: str
+    precision_approach: str
+    collection: str | None = None
+    sampling: dict | None = None
+    status: JobStatus = JobStatus.pending
+    phase: str | None = None
+    phases: list[Discovery_Phase_Model] = []
+    created_at: datetime | None = None
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+    elapsed_seconds: float | None = None
+    quality: dict | None = None
+    files: list[str] = []
+    cached: bool = False
+    error: str | None = None
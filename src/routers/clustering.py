@@ -1,19 +1,29 @@
+import asyncio
 import csv
-import io
-import os
 import tempfile
 import zipfile
 from fastapi import APIRouter, Body, Depends, File, HTTPException, Query, Request, status, UploadFile, Response
 from fastapi.responses import FileResponse
 from typing import Annotated
+import numpy as np
 from ..collection_utils import collection_exists
 from ..models.cluster_params import ClusteringMethod, ClusteringParams, DistanceMeasure, LinkageCriteria, VectorRepresentation
+from ..models.cluster_params import ScalableClusteringMethod
 from ..models.cluster_params import ClusteringMethodFss, FssClusteringParams, FssDistanceMeasure
 from ..models.users import User_Model
 from ..security import get_current_active_user
-from clustering.main import (feature_based_clustering, fss_euclidean_distance, fss_meanshift,
-                             trace_based_clustering, vector_based_clustering)
+from clustering.main import feature_based_clustering, fss_euclidean_distance, fss_meanshift
 from src.clustering_utils import empty_directory, post_clusters, fetch_documents, create_csv_files, create_zip_file, create_csv_file
+from src.clustering_utils import create_csv_file_from_events, create_csv_files_from_events
+from src.distance_utils import DISTANCE_MATRIX_MAX_ITEMS, compute_distance_matrix, distance_matrix_cached, distance_matrix_key
+from src.distance_utils import log_items
+from src.events_utils import get_events_collection
+from src.executor_utils import run_discovery
+from src.utils import save_upload_file
+from src.variant_clustering_utils import CENTROID_DISTANCES, CLUSTERING_SWEEP_MAX_SETTINGS, CLUSTERING_SWEEP_WORKERS
+from src.variant_clustering_utils import SCORES_SAMPLE_SIZE
+from src.variant_clustering_utils import cluster_log, cluster_log_scalable, sweep_group, sweep_groups
+from src.workspace_utils import Workspace, request_workspace
 
 
 
@@ -23,13 +33,89 @@ router = APIRouter(
 )
 
 
+def check_clustering_params(algorithm: ClusteringMethod | ScalableClusteringMethod, params: ClusteringParams) -> None:
+    """Check that the parameters of the clustering algorithm are given, and valid"""
+    if algorithm.value == "DBSCAN" and (params.epsilon is None or params.min_samples is None):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="DBSCAN needs the epsilon and min_samples parameters")
+    if algorithm.value in ("Agglomerative", "MiniBatchKMeans") and not params.nbr_clusters:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"{algorithm.value} clustering needs the nbr_clusters parameter")
+    if algorithm.value in ("MiniBatchKMeans", "Birch") and params.distance not in CENTROID_DISTANCES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"{algorithm.value} clusters the vectors with the Euclidean or Cosine distance")
+    if params.epsilon is not None and params.epsilon <= 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="epsilon must be positive")
+    if params.min_samples is not None and params.min_samples < 1:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="min_samples must be at least 1")
+    if params.nbr_clusters is not None and params.nbr_clusters < 1:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="nbr_clusters must be at least 1")
+
+
+async def upload_distance_matrix(username: str, scratch: Workspace, file: UploadFile, measure: str,
+                                 representation: str | None = None, vocabulary: str | None = None
+                                 ) -> tuple[str, str, np.ndarray | None]:
+    """Save an uploaded log in the workspace and compute the distance matrix of its items if it is not cached
+        The log is hashed while it is saved, its distance matrix is cached under this hash: it is computed
+        once (in parallel by the distance pool) and clustering the same log again only reruns the clustering.
+        The logs with more than DISTANCE_MATRIX_MAX_ITEMS distinct items are refused
+
+    Args:
+        username (str): the user running the clustering
+        scratch (Workspace): workspace of the request
+        file (UploadFile): the log file (client_id;action;timestamp csv file)
+        measure (str): levenshtein, or the distance between the vectors of the traces
+        representation (str): vector representation of the traces, None for the trace based clustering
+        vocabulary (str): collection whose interned vocabulary gives the ids of the actions
+
+    Returns:
+        str: path of the log in the workspace
+        str: key of its distance matrix
+        np.ndarray: number of traces of each item of the log, None when the matrix was cached
+    """
+    file_path = scratch.file("log.csv")
+    log_hash = await save_upload_file(file, file_path)
+    matrix_key = distance_matrix_key(log_hash, measure, representation)
+    counts = None
+    if not distance_matrix_cached(matrix_key):
+        items, counts, _ = await run_discovery(username, log_items, file_path, representation, vocabulary)
+        if len(counts) > DISTANCE_MATRIX_MAX_ITEMS:
+            detail = f"The log has {len(counts)} distinct items, at most {DISTANCE_MATRIX_MAX_ITEMS} are clustered " \
+                     f"with their distance matrix"
+            if representation is not None:
+                detail += ", the large logs are clustered by /clustering/feature_based/scalable"
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=detail)
+        await compute_distance_matrix(matrix_key, items, measure)
+    return file_path, matrix_key, counts
+
+
+async def cluster_uploaded_log(username: str, scratch: Workspace, file: UploadFile, algorithm: ClusteringMethod,
+                               params: ClusteringParams, measure: str,
+                               representation: str | None = None) -> tuple[dict, list[str]]:
+    """Cluster the traces of an uploaded log with its cached distance matrix,
+        its cluster logs are written in the workspace
+
+    Returns:
+        dict: the scores of the clustering
+        list[str]: paths of the cluster logs
+    """
+    check_clustering_params(algorithm, params)
+    # The actions get the ids of the interned vocabulary of the collection of the clusters
+    file_path, matrix_key, _ = await upload_distance_matrix(username, scratch, file, measure, representation,
+                                                            params.collection)
+    return await run_discovery(username, cluster_log, file_path, matrix_key, scratch.path, algorithm.value,
+                               params.dict(), representation)
+
+
 @router.post("/trace_based/")
 async def trace_based(
         current_user: Annotated[User_Model, Depends(get_current_active_user)],
+        scratch: Annotated[Workspace, Depends(request_workspace)],
         algorithm: ClusteringMethod, linkage: LinkageCriteria,params: ClusteringParams = Depends(),logfile_name: str= None, file: UploadFile = File(...)):
     """
         Trace based clustering using levenshtein distance measure, and choosing the clustering algorithm and
-        the parameters for each algorithm
+        the parameters for each algorithm. The distance matrix of the variants of the log is cached:
+        clustering the same log again with other parameters only reruns the clustering
     Args:
         logfile_name: Name of the log file on which we will perform the clustering
         clustering_method: Agglomerative or DBSCAN
@@ -44,22 +130,12 @@ async def trace_based(
         Silhouette score of the clustering and for each cluster
     """
     try:
-        file_content = await file.read()
-        # Decode file content
-        decode = io.StringIO(file_content.decode('utf-8'))
         params.linkage = linkage.lower()
-        # Perform trace-based clustering
-        result, nb = trace_based_clustering(decode, algorithm, params)
-        result["Number of traces"] = nb["Number of traces"]
-        # save the resulting log files in the user's collection
-        files_paths = []
-        log_directory = "temp/logs"
-        # retrieve the files stored in the log directory
-        for filename in os.listdir(log_directory):
-            if filename.startswith("cluster_log_"):
-                file_path = os.path.join(log_directory, filename)
-                files_paths.append(file_path)
+        # Perform trace-based clustering, the resulting log files are written in the workspace
+        result, files_paths = await cluster_uploaded_log(current_user.username, scratch, file, algorithm, params,
+                                                         "levenshtein")
 
+        # save the resulting log files in the user's collection
         col_parameters = {
             "clustering approach": 'Trace Based Clustering',
             "Clustering algorithm": algorithm,
@@ -77,11 +153,13 @@ async def trace_based(
 @router.post("/feature_based/")
 async def vector_representation(
         current_user: Annotated[User_Model, Depends(get_current_active_user)],
+        scratch: Annotated[Workspace, Depends(request_workspace)],
         clustering_method: ClusteringMethod, linkage: LinkageCriteria, vector_representation: VectorRepresentation, distance : DistanceMeasure,
         params: ClusteringParams = Depends(), logfile_name: str= None,file: UploadFile = File(...)):
     """
         Feature based clustering by representing the data as binary vectors, frequency vectors or relative
-        frequency vectors
+        frequency vectors. The traces with the same vector are clustered once, and the distance matrix of the
+        vectors of the log is cached
     Args:
         logfile_name: Name of the log file on which we will perform the clustering
         clustering_method: Agglomerative or DBSCAN
@@ -100,20 +178,12 @@ async def vector_representation(
 
     """
     try:
-        file_content = await file.read()
-        decode = io.StringIO(file_content.decode('utf-8'))
         params.linkage = linkage.lower()
         params.distance = distance.lower()
         #perform feature based clustering based on the vector representation and algorithm chosen by the user
-        result, nb = vector_based_clustering(decode, vector_representation.lower(), clustering_method, params)
-        result["Number of traces"] = nb["Number of traces"]
+        result, files_paths = await cluster_uploaded_log(current_user.username, scratch, file, clustering_method,
+                                                         params, params.distance, vector_representation.lower())
         # save the resulting log files in the user's collection
-        files_paths = []
-        log_directory = "temp/logs"
-        for filename in os.listdir(log_directory):
-            if filename.startswith("cluster_log_"):
-                file_path = os.path.join(log_directory, filename)
-                files_paths.append(file_path)
 
         col_parameters = {
             "clustering approach": 'Feature Based Clustering',
@@ -131,6 +201,140 @@ async def vector_representation(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# Feature based clustering of large logs, without distance matrix: the memory and time grow with the number
+# of distinct vectors instead of its square, and the scores are computed on a sample of the traces
+@router.post("/feature_based/scalable")
+async def scalable_feature_based(
+        current_user: Annotated[User_Model, Depends(get_current_active_user)],
+        scratch: Annotated[Workspace, Depends(request_workspace)],
+        algorithm: ScalableClusteringMethod, vector_representation: VectorRepresentation, distance: DistanceMeasure,
+        params: ClusteringParams = Depends(), sample_size: int = Query(SCORES_SAMPLE_SIZE, ge=2),
+        logfile_name: str = None, file: UploadFile = File(...)):
+    """
+        Feature based clustering of logs too large for the distance matrix of their vectors.
+        MiniBatchKMeans and Birch cluster the vectors in the euclidean space (the vectors are normalized for
+        the Cosine distance, the other distances are refused), DBSCAN runs over the sparse graph of the vectors
+        closer than epsilon with any distance
+    Args:
+        logfile_name: Name of the log file on which we will perform the clustering
+        algorithm: MiniBatchKMeans, Birch or DBSCAN
+        vector_representation: convert the trace to a vector representation either with Binary, Frequency based, or Relative frequency
+        representation
+        distance: distance measure for the clustering, either Hamming, Jaccard, Cosine or Euclidean distance
+        params: parameters of each clustering algorithm
+            n_cluster => MiniBatchKMeans
+            n_cluster (optional) and epsilon (threshold, 0.5 by default) => Birch
+            epsilon and min_samples => DBSCAN
+        sample_size: number of traces sampled to compute the scores
+        file: log file
+    Returns:
+        Davis bouldin score
+        Number of clusters
+        Silhouette score of the clustering and for each cluster
+        Number of traces, of distinct vectors and of sampled traces
+    """
+    try:
+        params.distance = distance.lower()
+        check_clustering_params(algorithm, params)
+        file_path = scratch.file("log.csv")
+        await save_upload_file(file, file_path)
+        result, files_paths = await run_discovery(current_user.username, cluster_log_scalable, file_path,
+                                                  scratch.path, algorithm.value, params.dict(),
+                                                  vector_representation.lower(), sample_size, params.collection)
+
+        col_parameters = {
+            "clustering approach": 'Feature Based Clustering',
+            "Vector representation": vector_representation,
+            "Clustering algorithm": algorithm,
+            "Logfile name": logfile_name,
+
+        }
+        await post_clusters(files_paths, col_parameters, params, current_user, result)
+        return result
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# Evaluate a grid of clustering parameters on a log, its distance matrix is computed once for all the settings
+@router.post("/sweep/")
+async def clustering_sweep(
+        current_user: Annotated[User_Model, Depends(get_current_active_user)],
+        scratch: Annotated[Workspace, Depends(request_workspace)],
+        algorithm: ClusteringMethod,
+        epsilon: list[float] = Query([]),
+        min_samples: list[int] = Query([]),
+        nbr_clusters: list[int] = Query([]),
+        linkage: list[LinkageCriteria] = Query([]),
+        vector_representation: VectorRepresentation | None = None,
+        distance: DistanceMeasure = DistanceMeasure.Jaccard,
+        file: UploadFile = File(...)):
+    """
+        Parameter sweep of the trace based clustering (levenshtein distance), or of the feature based clustering
+        when a vector representation is given. The distance matrix of the log is computed once (or taken from the
+        cache), then the settings are clustered by groups sharing their dendrogram or their epsilon, at most
+        CLUSTERING_SWEEP_WORKERS groups at the same time within the discovery limits of the user.
+        Nothing is saved in a collection
+    Args:
+        algorithm: Agglomerative or DBSCAN
+        epsilon, min_samples: values of the parameters of DBSCAN, each pair is a setting
+        nbr_clusters, linkage: values of the parameters of Agglomerative, each pair is a setting
+        vector_representation: Binary, Frequency or Relative frequency representation of the traces,
+            none for the trace based clustering
+        distance: distance measure of the feature based clustering, either Hamming, Jaccard, Cosine or Euclidean
+        file: log file
+    Returns:
+        Number of traces and of distinct items (variants or vectors) of the log
+        Silhouette score, Davies bouldin score and number of clusters of each setting, and the setting with the
+        best silhouette score
+    """
+    grid = {"epsilon": epsilon, "min_samples": min_samples, "nbr_clusters": nbr_clusters,
+            "linkage": [criteria.lower() for criteria in linkage]}
+    parameters = ("epsilon", "min_samples") if algorithm == ClusteringMethod.DBSCAN else ("linkage", "nbr_clusters")
+    if not all(grid[parameter] for parameter in parameters):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"The sweep of {algorithm.value} needs values of {' and '.join(parameters)}")
+    if len(grid[parameters[0]]) * len(grid[parameters[1]]) > CLUSTERING_SWEEP_MAX_SETTINGS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"A sweep evaluates at most {CLUSTERING_SWEEP_MAX_SETTINGS} settings")
+    # The smallest values are the ones that may be out of range
+    check_clustering_params(algorithm, ClusteringParams(epsilon=min(epsilon, default=None),
+                                                        min_samples=min(min_samples, default=None),
+                                                        nbr_clusters=min(nbr_clusters, default=None)))
+
+    try:
+        representation = vector_representation.lower() if vector_representation else None
+        measure = distance.lower() if representation else "levenshtein"
+        file_path, matrix_key, counts = await upload_distance_matrix(current_user.username, scratch, file, measure,
+                                                                     representation)
+        if counts is None:
+            counts = await run_discovery(current_user.username, log_items, file_path, representation, result_index=1)
+
+        # Each group holds the square distance matrix of the log: the groups run as discoveries of the user,
+        # and a sweep runs at most CLUSTERING_SWEEP_WORKERS of them at the same time
+        workers = asyncio.Semaphore(CLUSTERING_SWEEP_WORKERS)
+
+        async def run_group(group: dict) -> list[dict]:
+            async with workers:
+                return await run_discovery(current_user.username, sweep_group, matrix_key, counts, algorithm.value,
+                                           group, wait=True)
+
+        groups = await asyncio.gather(*(run_group(group) for group in sweep_groups(algorithm.value, grid)))
+        settings = [setting for group in groups for setting in group]
+        scored = [setting for setting in settings if setting["Silhouette score"] is not None]
+        return {
+            "Number of traces": int(counts.sum()),
+            "Number of variants" if representation is None else "Number of distinct vectors": len(counts),
+            "settings": settings,
+            "best": max(scored, key=lambda setting: setting["Silhouette score"]) if scored else None,
+        }
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 # NOTE:  FSS Clustering takes tOo much time when testing with moodle data,
 # We can test this method with other files logs in the service clustering
 
@@ -239,11 +443,15 @@ async def get_clusters_func( collection: str,
     try:
         # Check if the collection exists
         collection_db = await collection_exists(current_user.username, collection)
-        documents = await fetch_documents(collection_db)
+        events_db = await get_events_collection(current_user.username, collection)
 
         # Create a directory to store the CSV files
         directory = "temp/clusters"
-        file_paths = create_csv_files(documents, directory)
+        if events_db is not None:
+            file_paths = await create_csv_files_from_events(events_db, directory)
+        else:
+            documents = await fetch_documents(collection_db)
+            file_paths = create_csv_files(documents, directory)
 
         return {"message": "Documents have been saved as CSV files.", "file_paths": file_paths}
 
@@ -262,10 +470,14 @@ async def get_file( collection: str, cluster_id : int,
     try:
         # Check if the collection exists
         collection_db = await collection_exists(current_user.username, collection)
-        documents = await fetch_documents(collection_db)
+        events_db = await get_events_collection(current_user.username, collection)
 
         # Create a directory to store the CSV files
-        csv_data = create_csv_file(documents, cluster_id)
+        if events_db is not None:
+            csv_data = await create_csv_file_from_events(events_db, cluster_id)
+        else:
+            documents = await fetch_documents(collection_db)
+            csv_data = create_csv_file(documents, cluster_id)
 
         response = Response(content=csv_data, media_type="text/csv")
         response.headers["Content-Disposition"] = f"attachment; filename=cluster_{cluster_id}.csv"
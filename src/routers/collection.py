@@ -5,8 +5,11 @@ from fastapi import APIRouter, HTTPException, status
 from fastapi.encoders import jsonable_encoder
 from fastapi.params import Depends
 
+from ..cache_utils import bump_generation, statistics_cache
+from ..client_utils import ensure_client_indexes, normalize_request_times
 from ..collection_utils import get_log_collections, get_cluster_collections, get_collections_names, remove_null_values
 from ..database.config import database, user_collection
+from ..events_utils import EVENT_INDEXES, events_collection_name, rebuild_events
 from ..models.collection import *
 from ..models.users import User_Model
 from ..security import get_current_active_user
@@ -61,6 +64,9 @@ async def create_collection(
     )
     # Create collection in database
     await database.create_collection(coll.name)
+    await ensure_client_indexes(database[coll.name])
+    if coll.event_layout:
+        await database[events_collection_name(coll.name)].create_indexes(EVENT_INDEXES)
     return coll
 
 
@@ -102,10 +108,53 @@ async def delete_collection(
         {"$pull": {"collections": {"name": collection}}},
     )
     # Delete collection for database
-    database.drop_collection(collection)
+    await database.drop_collection(collection)
+    await database.drop_collection(events_collection_name(collection))
+    statistics_cache.invalidate(collection)
     return {"Success": "Collection deleted successfully"}
 
 
+# Route to enable or disable the event layout of a collection
+# The event layout stores one document per request in the collection "<name>_events", alongside the clients
+# Return a success message with the status code 200
+@router.put("/event_layout/", status_code=status.HTTP_200_OK)
+async def set_event_layout(
+        current_user: Annotated[User_Model, Depends(get_current_active_user)],
+        collection: str,
+        enabled: bool = True,
+) -> dict:
+    if collection not in await get_collections_names(current_user.username):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Collection doesn't exist"
+        )
+    await user_collection.update_one(
+        {"username": current_user.username, "collections.name": collection},
+        {"$set": {"collections.$.event_layout": enabled}},
+    )
+    if enabled:
+        # Build the events from the clients already in the collection
+        await rebuild_events(database[collection], database[events_collection_name(collection)])
+        return {"Success": "Event layout enabled"}
+    await database.drop_collection(events_collection_name(collection))
+    return {"Success": "Event layout disabled"}
+
+
+# Route to convert the request times of a collection created before they were stored as dates
+# Return the number of clients converted with the status code 200
+@router.put("/normalize_request_time/", status_code=status.HTTP_200_OK)
+async def normalize_collection_request_time(
+        current_user: Annotated[User_Model, Depends(get_current_active_user)],
+        collection: str,
+) -> dict:
+    if collection not in await get_collections_names(current_user.username):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Collection doesn't exist"
+        )
+    converted = await normalize_request_times(database[collection])
+    await bump_generation(collection)
+    return {"Success": "Request times converted", "Clients converted": converted}
+
+
 # Route to purge a collection in database
 # Take a collection name as parameter
 # Doesn't delete the files hash
@@ -114,4 +163,6 @@ async def delete_collection(
 async def purge_collection(collection: str) -> dict:
     # Delete all documents in collection
     await database[collection].delete_many({})
+    await database[events_collection_name(collection)].delete_many({})
+    await bump_generation(collection)
     return {"Success": "Collection purged successfully"}
@@ -1,22 +1,30 @@
+import json
 import os
-import tempfile
+import zipfile
 from typing import Annotated
-from fastapi import FastAPI, UploadFile, File, APIRouter, HTTPException, Query, Request, Depends
+from fastapi import FastAPI, UploadFile, File, APIRouter, HTTPException, Query, Request, Depends, status
 from fastapi.responses import JSONResponse, Response, FileResponse, HTMLResponse
-from discover.main import (alpha_miner_algo, alpha_algo_quality, alpha_miner_plus, alpha_miner_plus_quality,
-                           freq_alpha_miner, heuristic_miner, heuristic_miner_petri,
-                           inductive_miner, inductive_miner_quality, inductive_miner_tree,
-                           dfg_precision, dfg_petri_quality,
-                           dfg_performance, bpmn_model, process_animate)
+from discover.main import (alpha_miner_algo, alpha_miner_plus, inductive_miner, inductive_miner_tree,
+                           bpmn_model, process_animate)
 from ..database.config import database
 from ..collection_utils import collection_exists
-from ..discover_utils import read_files, create_zip_file
-from ..models.discover import Quality_Type
+from ..cache_utils import get_generation
+from ..discover_utils import (QUALITY_SAMPLE_VARIANTS, create_zip_file, discover_model,
+                              get_cached_model, model_cache_key, model_render_path, parsed_log_key, render_dfg,
+                              render_frequency_alpha, render_heuristics_net, render_model, render_performance_dfg,
+                              render_petri_net, quality_model_zip, store_cached_model)
+from ..events_utils import get_events_collection
+from ..executor_utils import run_discovery
+from ..jobs_utils import (cancel_discovery_job, create_discovery_job, discovery_job_dir, get_discovery_job,
+                          start_discovery_job)
+from ..models.discover import Discovery_Algorithm, Image_Format, Model_Kind, Quality_Type
+from ..models.jobs import Discovery_Job_Model, JobStatus
 from ..models.users import User_Model
 from ..security import get_current_active_user
 from ..stats_utils import get_clients_action
+from ..utils import save_upload_file
+from ..workspace_utils import Workspace, request_workspace, workspace
 
-import time
 import logging
 import sys
 
@@ -38,8 +46,70 @@ router = APIRouter(
 )
 
 
+async def run_cached_discovery(username: str, file: UploadFile, function, *args,
+                               result_index: int | None = None, columns: dict | None = None) -> str:
+    """Run a discovery function on an uploaded log in the discovery executor
+        Its output is kept in the models cache, keyed by the SHA-256 of the log, the function and its arguments:
+        the same discovery run again on the same log is served from the cache
+
+    Args:
+        username (str): the user running the discovery
+        file (UploadFile): the csv or xes log file
+        function: a discover.main function, called with the path of the log and args,
+            or when columns is given a discover_utils function, called with the log source
+            (so it goes through the parsed logs cache), an output directory and args
+        result_index (int): element of the tuple returned by a discover.main function which is the output file
+        columns (dict): case_name, concept_name, timestamp and separator of the csv file
+
+    Returns:
+        str: path of the output file (image or zip file) in the cache
+    """
+    extension = os.path.splitext(file.filename)[1]
+    async with workspace() as scratch:
+        temp_file_path = scratch.file("log" + extension)
+        file_hash = await save_upload_file(file, temp_file_path)
+        if columns is None:
+            cache_key = model_cache_key(file_hash, extension.lower(), function.__name__, args)
+        else:
+            source = {"file_path": temp_file_path, "file_hash": file_hash, "columns": columns}
+            cache_key = model_cache_key(parsed_log_key(source), function.__name__, args)
+        cached_path = get_cached_model(cache_key)
+        if cached_path is None:
+            if columns is None:
+                output_path = await run_discovery(username, function, temp_file_path, *args, result_index=result_index)
+            else:
+                output_path = await run_discovery(username, function, source, scratch.path, *args)
+            cached_path = store_cached_model(cache_key, [output_path])
+    return os.path.join(cached_path, os.listdir(cached_path)[0])
+
+
+def log_columns(case_name: str, concept_name: str, timestamp: str, separator: str) -> dict:
+    return {"case_name": case_name, "concept_name": concept_name, "timestamp": timestamp, "separator": separator}
+
+
+def quality_sampling(approximate: bool = False,
+                     sample_variants: int = Query(QUALITY_SAMPLE_VARIANTS, ge=1),
+                     time_limit: float | None = Query(None, gt=0),
+                     confidence_level: float = Query(0.95, gt=0, lt=1)) -> dict | None:
+    """Query parameters of the approximate quality of the quality routes
+
+    Args:
+        approximate: estimate the quality on a sample of the variants of the log instead of measuring it exactly
+        sample_variants: maximum number of variants replayed or aligned
+        time_limit: time (in seconds) after which no more traces are sampled
+        confidence_level: level of the confidence intervals of the estimates
+
+    Returns:
+        dict: the sampling settings of estimate_quality, None for the exact quality
+    """
+    if not approximate:
+        return None
+    return {"sample_variants": sample_variants, "time_limit": time_limit, "confidence_level": confidence_level}
+
+
 @router.post("/alpha-miner/")
 async def alpha_miner_algorithm(
+        current_user: Annotated[User_Model, Depends(get_current_active_user)],
         case_name: str = "client_id",
         concept_name: str = "action",
         timestamp: str = 'timestamp', separator: str = ";",file: UploadFile = File(...)):
@@ -52,16 +122,11 @@ async def alpha_miner_algorithm(
             petri net, initial marking and final marking
            """
     try:
-        file_content = await file.read()
-        file_extension = os.path.splitext(file.filename)[1]
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as temp_file:
-            temp_file.write(file_content)
-            temp_file_path = temp_file.name
-
-        log, net, initial_marking, final_marking, output_path = await alpha_miner_algo(temp_file_path, case_name,
-                                                                                       concept_name, timestamp, separator)
+        output_path = await run_cached_discovery(current_user.username, file, alpha_miner_algo, case_name,
+                                                 concept_name, timestamp, separator, result_index=-1)
         return FileResponse(output_path)
+    except HTTPException as e:
+        raise e
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
     except Exception as e:
@@ -69,8 +134,11 @@ async def alpha_miner_algorithm(
 
 
 @router.post("/alpha-miner-algo-quality/")
-async def alphaminer_algo_quality(fitness_approach: Quality_Type,
-                                  precision_approach: Quality_Type, case_name: str = "client_id",
+async def alphaminer_algo_quality(current_user: Annotated[User_Model, Depends(get_current_active_user)],
+                                  fitness_approach: Quality_Type,
+                                  precision_approach: Quality_Type,
+                                  sampling: Annotated[dict | None, Depends(quality_sampling)],
+                                  case_name: str = "client_id",
                                   concept_name: str = "action",
                                   timestamp: str = 'timestamp', separator: str = ";", file: UploadFile = File(...)):
     """
@@ -82,16 +150,12 @@ async def alphaminer_algo_quality(fitness_approach: Quality_Type,
                 petri net, initial marking and final marking
                """
     try:
-        file_content = await file.read()
-        file_extension = os.path.splitext(file.filename)[1]
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as temp_file:
-            temp_file.write(file_content)
-            temp_file_path = temp_file.name
-
-        results, zip = await alpha_algo_quality(temp_file_path, case_name, concept_name, timestamp, separator,
-                                                fitness_approach.lower(), precision_approach.lower())
+        zip = await run_cached_discovery(current_user.username, file, quality_model_zip, "alpha", {},
+                                         fitness_approach.value, precision_approach.value, sampling,
+                                         columns=log_columns(case_name, concept_name, timestamp, separator))
         return FileResponse(zip, media_type="application/zip", filename="Model_Quality.zip")
+    except HTTPException as e:
+        raise e
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
     except Exception as e:
@@ -100,7 +164,8 @@ async def alphaminer_algo_quality(fitness_approach: Quality_Type,
 
 # able to discover more complex connection, handle loops and connections effectively
 @router.post("/alpha-miner-plus/")
-async def alpha_plus(case_name: str = "client_id", concept_name: str = "action",
+async def alpha_plus(current_user: Annotated[User_Model, Depends(get_current_active_user)],
+                     case_name: str = "client_id", concept_name: str = "action",
                      timestamp: str = 'timestamp', separator: str = ";", file: UploadFile = File(...)):
     """
                Alpha miner plus :  able to discover more complex connections, handle loops and connections effectively
@@ -111,17 +176,11 @@ async def alpha_plus(case_name: str = "client_id", concept_name: str = "action",
                 petri net, initial marking and final marking
                """
     try:
-        file_content = await file.read()
-        file_extension = os.path.splitext(file.filename)[1]
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as temp_file:
-            temp_file.write(file_content)
-            temp_file_path = temp_file.name
-
-        log, net, initial_marking, final_marking, output_path = await alpha_miner_plus(temp_file_path, case_name,
-                                                                                       concept_name, timestamp,
-                                                                                       separator, )
+        output_path = await run_cached_discovery(current_user.username, file, alpha_miner_plus, case_name,
+                                                 concept_name, timestamp, separator, result_index=-1)
         return FileResponse(output_path)
+    except HTTPException as e:
+        raise e
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
     except Exception as e:
@@ -129,8 +188,11 @@ async def alpha_plus(case_name: str = "client_id", concept_name: str = "action",
 
 
 @router.post("/alpha-miner-plus-quality/")
-async def alpha_miner_plus_qual(fitness_approach: Quality_Type,
-                                precision_approach: Quality_Type, case_name: str = "client_id",
+async def alpha_miner_plus_qual(current_user: Annotated[User_Model, Depends(get_current_active_user)],
+                                fitness_approach: Quality_Type,
+                                precision_approach: Quality_Type,
+                                sampling: Annotated[dict | None, Depends(quality_sampling)],
+                                case_name: str = "client_id",
                                 concept_name: str = "action",
                                 timestamp: str = 'timestamp', separator: str = ";",
                                 file: UploadFile = File(...)):
@@ -143,16 +205,12 @@ async def alpha_miner_plus_qual(fitness_approach: Quality_Type,
                 petri net, initial marking and final marking
                """
     try:
-        file_content = await file.read()
-        file_extension = os.path.splitext(file.filename)[1]
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as temp_file:
-            temp_file.write(file_content)
-            temp_file_path = temp_file.name
-
-        results, zip = await alpha_miner_plus_quality(temp_file_path, case_name, concept_name, timestamp, separator,
-                                                      fitness_approach.lower(), precision_approach.lower())
+        zip = await run_cached_discovery(current_user.username, file, quality_model_zip, "alpha_plus", {},
+                                         fitness_approach.value, precision_approach.value, sampling,
+                                         columns=log_columns(case_name, concept_name, timestamp, separator))
         return FileResponse(zip, media_type="application/zip", filename="Model_Quality.zip")
+    except HTTPException as e:
+        raise e
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
     except Exception as e:
@@ -160,7 +218,8 @@ async def alpha_miner_plus_qual(fitness_approach: Quality_Type,
 
 
 @router.post("/alpha-miner-frequency/")
-async def frequency_alpha_miner(case_name: str = "client_id", concept_name: str = "action",
+async def frequency_alpha_miner(current_user: Annotated[User_Model, Depends(get_current_active_user)],
+                                case_name: str = "client_id", concept_name: str = "action",
                                 timestamp: str = 'timestamp', separator: str = ";", file: UploadFile = File(...)):
     """
               Creates an Alpha miner petri net with the frequency of the activities and saves it in a png file
@@ -171,14 +230,11 @@ async def frequency_alpha_miner(case_name: str = "client_id", concept_name: str
                 petri net, initial marking and final marking
                """
     try:
-        file_content = await file.read()
-        file_extension = os.path.splitext(file.filename)[1]
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as temp_file:
-            temp_file.write(file_content)
-            temp_file_path = temp_file.name
-        output_path = await freq_alpha_miner(temp_file_path, case_name, concept_name, timestamp, separator)
+        output_path = await run_cached_discovery(current_user.username, file, render_frequency_alpha,
+                                                 columns=log_columns(case_name, concept_name, timestamp, separator))
         return FileResponse(output_path)
+    except HTTPException as e:
+        raise e
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
     except Exception as e:
@@ -186,7 +242,8 @@ async def frequency_alpha_miner(case_name: str = "client_id", concept_name: str
 
 
 @router.post("/heuristic_miner/")
-async def heuristic_miner_algo(case_name: str = "client_id", concept_name: str = "action",
+async def heuristic_miner_algo(current_user: Annotated[User_Model, Depends(get_current_active_user)],
+                               case_name: str = "client_id", concept_name: str = "action",
                                timestamp: str = 'timestamp', separator: str = ";", file: UploadFile = File(...),
                                dependency_threshold: float = Query(0.5, ge=0, le=1),
                                and_threshold: float = Query(0.65, ge=0, le=1),
@@ -203,16 +260,12 @@ async def heuristic_miner_algo(case_name: str = "client_id", concept_name: str =
     Returns: a png file of the heuristic net
                """
     try:
-        file_content = await file.read()
-        file_extension = os.path.splitext(file.filename)[1]
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as temp_file:
-            temp_file.write(file_content)
-            temp_file_path = temp_file.name
-
-        output_path = await heuristic_miner(temp_file_path, case_name, concept_name, timestamp, separator,
-                                            dependency_threshold, and_threshold, loop_two_threshold)
+        output_path = await run_cached_discovery(current_user.username, file, render_heuristics_net,
+                                                 dependency_threshold, and_threshold, loop_two_threshold,
+                                                 columns=log_columns(case_name, concept_name, timestamp, separator))
         return FileResponse(output_path)
+    except HTTPException as e:
+        raise e
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
     except Exception as e:
@@ -220,8 +273,11 @@ async def heuristic_miner_algo(case_name: str = "client_id", concept_name: str =
 
 
 @router.post("/heuristic_petri_net/")
-async def heuristic_miner_to_petrinet(fitness_approach: Quality_Type,
-                                      precision_approach: Quality_Type, case_name: str = "client_id",
+async def heuristic_miner_to_petrinet(current_user: Annotated[User_Model, Depends(get_current_active_user)],
+                                      fitness_approach: Quality_Type,
+                                      precision_approach: Quality_Type,
+                                      sampling: Annotated[dict | None, Depends(quality_sampling)],
+                                      case_name: str = "client_id",
                                       concept_name: str = "action",
                                       timestamp: str = 'timestamp', separator: str = ";",
                                       file: UploadFile = File(...)):
@@ -230,21 +286,14 @@ async def heuristic_miner_to_petrinet(fitness_approach: Quality_Type,
         Returns:
             A zip file containing the petri net, pnml file and the quality of the model
     """
-    start_time = time.time()
     try:
-        file_content = await file.read()
-        logger.info(f"File read in {time.time() - start_time:.2f} seconds")
-
-        file_extension = os.path.splitext(file.filename)[1]
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as temp_file:
-            temp_file.write(file_content)
-            temp_file_path = temp_file.name
-        logger.info(f"Temp file written in {time.time() - start_time:.2f} seconds")
-
-        results, zip_path = await heuristic_miner_petri(temp_file_path, case_name, concept_name, timestamp, separator,
-                                                         fitness_approach.lower(), precision_approach.lower())
+        zip_path = await run_cached_discovery(current_user.username, file, quality_model_zip, "heuristic", {},
+                                              fitness_approach.value, precision_approach.value, sampling,
+                                              columns=log_columns(case_name, concept_name, timestamp, separator))
 
         return FileResponse(zip_path, media_type="application/zip", filename="Model_Quality.zip")
+    except HTTPException as e:
+        raise e
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
     except Exception as e:
@@ -252,7 +301,8 @@ async def heuristic_miner_to_petrinet(fitness_approach: Quality_Type,
 
 
 @router.post("/inductive_miner/")
-async def inductive_miner_algo(case_name: str = "client_id", concept_name: str = "action",
+async def inductive_miner_algo(current_user: Annotated[User_Model, Depends(get_current_active_user)],
+                               case_name: str = "client_id", concept_name: str = "action",
                                timestamp: str = 'timestamp', separator: str = ";", file: UploadFile = File(...),
                                noise_threshold: float = Query(0, ge=0, le=1)):
     """
@@ -265,16 +315,11 @@ async def inductive_miner_algo(case_name: str = "client_id", concept_name: str =
             petri net, initial marking and final marking
     """
     try:
-        file_content = await file.read()
-        file_extension = os.path.splitext(file.filename)[1]
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as temp_file:
-            temp_file.write(file_content)
-            temp_file_path = temp_file.name
-        log, net, initial_marking, final_marking, output_path = await inductive_miner(temp_file_path, case_name,
-                                                                                      concept_name, timestamp,
-                                                                                      separator, noise_threshold)
+        output_path = await run_cached_discovery(current_user.username, file, inductive_miner, case_name,
+                                                 concept_name, timestamp, separator, noise_threshold, result_index=-1)
         return FileResponse(output_path)
+    except HTTPException as e:
+        raise e
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
     except Exception as e:
@@ -282,8 +327,11 @@ async def inductive_miner_algo(case_name: str = "client_id", concept_name: str =
 
 
 @router.post("/inductive_miner_quality/")
-async def inductive_miner_qual(fitness_approach: Quality_Type,
-                               precision_approach: Quality_Type, case_name: str = "client_id",
+async def inductive_miner_qual(current_user: Annotated[User_Model, Depends(get_current_active_user)],
+                               fitness_approach: Quality_Type,
+                               precision_approach: Quality_Type,
+                               sampling: Annotated[dict | None, Depends(quality_sampling)],
+                               case_name: str = "client_id",
                                concept_name: str = "action",
                                timestamp: str = 'timestamp', separator: str = ";",
                                noise_threshold: float = Query(0, ge=0, le=1),
@@ -300,19 +348,13 @@ async def inductive_miner_qual(fitness_approach: Quality_Type,
 
         """
     try:
-        file_content = await file.read()
-        file_extension = os.path.splitext(file.filename)[1]
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as temp_file:
-            temp_file.write(file_content)
-            temp_file_path = temp_file.name
-
-        print(fitness_approach.lower(), precision_approach.lower())
-
-        results, zip = await inductive_miner_quality(temp_file_path, case_name, concept_name, timestamp, separator,
-                                                     noise_threshold, fitness_approach.lower(),
-                                                     precision_approach.lower())
+        zip = await run_cached_discovery(current_user.username, file, quality_model_zip, "inductive",
+                                         {"noise_threshold": noise_threshold},
+                                         fitness_approach.value, precision_approach.value, sampling,
+                                         columns=log_columns(case_name, concept_name, timestamp, separator))
         return FileResponse(zip, media_type="application/zip", filename="Model_Quality.zip")
+    except HTTPException as e:
+        raise e
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
     except Exception as e:
@@ -320,7 +362,8 @@ async def inductive_miner_qual(fitness_approach: Quality_Type,
 
 
 @router.post("/inductive_process_tree/")
-async def inductive_miner_process_tree(case_name: str = "client_id", concept_name: str = "action",
+async def inductive_miner_process_tree(current_user: Annotated[User_Model, Depends(get_current_active_user)],
+                                       case_name: str = "client_id", concept_name: str = "action",
                                        timestamp: str = 'timestamp', separator: str = ";",
                                        file: UploadFile = File(...)):
     """
@@ -332,15 +375,11 @@ async def inductive_miner_process_tree(case_name: str = "client_id", concept_nam
                 petri net, initial marking and final marking
                """
     try:
-        file_content = await file.read()
-        file_extension = os.path.splitext(file.filename)[1]
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as temp_file:
-            temp_file.write(file_content)
-            temp_file_path = temp_file.name
-
-        output_path = await inductive_miner_tree(temp_file_path, case_name, concept_name, timestamp, separator )
+        output_path = await run_cached_discovery(current_user.username, file, inductive_miner_tree, case_name,
+                                                 concept_name, timestamp, separator)
         return FileResponse(output_path)
+    except HTTPException as e:
+        raise e
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
     except Exception as e:
@@ -348,7 +387,8 @@ async def inductive_miner_process_tree(case_name: str = "client_id", concept_nam
 
 
 @router.post("/bpmn_model_inductive/")
-async def bpmn_mod(case_name: str = "client_id", concept_name: str = "action",
+async def bpmn_mod(current_user: Annotated[User_Model, Depends(get_current_active_user)],
+                   case_name: str = "client_id", concept_name: str = "action",
                    timestamp: str = 'timestamp', separator: str = ";", file: UploadFile = File(...)):
     """
        Creates and inductive BPMN model and saves it in a png file
@@ -359,14 +399,11 @@ async def bpmn_mod(case_name: str = "client_id", concept_name: str = "action",
                 BPMN file
                """
     try:
-        file_content = await file.read()
-        file_extension = os.path.splitext(file.filename)[1]
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as temp_file:
-            temp_file.write(file_content)
-            temp_file_path = temp_file.name
-        output_path = await bpmn_model(temp_file_path, case_name, concept_name, timestamp, separator)
+        output_path = await run_cached_discovery(current_user.username, file, bpmn_model, case_name,
+                                                 concept_name, timestamp, separator)
         return FileResponse(output_path)
+    except HTTPException as e:
+        raise e
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
     except Exception as e:
@@ -374,7 +411,8 @@ async def bpmn_mod(case_name: str = "client_id", concept_name: str = "action",
 
 
 @router.post("/directly_follow_graph/")
-async def directly_follow_graph(case_name: str = "client_id", concept_name: str = "action",
+async def directly_follow_graph(current_user: Annotated[User_Model, Depends(get_current_active_user)],
+                                case_name: str = "client_id", concept_name: str = "action",
                                 timestamp: str = 'timestamp', separator: str = ";", file: UploadFile = File(...)):
     """
     Generates a graph of the directly follow activities and saves it in a png file
@@ -385,15 +423,11 @@ async def directly_follow_graph(case_name: str = "client_id", concept_name: str
         A tuple with the directly-following activities
     """
     try:
-        file_content = await file.read()
-        file_extension = os.path.splitext(file.filename)[1]
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as temp_file:
-            temp_file.write(file_content)
-            temp_file_path = temp_file.name
-
-        precision, output_path = await dfg_precision(temp_file_path, case_name, concept_name, timestamp, separator)
+        output_path = await run_cached_discovery(current_user.username, file, render_dfg,
+                                                 columns=log_columns(case_name, concept_name, timestamp, separator))
         return FileResponse(output_path)
+    except HTTPException as e:
+        raise e
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
     except Exception as e:
@@ -401,8 +435,11 @@ async def directly_follow_graph(case_name: str = "client_id", concept_name: str
 
 
 @router.post("/dfg_to_petrinet/")
-async def dfg_to_petrinet_quality(fitness_approach: Quality_Type,
-                                  precision_approach: Quality_Type, case_name: str = "client_id",
+async def dfg_to_petrinet_quality(current_user: Annotated[User_Model, Depends(get_current_active_user)],
+                                  fitness_approach: Quality_Type,
+                                  precision_approach: Quality_Type,
+                                  sampling: Annotated[dict | None, Depends(quality_sampling)],
+                                  case_name: str = "client_id",
                                   concept_name: str = "action",
                                   timestamp: str = 'timestamp', separator: str = ";",
                                   file: UploadFile = File(...)):
@@ -413,19 +450,13 @@ async def dfg_to_petrinet_quality(fitness_approach: Quality_Type,
      Returns : the precision of the Directly Follow Graph
                """
     try:
-        file_content = await file.read()
-        file_extension = os.path.splitext(file.filename)[1]
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as temp_file:
-            temp_file.write(file_content)
-            temp_file_path = temp_file.name
-
-        print(fitness_approach.lower(), precision_approach.lower())
-
-        results, zip = await dfg_petri_quality(temp_file_path, case_name, concept_name, timestamp, separator,
-                                               fitness_approach.lower(), precision_approach.lower())
+        zip = await run_cached_discovery(current_user.username, file, quality_model_zip, "dfg", {},
+                                         fitness_approach.value, precision_approach.value, sampling,
+                                         columns=log_columns(case_name, concept_name, timestamp, separator))
 
         return FileResponse(zip, media_type="application/zip", filename="Model_Quality.zip")
+    except HTTPException as e:
+        raise e
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
     except Exception as e:
@@ -433,7 +464,8 @@ async def dfg_to_petrinet_quality(fitness_approach: Quality_Type,
 
 
 @router.post("/dfg_performance/")
-async def dfg_perf(case_name: str = "client_id", concept_name: str = "action",
+async def dfg_perf(current_user: Annotated[User_Model, Depends(get_current_active_user)],
+                   case_name: str = "client_id", concept_name: str = "action",
                    timestamp: str = 'timestamp', separator: str = ";", file: UploadFile = File(...)):
     """
      Discovers a performance directly-follows graph from an event log and saves it in a png file
@@ -444,15 +476,11 @@ async def dfg_perf(case_name: str = "client_id", concept_name: str = "action",
         petri net, initial marking and final marking
                """
     try:
-        file_content = await file.read()
-        file_extension = os.path.splitext(file.filename)[1]
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as temp_file:
-            temp_file.write(file_content)
-            temp_file_path = temp_file.name
-
-        output_path = await dfg_performance(temp_file_path, case_name, concept_name, timestamp, separator)
+        output_path = await run_cached_discovery(current_user.username, file, render_performance_dfg,
+                                                 columns=log_columns(case_name, concept_name, timestamp, separator))
         return FileResponse(output_path)
+    except HTTPException as e:
+        raise e
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
     except Exception as e:
@@ -460,21 +488,305 @@ async def dfg_perf(case_name: str = "client_id", concept_name: str = "action",
 
 
 @router.post("/animate_process/")
-async def process_animation(file: UploadFile = File(...)):
+async def process_animation(current_user: Annotated[User_Model, Depends(get_current_active_user)],
+                            scratch: Annotated[Workspace, Depends(request_workspace)],
+                            file: UploadFile = File(...)):
     try:
-        # Save the uploaded file
-        file_path = os.path.join("src/temp", file.filename)
-        with open(file_path, "wb") as f:
-            contents = await file.read()
-            f.write(contents)
+        # Save the uploaded file, the workspace is deleted once the zip file is sent
+        file_path = scratch.file(file.filename)
+        await save_upload_file(file, file_path)
 
-        html_file_path = await process_animate(file_path)
+        html_file_path = await run_discovery(current_user.username, process_animate, file_path)
         print("file path ", html_file_path)
         list_files = []
         list_files.append(html_file_path)
         list_files.append("src/temp/process_animation_files")
-        zip_file_path = create_zip_file(list_files)
+        zip_file_path = create_zip_file(list_files, scratch.path)
 
         return FileResponse(zip_file_path, media_type="application/zip", filename="animation.zip")
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def algorithm_parameters(algorithm: Discovery_Algorithm, noise_threshold: float, dependency_threshold: float,
+                         and_threshold: float, loop_two_threshold: float) -> dict:
+    """Keep the parameters used by the algorithm, the other ones must not change the key of its model in the cache"""
+    if algorithm == Discovery_Algorithm.inductive:
+        return {"noise_threshold": noise_threshold}
+    elif algorithm == Discovery_Algorithm.heuristic:
+        return {"dependency_threshold": dependency_threshold, "and_threshold": and_threshold,
+                "loop_two_threshold": loop_two_threshold}
+    return {}
+
+
+async def collection_log_source(username: str, collection: str, cluster_id: int | None,
+                                tags: list[str] | None) -> dict:
+    """Describe a log collection of a user (and its filters) for the discovery processes, which read it from MongoDB"""
+    await collection_exists(username, collection)
+    events_db = await get_events_collection(username, collection)
+    return {
+        "collection": collection,
+        "events_collection": events_db.name if events_db is not None else None,
+        "generation": await get_generation(collection),
+        "cluster_id": cluster_id,
+        "tags": tags,
+    }
+
+
+# Discover a petri net from a log collection, without exporting and uploading its events
+@router.get("/collection/{algorithm}")
+async def discover_from_collection(algorithm: Discovery_Algorithm, collection: str,
+                                   current_user: Annotated[User_Model, Depends(get_current_active_user)],
+                                   cluster_id: int | None = None,
+                                   tags: list[str] | None = Query(None),
+                                   noise_threshold: float = Query(0, ge=0, le=1),
+                                   dependency_threshold: float = Query(0.5, ge=0, le=1),
+                                   and_threshold: float = Query(0.65, ge=0, le=1),
+                                   loop_two_threshold: float = Query(0.5, ge=0, le=1)):
+    """
+    Discover a petri net from the events of a collection and saves it in a png file
+    Args:
+        algorithm: alpha, alpha_plus, heuristic, inductive or dfg
+        collection: the log collection, the cases are the clients and the activities the tags of the requests
+            (their url when they are not tagged)
+        cluster_id: only mine the requests of this cluster
+        tags: only mine these activities
+        noise_threshold: parameter of the inductive miner
+        dependency_threshold, and_threshold, loop_two_threshold: parameters of the heuristic miner
+    Returns:
+        a png file of the petri net
+    """
+    source = await collection_log_source(current_user.username, collection, cluster_id, tags)
+    parameters = algorithm_parameters(algorithm, noise_threshold, dependency_threshold, and_threshold,
+                                      loop_two_threshold)
+    cache_key = model_cache_key(parsed_log_key(source), "petri_net", algorithm.value, parameters)
+    cached_path = get_cached_model(cache_key)
+    if cached_path is None:
+        try:
+            async with workspace() as scratch:
+                output_path = await run_discovery(current_user.username, render_petri_net, source, scratch.path,
+                                                  algorithm.value, parameters)
+                cached_path = store_cached_model(cache_key, [output_path])
+        except HTTPException as e:
+            raise e
+        except ValueError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    return FileResponse(os.path.join(cached_path, "model.png"))
+
+
+# Discover a model and return it as JSON (nodes, arcs, frequencies and performance), nothing is rendered
+@router.post("/models/{kind}")
+async def discover_model_json(kind: Model_Kind,
+                              current_user: Annotated[User_Model, Depends(get_current_active_user)],
+                              algorithm: Discovery_Algorithm = Discovery_Algorithm.inductive,
+                              case_name: str = "client_id",
+                              concept_name: str = "action",
+                              timestamp: str = 'timestamp', separator: str = ";",
+                              noise_threshold: float = Query(0, ge=0, le=1),
+                              dependency_threshold: float = Query(0.5, ge=0, le=1),
+                              and_threshold: float = Query(0.65, ge=0, le=1),
+                              loop_two_threshold: float = Query(0.5, ge=0, le=1),
+                              collection: str | None = None,
+                              cluster_id: int | None = None,
+                              tags: list[str] | None = Query(None),
+                              file: UploadFile | None = File(None)):
+    """
+    Discover a directly-follows graph, a heuristics net or a petri net, returned as JSON for the clients drawing
+    the models themselves. Its image is rendered on demand by /discovery/models/{model_id}/render
+    Args:
+        kind: dfg, heuristics_net or petri_net
+        algorithm: discovery algorithm of the petri net (alpha, alpha_plus, heuristic, inductive or dfg)
+        separator,timestamp, concept_name,case_name: columns of the csv file
+        noise_threshold: parameter of the inductive miner
+        dependency_threshold, and_threshold, loop_two_threshold: parameters of the heuristic miner
+        file: csv or xes log file
+        collection: or the log collection to mine, filtered on cluster_id and tags (activities) if given
+    Returns:
+        the model_id, the kind of the model, its nodes and its arcs
+    """
+    if (file is None) == (collection is None):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Send either a log file or the name of a collection")
+    if kind == Model_Kind.heuristics_net:
+        algorithm = Discovery_Algorithm.heuristic
+    parameters = {} if kind == Model_Kind.dfg else algorithm_parameters(
+        algorithm, noise_threshold, dependency_threshold, and_threshold, loop_two_threshold)
+
+    try:
+        async with workspace() as scratch:
+            if collection is not None:
+                source = await collection_log_source(current_user.username, collection, cluster_id, tags)
+            else:
+                file_path = scratch.file("log" + os.path.splitext(file.filename)[1].lower())
+                source = {"file_path": file_path, "file_hash": await save_upload_file(file, file_path),
+                          "columns": log_columns(case_name, concept_name, timestamp, separator)}
+            model_id = model_cache_key(parsed_log_key(source), "model", kind.value,
+                                       algorithm.value if kind == Model_Kind.petri_net else None, parameters)
+            model_dir = get_cached_model(model_id)
+            if model_dir is None:
+                model_path = await run_discovery(current_user.username, discover_model, source, scratch.path,
+                                                 kind.value, algorithm.value, parameters)
+                model_dir = store_cached_model(model_id, [model_path])
+        with open(os.path.join(model_dir, "model.json")) as model_file:
+            return {"model_id": model_id, **json.load(model_file)}
+    except HTTPException as e:
+        raise e
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+# Get a model discovered by /discovery/models/{kind}, as long as it is in the models cache
+@router.get("/models/{model_id}")
+async def get_model_json(model_id: str, current_user: Annotated[User_Model, Depends(get_current_active_user)]):
+    model_dir = get_cached_model(model_id) if model_id.isalnum() else None
+    if model_dir is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Model not found, discover it again")
+    return FileResponse(os.path.join(model_dir, "model.json"), media_type="application/json")
+
+
+# Render the image of a model, the image is cached with the model for each format and pruning
+@router.get("/models/{model_id}/render")
+async def render_model_image(model_id: str, current_user: Annotated[User_Model, Depends(get_current_active_user)],
+                             image_format: Image_Format = Image_Format.svg,
+                             min_frequency: int = Query(0, ge=0),
+                             max_arcs: int | None = Query(None, ge=0),
+                             performance: bool = False):
+    """
+    Args:
+        model_id: the id returned by /discovery/models/{kind}
+        image_format: svg or png
+        min_frequency: drop the arcs less frequent than min_frequency before rendering
+        max_arcs: then only keep the max_arcs most frequent arcs (the arcs of a petri net are never dropped)
+        performance: label the arcs of a dfg with the mean time between the activities instead of their frequency
+    Returns:
+        the image of the model
+    """
+    model_dir = get_cached_model(model_id) if model_id.isalnum() else None
+    if model_dir is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Model not found, discover it again")
+    output_path = model_render_path(model_dir, image_format.value, min_frequency, max_arcs, performance)
+    if not os.path.exists(output_path):
+        try:
+            output_path = await run_discovery(current_user.username, render_model, model_dir, image_format.value,
+                                              min_frequency, max_arcs, performance)
+        except HTTPException as e:
+            raise e
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Model not found, discover it again")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    return FileResponse(output_path, media_type="image/svg+xml" if image_format == Image_Format.svg else "image/png")
+
+
+# Submit a discovery job, the model and its quality are computed in the background
+@router.post("/jobs/", status_code=status.HTTP_202_ACCEPTED)
+async def submit_discovery_job(current_user: Annotated[User_Model, Depends(get_current_active_user)],
+                               algorithm: Discovery_Algorithm,
+                               fitness_approach: Quality_Type,
+                               precision_approach: Quality_Type,
+                               sampling: Annotated[dict | None, Depends(quality_sampling)],
+                               case_name: str = "client_id",
+                               concept_name: str = "action",
+                               timestamp: str = 'timestamp', separator: str = ";",
+                               noise_threshold: float = Query(0, ge=0, le=1),
+                               dependency_threshold: float = Query(0.5, ge=0, le=1),
+                               and_threshold: float = Query(0.65, ge=0, le=1),
+                               loop_two_threshold: float = Query(0.5, ge=0, le=1),
+                               collection: str | None = None,
+                               cluster_id: int | None = None,
+                               tags: list[str] | None = Query(None),
+                               file: UploadFile | None = File(None)):
+    """
+    Discover a petri net and measure its quality in a background job, the request returns at once
+    Args:
+        algorithm: alpha, alpha_plus, heuristic, inductive or dfg
+        fitness_approach, precision_approach: chosing if token based or alignement based approach
+        separator,timestamp, concept_name,case_name: columns of the csv file
+        noise_threshold: parameter of the inductive miner
+        dependency_threshold, and_threshold, loop_two_threshold: parameters of the heuristic miner
+        file: csv or xes log file
+        collection: or the log collection to mine, filtered on cluster_id and tags (activities) if given
+    Returns:
+        the id of the job, to follow it on /discovery/jobs/{job_id}
+        code: 202
+    """
+    if (file is None) == (collection is None):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Send either a log file or the name of a collection")
+    parameters = algorithm_parameters(algorithm, noise_threshold, dependency_threshold, and_threshold,
+                                      loop_two_threshold)
+    if collection is not None:
+        source = await collection_log_source(current_user.username, collection, cluster_id, tags)
+
+    job = await create_discovery_job(current_user.username, algorithm.value, parameters,
+                                     fitness_approach.value, precision_approach.value, collection,
+                                     sampling)
+    if file is not None:
+        file_path = os.path.join(discovery_job_dir(job.job_id), "log" + os.path.splitext(file.filename)[1].lower())
+        file_hash = await save_upload_file(file, file_path)
+        source = {"file_path": file_path, "file_hash": file_hash,
+                  "columns": log_columns(case_name, concept_name, timestamp, separator)}
+    start_discovery_job(job, source)
+    return {"job_id": job.job_id, "status": job.status}
+
+
+# Get the phase of a discovery job and the quality of its model once it is done
+@router.get("/jobs/{job_id}", status_code=status.HTTP_200_OK)
+async def get_discovery_job_status(job_id: str, current_user: Annotated[User_Model, Depends(get_current_active_user)]
+                                   ) -> Discovery_Job_Model:
+    """
+    Returns:
+        Discovery_Job_Model: the status and the phase (read, mine, fitness, precision, render) of the job,
+            the time elapsed since it started, and once it is done the quality and the files of the model
+    """
+    job = await get_discovery_job(current_user.username, job_id)
+    if not job:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job doesn't exist")
+    return job
+
+
+# Download a file of a finished discovery job: model.png, model.pnml or quality.json
+@router.get("/jobs/{job_id}/files/{filename}")
+async def download_discovery_job_file(job_id: str, filename: str,
+                                      current_user: Annotated[User_Model, Depends(get_current_active_user)]):
+    job = await get_discovery_job(current_user.username, job_id)
+    if not job:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job doesn't exist")
+    if filename not in job["files"]:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
+    return FileResponse(os.path.join(discovery_job_dir(job_id), filename), filename=filename)
+
+
+# Download all the files of a finished discovery job in a zip file
+@router.get("/jobs/{job_id}/download")
+async def download_discovery_job(job_id: str, current_user: Annotated[User_Model, Depends(get_current_active_user)]):
+    job = await get_discovery_job(current_user.username, job_id)
+    if not job:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job doesn't exist")
+    if job["status"] != JobStatus.done.value:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"The job is {job['status']}")
+    if not job["files"]:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="The files of the job have been deleted")
+
+    zip_path = os.path.join(discovery_job_dir(job_id), "Model_Quality.zip")
+    if not os.path.exists(zip_path):
+        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            for filename in job["files"]:
+                zip_file.write(os.path.join(discovery_job_dir(job_id), filename), filename)
+    return FileResponse(zip_path, media_type="application/zip", filename="Model_Quality.zip")
+
+
+# Cancel a discovery job, its process is stopped and its files are deleted
+@router.delete("/jobs/{job_id}", status_code=status.HTTP_200_OK)
+async def cancel_job(job_id: str, current_user: Annotated[User_Model, Depends(get_current_active_user)]):
+    job = await get_discovery_job(current_user.username, job_id)
+    if not job:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job doesn't exist")
+    await cancel_discovery_job(job_id)
+    return {"message": "Job cancelled and its files deleted"}
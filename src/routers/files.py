@@ -1,154 +1,144 @@
 # import aiofiles
-import json
 import os
+import uuid
 
-import pandas as pd
-from parser.main import parser, csv_parser
 from parser.models.csv_parameters import CsvParameters
 from parser.models.parameters import Parameters
 from typing import Annotated
 
 from fastapi import APIRouter, Depends, HTTPException, UploadFile, status
+from fastapi.encoders import jsonable_encoder
 
 from ..collection_utils import collection_exists, get_hashed_files
-from ..client_utils import get_clients_from_collection, post_clients_in_collection
-from ..database.config import user_collection
+from ..jobs_utils import create_ingestion_job, parse_csv_file, parse_log_file, start_ingestion_job
 from ..models.users import User_Model
 from ..security import get_current_active_user
 from ..users_utils import user_exists
-from ..utils import compute_sha256
-from .collection import purge_collection
+from ..utils import save_upload_file
 
 # Router to handle the logs
 router = APIRouter(prefix="/files", tags=["files"])
 
 
-@router.post("/", status_code=status.HTTP_201_CREATED)
+async def save_files_to_parse(files: list[UploadFile], username: str, collection: str):
+    """Function to write the uploaded files in the temp directory and skip the files already parsed
+
+    Args:
+        files (list[UploadFile]): the uploaded files
+        username (str): owner of the collection
+        collection (str): name of the collection
+
+    Returns:
+        tuple: the (name, path, hash) of the files to parse and the names of the files already parsed
+    """
+    list_file_deleted = []
+    list_file_write = []
+    hashed_files = set(await get_hashed_files(username, collection))
+    for file in files:
+        # Prefix the file to avoid collisions between the uploads being parsed
+        file_path = "temp/" + uuid.uuid4().hex + "_" + file.filename  # type: ignore
+        # Stream the file in the log directory, hashing it on the way
+        file_hash = await save_upload_file(file, file_path)
+
+        # check if file have already been parsed
+        if file_hash in hashed_files:
+            os.remove(file_path)
+            list_file_deleted.append(file.filename)
+        else:
+            hashed_files.add(file_hash)
+            list_file_write.append((file.filename, file_path, file_hash))
+
+    # If all files have already been parsed, return an error
+    if not list_file_write:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="All files have already been parsed",
+        )
+    return list_file_write, list_file_deleted
+
+
+@router.post("/", status_code=status.HTTP_202_ACCEPTED)
 async def post_log_file(
         files: list[UploadFile],
         collection: str,
-        current_user: Annotated[User_Model, Depends(get_current_active_user)]
+        current_user: Annotated[User_Model, Depends(get_current_active_user)],
+        incremental: bool = True
 ):
     """Route to send logs files to the server and add it to the collection(once parsed)
+        The files are parsed in the background, the progress is available on /jobs/{job_id}
 
 
     Args:
         files (list[UploadFile]): A list of file to parse
         collection (str): name of the collection
+        incremental (bool): only upsert the clients found in the new files instead of
+            rewriting the whole collection
 
     Returns:
-        dict: A report of the files added to the collection
-        code: 201
+        dict: The id of the ingestion job and a report of the files queued
+        code: 202
     """
     # Check if the user exist
     await user_exists(current_user.username)
     # Check if the collection exist
-    collection_db = await collection_exists(current_user.username, collection)
+    await collection_exists(current_user.username, collection)
     # Check if at least one file is provided
-    if not files.__contains__:
+    if not files:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="No file provided"
         )
 
-    list_file_deleted = []
-    list_file_write = []
     tmp = Parameters(
         parser_type="custom",
         parser_format='%h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-Agent}i"',
     )
-    for file in files:
-        file_path = "temp/" + file.filename  # type: ignore
-        # Write the file in the log directory
-        with open(file_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
+    list_file_write, list_file_deleted = await save_files_to_parse(files, current_user.username, collection)
 
-        file_hash = await compute_sha256(file_path)
-
-        # check if file have already been parsed
-        if file_hash in await get_hashed_files(current_user.username, collection):
-            list_file_deleted.append(file.filename)
-        else:
-            # Parse the file
-
-            list_client = await get_clients_from_collection(collection_db)
-
-            list_client = await parser(
-                file=file_path, collection=list_client, parameters=tmp  # type: ignore
-            )
-
-            # Remove the old clients from the collection
-            await purge_collection(collection)
-            # Add the client (old and new) to the collection
-            await post_clients_in_collection(list_client, collection_db)  # type: ignore
-            os.remove(file_path)
-
-            # add the file to the hash list
-            await user_collection.update_one(
-                {"username": current_user.username, "collections.name": collection},
-                {
-                    "$push": {"collections.$.files_hash": file_hash},
-                    "$set": {"collections.$.file_name": file.filename},
-                },
-                upsert=False
-            )
-            list_file_write.append(file.filename)
-
-    # If all files have already been parsed, return an error
-    if not list_file_write:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="All files have already been parsed",
-        )
-    # Else, return a report
-    else:
-        return {
-            "message": "File(s) added to the collection",
-            "files added to the collection": list_file_write,
-            "files already in the collection": list_file_deleted,
-        }
+    job = await create_ingestion_job(current_user.username, collection, list_file_write, list_file_deleted)
+    start_ingestion_job(job, list_file_write, parse_log_file, tmp.dict(), incremental)
+    return {
+        "message": "File(s) queued to be added to the collection",
+        "job_id": job.job_id,
+        "files queued": job.files,
+        "files already in the collection": list_file_deleted,
+    }
 
 
 # Route for CSV parser (TEST)
-@router.post("/csv", status_code=status.HTTP_201_CREATED)
+@router.post("/csv", status_code=status.HTTP_202_ACCEPTED)
 async def post_csv_file(
         files: list[UploadFile],
         collection: str,
         current_user: Annotated[User_Model, Depends(get_current_active_user)],
         timestamp_column: str= "Time",timestamp_format: str= "%Y-%m-%d %H:%M:%S",
-        action_column: str= "Event name", session_id_column: str="moodleUserId",separator: str = ","
-
+        action_column: str= "Event name", session_id_column: str="moodleUserId",separator: str = ",",
+        incremental: bool = True
 ):
     """Route to send logs files to the server and add it to the collection(once parsed)
+        The files are validated and parsed in the background, the progress and the errors
+        are available on /jobs/{job_id}
 
     Args:
         current_user:
         tmp:
         files (list[UploadFile]): A list of file to parse
         collection (str): name of the collection
+        incremental (bool): only upsert the clients found in the new files instead of
+            rewriting the whole collection
 
     Returns:
-        dict: A report of the files added to the collection
-        code: 201
+        dict: The id of the ingestion job and a report of the files queued
+        code: 202
     """
-    # Check if the user exist
-    print('!!!!!!!!!!! CSV PARSER !!!!!!!!')
-
     await user_exists(current_user.username)
     # Check if the collection exist
-    collection_db = await collection_exists(current_user.username, collection)
+    await collection_exists(current_user.username, collection)
     # Check if at least one file is provided
-    if not files.__contains__:
+    if not files:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="No file provided"
         )
 
-    list_file_deleted = []
-    list_file_write = []
-    # tmp = Parameters(
-    #     parser_type="custom",
-    #     parser_format='%h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-Agent}i"',
-    # )
     tmp = CsvParameters(
         separator=separator,
         timestamp_column=timestamp_column,
@@ -157,74 +147,17 @@ async def post_csv_file(
         session_id_column=session_id_column,
         session_time_limit=3600,
     )
+    list_file_write, list_file_deleted = await save_files_to_parse(files, current_user.username, collection)
 
-    for file in files:
-        file_path = "temp/" + file.filename  # type: ignore
-        # Write the file in the log directory
-        with open(file_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
-
-        file_hash = await compute_sha256(file_path)
-        print(file.filename)
-        # check if file have already been parsed
-        if file_hash in await get_hashed_files(current_user.username, collection):
-            list_file_deleted.append(file.filename)
-        else:
-            try:
-                # Read the CSV file
-                df = pd.read_csv(file_path, sep=separator)
-
-                # Validate the date format
-                pd.to_datetime(df[timestamp_column], format=timestamp_format)
-
-            except ValueError as e:
-                os.remove(file_path)
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                                    detail=f"Date format or column name error in file {file.filename}.")
-            except Exception as e:
-                os.remove(file_path)
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                                    detail=f"Error reading CSV file {file.filename}, wrong separator. {e}")
-
-            # Parse the file
-
-            list_client = await get_clients_from_collection(collection_db)
-
-            list_client = csv_parser(
-                file=file_path, collection=list_client, parameters=tmp  # type: ignore
-            )
-            # Remove the old clients from the collection
-            await purge_collection(collection)
-            # Add the client (old and new) to the collection
-            await post_clients_in_collection(list_client, collection_db)  # type: ignore
-            os.remove(file_path)
-
-            # add the file to the hash list
-            await user_collection.update_one(
-                {"username": current_user.username, "collections.name": collection},
-                {
-                    "$push": { "collections.$.files_hash": file_hash},
-                "$set": {"collections.$.file_name": file.filename,
-                         "collections.$.timestamp_format": timestamp_format},
-                },
-                upsert=False
-            )
-            list_file_write.append(file.filename)
-
-    # If all files have already been parsed, return an error
-    if not list_file_write:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="All files have already been parsed",
-        )
-    # Else, return a report
-    else:
-        return {
-            "message": "File(s) added to the collection",
-            "files added to the collection": list_file_write,
-            "files already in the collection": list_file_deleted,
-        }
+    job = await create_ingestion_job(current_user.username, collection, list_file_write, list_file_deleted)
+    start_ingestion_job(job, list_file_write, parse_csv_file, tmp.dict(), incremental,
+                        {"timestamp_format": timestamp_format})
+    return {
+        "message": "File(s) queued to be added to the collection",
+        "job_id": job.job_id,
+        "files queued": job.files,
+        "files already in the collection": list_file_deleted,
+    }
 
 
 @router.get("/json", status_code=status.HTTP_200_OK)
@@ -244,7 +177,7 @@ async def get_json_from_collection(
     collection_db = await collection_exists(current_user.username, collection)
     json_obj = []
     async for doc in collection_db.find({}, {"_id": 0}):  # type: ignore
-        json_obj.append(json.loads(json.dumps(doc)))
+        json_obj.append(jsonable_encoder(doc))
     # if json is empty, return an error
     if not json_obj:
         raise HTTPException(
@@ -0,0 +1,29 @@
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, HTTPException, status
+
+from ..jobs_utils import get_ingestion_job
+from ..models.jobs import Ingestion_Job_Model
+from ..models.users import User_Model
+from ..security import get_current_active_user
+
+router = APIRouter(prefix="/jobs", tags=["jobs"])
+
+
+# Get the progress of an ingestion job
+@router.get("/{job_id}", status_code=status.HTTP_200_OK, description="Get the progress of a log ingestion job")
+async def get_job(job_id: str, current_user: Annotated[User_Model, Depends(get_current_active_user)])->Ingestion_Job_Model:
+    """This route allows to follow the parsing of the files sent to /files/ or /files/csv
+
+    Args:
+        job_id (str): id of the job returned by the upload route
+
+    Returns:
+        Ingestion_Job_Model: The status of the job, the bytes processed, the clients created and the errors
+        code: 200
+    """
+    job = await get_ingestion_job(current_user.username, job_id)
+    if not job:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Job doesn't exist")
+    return job
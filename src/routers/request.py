@@ -6,6 +6,7 @@ from ..security import get_current_active_user
 
 from ..collection_utils import collection_exists
 from ..users_utils import user_exists
+from ..utils import day_interval_to_utc
 
 router = APIRouter(prefix="/requests", tags=["requests"])
 
@@ -103,44 +104,60 @@ async def get_city_requests(collection: str, city_name: str, current_user: Annot
     return requests
 
 
+def requests_in_interval_pipeline(start: datetime, end: datetime) -> list:
+    """Pipeline returning the clients having requests in [start, end[ with only these requests
+        The $match runs on the multikey index of sessions.requests.request_time
+    """
+    in_interval = {"$and": [
+        {"$gte": ["$$request.request_time", start]},
+        {"$lt": ["$$request.request_time", end]},
+    ]}
+    return [
+        {"$match": {"sessions.requests.request_time": {"$gte": start, "$lt": end}}},
+        {"$set": {"sessions": {"$filter": {
+            "input": {"$map": {
+                "input": "$sessions",
+                "as": "session",
+                "in": {"$mergeObjects": ["$$session", {"requests": {"$filter": {
+                    "input": "$$session.requests",
+                    "as": "request",
+                    "cond": in_interval,
+                }}}]},
+            }},
+            "as": "session",
+            "cond": {"$ne": ["$$session.requests", []]},
+        }}}},
+        {"$project": {"_id": 0}},
+    ]
+
+
 # Get all requests for a specific date
 @router.get("/req_date/", status_code=status.HTTP_200_OK, description="Get the informations of all clients's requests for a giving date (ex date: 2017-03-31)")
-async def get_requests_by_date(collection: str, request_date: date, current_user: Annotated[User_Model, Depends(get_current_active_user)])->list:
+async def get_requests_by_date(
+    collection: str, request_date: date, current_user: Annotated[User_Model, Depends(get_current_active_user)],
+    timezone: str = "UTC")->list:
     """This route allows to retrieve athe informations of all clients's requests for a giving date
 
     Args:
         collection (str): name of the collection containing the clients's logs
         request_date (date): the date to retrieve the requests for
+        timezone (str): the timezone of the date (ex: Europe/Paris), UTC by default
 
     Returns:
-        list: The list of the client's requests
+        list: The list of the clients with only their requests of this date
         code: 200
     """
     collection_db = await collection_exists(current_user.username, collection)
-    date_format = "%Y-%m-%d %H:%M:%S%z"
     try:
-        start_date = datetime.strptime(
-            str(request_date) + " 00:00:00+02:00", date_format
-        )
-        end_date = datetime.strptime(str(request_date) + " 23:59:59+02:00", date_format)
-        start_date = start_date.strftime("%Y-%m-%dT%H:%M:%S%z")
-        end_date = end_date.strftime("%Y-%m-%dT%H:%M:%S%z")
-        requests = [
-            request
-            async for request in collection_db.find(
-                {
-                    "sessions.requests.request_time": {
-                        "$gte": start_date,
-                        "$lte": end_date,
-                    }
-                },
-                {"_id": 0},
-            )
-        ]
-    except ValueError:
+        start_date, end_date = day_interval_to_utc(request_date, request_date, timezone)
+    except ValueError as e:
         raise HTTPException(
-            status_code=status.HTTP_501_NOT_IMPLEMENTED, detail="Invalid date format"
+            status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)
         )
+    requests = [
+        request
+        async for request in collection_db.aggregate(requests_in_interval_pipeline(start_date, end_date))
+    ]
     if not requests:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -152,30 +169,30 @@ async def get_requests_by_date(collection: str, request_date: date, current_user
 # Get all requests for a specific date interval
 @router.get("/date_interval/", status_code=status.HTTP_200_OK, description="Get the informations of all clients's requests for a giving date interval (ex date: 2017-03-31)")
 async def get_requests_by_date_interval(
-    collection: str, start_date: date, end_date: date, current_user: Annotated[User_Model, Depends(get_current_active_user)])->list:
+    collection: str, start_date: date, end_date: date, current_user: Annotated[User_Model, Depends(get_current_active_user)],
+    timezone: str = "UTC")->list:
     """This route allows to retrieve athe informations of all clients's requests for a giving date interval
 
     Args:
         collection (str): name of the collection containing the clients's logs
         start_date (str): the start date of the interval
-        end_date (str): the end date of the interval
+        end_date (str): the end date of the interval (included)
+        timezone (str): the timezone of the dates (ex: Europe/Paris), UTC by default
 
     Returns:
-        list: The list of the client's requests
+        list: The list of the clients with only their requests of this interval
         code: 200
     """
     collection_db = await collection_exists(current_user.username, collection)
-    date_format = "%Y-%m-%d %H:%M:%S%z"
-    start_date = datetime.strptime(str(start_date) + " 00:00:00+0200", date_format)
-    end_date = datetime.strptime(str(end_date) + " 23:59:59+0200", date_format)
-    start_date = start_date.strftime("%Y-%m-%dT%H:%M:%S%z")
-    end_date = end_date.strftime("%Y-%m-%dT%H:%M:%S%z")
+    try:
+        start, end = day_interval_to_utc(start_date, end_date, timezone)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)
+        )
     requests = [
         request
-        async for request in collection_db.find(
-            {"sessions.requests.request_time": {"$gte": start_date, "$lte": end_date}},
-            {"_id": 0},
-        )
+        async for request in collection_db.aggregate(requests_in_interval_pipeline(start, end))
     ]
     if not requests:
         raise HTTPException(
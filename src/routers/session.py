@@ -1,21 +1,70 @@
 import io
 from collections import defaultdict
-from datetime import datetime
 from fastapi import APIRouter, Body, Depends, File, HTTPException, Query, Request, status, UploadFile
 from fastapi.responses import StreamingResponse
-from typing import Annotated, List, Dict, Any, Counter
+from typing import Annotated, List, Dict, Any
 from statistics import mean
 import matplotlib.pyplot as plt
+from ..cache_utils import cached_statistic
 from ..collection_utils import collection_exists
+from ..events_utils import get_events_collection
+from ..stats_utils import get_collection_profile
 from ..models.users import User_Model
 from ..security import get_current_active_user
-from ..models.response_parameters import ClientSessionDurationResponse, ActionFrequencyResponse
+from ..models.response_parameters import ActionFrequencyResponse
+from ..utils import to_utc_datetime
 
 router = APIRouter(
     prefix="/log/stats",
     tags=["LogStats"]
 )
 
+
+async def get_requests_source(username: str, collection: str, collection_db):
+    """Function to get where the requests of a collection are aggregated from
+
+    Returns:
+        tuple: the collection to aggregate, the stages giving one document per request
+            and the expression of the action (request url) in these documents
+    """
+    events_db = await get_events_collection(username, collection)
+    if events_db is not None:
+        return events_db, [], "$action"
+    return collection_db, [{"$unwind": "$sessions"}, {"$unwind": "$sessions.requests"}], "$sessions.requests.request_url"
+
+
+async def get_overall_actions(username: str, collection: str, collection_db) -> Dict[str, int]:
+    """Function to count the occurrence of each action of a collection on the server
+
+    Returns:
+        Dict[str, int]: the occurrence of each action, sorted in descending order
+    """
+    async def compute():
+        source, pipeline, action_field = await get_requests_source(username, collection, collection_db)
+        try:
+            overall_actions = {
+                action["_id"]: action["count"]
+                async for action in source.aggregate(
+                    pipeline + [{"$sortByCount": action_field}],
+                    allowDiskUse=True,
+                )
+            }
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"Error retrieving sessions: {str(e)}"
+            )
+
+        if not overall_actions:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="No sessions found"
+            )
+        return overall_actions
+
+    return await cached_statistic(collection, "overall_actions", (), compute)
+
+
 @router.get(
     "/traces_duration",
     status_code=status.HTTP_200_OK,
@@ -44,59 +93,9 @@ async def get_traces_duration(
             detail=f"Error accessing collection: {str(e)}"
         )
 
-    try:
-        sessions = [
-            request
-            async for request in collection_db.find(
-                {},
-                {"_id": 0, "client_id": 1, "sessions.requests": 1}
-            )
-        ]
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error retrieving sessions: {str(e)}"
-        )
-
-    if not sessions:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="No sessions found"
-        )
-
-    client_durations = {}
-    for session in sessions:
-        client_id = session['client_id']
-        if client_id not in client_durations:
-            client_durations[client_id] = []
-
-        for sess in session['sessions']:
-            try:
-                request_times = [datetime.fromisoformat(req['request_time']) for req in sess['requests']]
-                client_durations[client_id].extend(request_times)
-            except Exception as e:
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail=f"Error processing session for client {client_id}: {str(e)}"
-                )
-
-    client_total_durations = []
-    for client_id, times in client_durations.items():
-        if times:
-            total_duration = max(times) - min(times)
-
-            total_duration_days = total_duration.total_seconds() / (24 * 3600)
-            total_duration_weeks = total_duration_days / 7
-            client_total_durations.append(
-                ClientSessionDurationResponse(
-                    client_id=client_id,
-                    total_duration_seconds=total_duration.total_seconds(),
-                    total_duration_days=total_duration_days,
-                    total_duration_weeks=total_duration_weeks
-                )
-            )
-
-    return client_total_durations
+    events_db = await get_events_collection(current_user.username, collection)
+    profile = await get_collection_profile(collection_db, events_db)
+    return profile.client_durations()
 
 @router.get("/actions_count", status_code=status.HTTP_200_OK,
             description="Counts the occurence of all the actions for a specific client")
@@ -181,53 +180,39 @@ async def get_actions_frequency_trace(
             detail=f"Error accessing collection: {str(e)}"
         )
 
-    try:
-        sessions = [
-            request
-            async for request in collection_db.find(
-                {},
-                {"_id": 0, "client_id": 1, "sessions.requests": 1}
-            )
-        ]
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error retrieving sessions: {str(e)}"
-        )
-
-    if not sessions:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="No sessions found"
-        )
-
-    client_actions = {}
-    for session in sessions:
-        client_id = session['client_id']
-        if client_id not in client_actions:
-            client_actions[client_id] = Counter()
-
-        for sess in session['sessions']:
-            try:
-                actions = [req['request_url'] for req in sess['requests']]
-                client_actions[client_id].update(actions)
-            except Exception as e:
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail=f"Error processing session for client {client_id}: {str(e)}"
+    async def compute():
+        source, pipeline, action_field = await get_requests_source(current_user.username, collection, collection_db)
+        try:
+            client_action_frequencies = [
+                {
+                    "client_id": client["_id"],
+                    # Sorted by frequency in descending order by the pipeline
+                    "action_frequency": {action["action"]: action["count"] for action in client["actions"]},
+                }
+                async for client in source.aggregate(
+                    pipeline + [
+                        {"$group": {"_id": {"client_id": "$client_id", "action": action_field}, "count": {"$sum": 1}}},
+                        {"$sort": {"count": -1}},
+                        {"$group": {"_id": "$_id.client_id", "actions": {"$push": {"action": "$_id.action", "count": "$count"}}}},
+                    ],
+                    allowDiskUse=True,
                 )
+            ]
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"Error retrieving sessions: {str(e)}"
+            )
 
-    client_action_frequencies = []
-    for client_id, action_counter in client_actions.items():
-        # Sort the action frequencies by frequency in ascending order
-        sorted_actions = dict(sorted(action_counter.items(), key=lambda item: item[1], reverse=True))
+        if not client_action_frequencies:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="No sessions found"
+            )
 
-        client_action_frequencies.append({
-            "client_id": client_id,
-            "action_frequency": sorted_actions
-        })
+        return client_action_frequencies
 
-    return client_action_frequencies
+    return await cached_statistic(collection, "action_frequencies", (), compute)
 
 @router.get(
     "/total_actions_occurrence",
@@ -255,53 +240,14 @@ async def get_total_actions_occurrence(
             detail=f"Error accessing collection: {str(e)}"
         )
 
-    try:
-        sessions = [
-            request
-            async for request in collection_db.find(
-                {},
-                {"_id": 0, "client_id": 1, "sessions.requests": 1}
-            )
-        ]
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error retrieving sessions: {str(e)}"
-        )
-
-    if not sessions:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="No sessions found"
-        )
-
-    client_actions = {}
-    overall_actions = Counter()
-
-    for session in sessions:
-        client_id = session['client_id']
-        if client_id not in client_actions:
-            client_actions[client_id] = Counter()
-
-        for sess in session['sessions']:
-            try:
-                actions = [req['request_url'] for req in sess['requests']]
-                client_actions[client_id].update(actions)
-                overall_actions.update(actions)
-            except Exception as e:
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail=f"Error processing session for client {client_id}: {str(e)}"
-                )
+    overall_actions = await get_overall_actions(current_user.username, collection, collection_db)
 
     total_actions = sum(overall_actions.values())
-    sorted_overall_actions = dict(sorted(overall_actions.items(), key=lambda item: item[1], reverse=True))
     return {
         "total_actions": total_actions,
-        "action_frequencies": sorted_overall_actions,
+        "action_frequencies": overall_actions,
     }
 
-
 @router.get(
     "/total_actions_percentage",
     status_code=status.HTTP_200_OK,
@@ -328,57 +274,17 @@ async def get_total_actions_percentage(
             detail=f"Error accessing collection: {str(e)}"
         )
 
-    try:
-        sessions = [
-            request
-            async for request in collection_db.find(
-                {},
-                {"_id": 0, "client_id": 1, "sessions.requests": 1}
-            )
-        ]
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error retrieving sessions: {str(e)}"
-        )
-
-    if not sessions:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="No sessions found"
-        )
-
-    client_actions = {}
-    overall_actions = Counter()
-
-    for session in sessions:
-        client_id = session['client_id']
-        if client_id not in client_actions:
-            client_actions[client_id] = Counter()
-
-        for sess in session['sessions']:
-            try:
-                actions = [req['request_url'] for req in sess['requests']]
-                client_actions[client_id].update(actions)
-                overall_actions.update(actions)
-            except Exception as e:
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail=f"Error processing session for client {client_id}: {str(e)}"
-                )
+    overall_actions = await get_overall_actions(current_user.username, collection, collection_db)
 
     total_actions = sum(overall_actions.values())
+    # The actions are already sorted by occurrence
     action_percentages = {action: f"{(count / total_actions) * 100:.2f}%" for action, count in overall_actions.items()}
 
-    sorted_action_percentages = dict(
-        sorted(action_percentages.items(), key=lambda item: float(item[1][:-1]), reverse=True))
-
     return {
         "total_actions": total_actions,
-        "action_percentages": sorted_action_percentages
+        "action_percentages": action_percentages
     }
 
-
 @router.get(
     "/trace_variants",
     status_code=status.HTTP_200_OK,
@@ -405,44 +311,45 @@ async def get_trace_variants(
             detail=f"Error accessing collection: {str(e)}"
         )
 
-    try:
-        sessions = [
-            request
-            async for request in collection_db.find(
-                {},
-                {"_id": 0, "sessions.requests": 1}
+    async def compute():
+        events_db = await get_events_collection(current_user.username, collection)
+        if events_db is not None:
+            source = events_db
+            pipeline = [
+                {"$sort": {"client_id": 1, "session_id": 1, "position": 1}},
+                {"$group": {"_id": {"client_id": "$client_id", "session_id": "$session_id"}, "actions": {"$push": "$action"}}},
+                {"$group": {"_id": "$actions"}},
+            ]
+        else:
+            # The urls of a session are grouped as an array, so each group is a variant
+            source = collection_db
+            pipeline = [
+                {"$unwind": "$sessions"},
+                {"$group": {"_id": "$sessions.requests.request_url"}},
+            ]
+        try:
+            trace_variants = [
+                tuple(variant["_id"])
+                async for variant in source.aggregate(pipeline, allowDiskUse=True)
+            ]
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"Error retrieving sessions: {str(e)}"
             )
-        ]
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error retrieving sessions: {str(e)}"
-        )
-
-    if not sessions:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="No sessions found"
-        )
 
-    trace_variants = set()
-
-    for session in sessions:
-        for sess in session['sessions']:
-            try:
-                actions = tuple(req['request_url'] for req in sess['requests'])
-                trace_variants.add(actions)
-            except Exception as e:
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail=f"Error processing session: {str(e)}"
-                )
+        if not trace_variants:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="No sessions found"
+            )
 
-    return {
-        "unique_variant_count": len(trace_variants),
-        "unique_variants": trace_variants
-    }
+        return {
+            "unique_variant_count": len(trace_variants),
+            "unique_variants": trace_variants
+        }
 
+    return await cached_statistic(collection, "trace_variants", (), compute)
 
 @router.get(
     "/distribution_activity_over_time",
@@ -496,7 +403,7 @@ async def distribution_activity_over_time(
         for sess in session['sessions']:
             try:
                 times_and_urls = [
-                    (datetime.fromisoformat(req['request_time']), req['request_url'])
+                    (to_utc_datetime(req['request_time']), req['request_url'])
                     for req in sess['requests']
                 ]
                 request_times.extend([time for time, url in times_and_urls])
@@ -8,6 +8,7 @@ from ..stats_utils import *
 from ..tags_utils import trace_handler
 from ..users_utils import user_exists
 from ..collection_utils import collection_exists
+from ..events_utils import get_events_collection
 from heapq import nlargest
 from heapq import nsmallest
 
@@ -95,16 +96,21 @@ async def get_number_of_request_for_a_tag(
         code: 200
     """
     collection_db = await collection_exists(current_user.username, collection)
+    events_db = await get_events_collection(current_user.username, collection)
+    if events_db is not None:
+        source, tag_field = events_db, "tag"
+        pipeline = []
+    else:
+        source, tag_field = collection_db, "sessions.requests.request_tag"
+        pipeline = [{"$unwind": "$sessions"}, {"$unwind": "$sessions.requests"}]
     stats = [
         stat
-        async for stat in collection_db.aggregate(
-            [
-                {"$unwind": "$sessions"},
-                {"$unwind": "$sessions.requests"},
-                {"$match": {"sessions.requests.request_tag": {'$regex': tag_name, "$options": "i" }}},
+        async for stat in source.aggregate(
+            pipeline + [
+                {"$match": {tag_field: {'$regex': tag_name, "$options": "i" }}},
                 {
                     "$group": {
-                        "_id": "$sessions.requests.request_tag",
+                        "_id": "$" + tag_field,
                         "Quantity": {"$count": {}},
                     }
                 },
@@ -134,15 +140,20 @@ async def get_requests_grouped_by_tag(collection: str, current_user: Annotated[U
         code: 200
     """
     collection_db = await collection_exists(current_user.username, collection)
+    events_db = await get_events_collection(current_user.username, collection)
+    if events_db is not None:
+        source, tag_field = events_db, "tag"
+        pipeline = []
+    else:
+        source, tag_field = collection_db, "sessions.requests.request_tag"
+        pipeline = [{"$unwind": "$sessions"}, {"$unwind": "$sessions.requests"}]
     stats = [
         stat
-        async for stat in collection_db.aggregate(
-            [
-                {"$unwind": "$sessions"},
-                {"$unwind": "$sessions.requests"},
+        async for stat in source.aggregate(
+            pipeline + [
                 {
                     "$group": {
-                        "_id": "$sessions.requests.request_tag",
+                        "_id": "$" + tag_field,
                         "Quantity": {"$count": {}},
                     }
                 },
@@ -184,16 +195,21 @@ async def get_number_of_request(collection: str, quantity: int, current_user: An
         code: 200
     """
     collection_db = await collection_exists(current_user.username, collection)
+    events_db = await get_events_collection(current_user.username, collection)
+    if events_db is not None:
+        source, tag_field, url_field = events_db, "tag", "action"
+        pipeline = []
+    else:
+        source, tag_field, url_field = collection_db, "sessions.requests.request_tag", "sessions.requests.request_url"
+        pipeline = [{"$unwind": "$sessions"}, {"$unwind": "$sessions.requests"}]
     stats = [
         stat
-        async for stat in collection_db.aggregate(
-            [
-                {"$unwind": "$sessions"},
-                {"$unwind": "$sessions.requests"},
-                {"$match": {"sessions.requests.request_tag": {"$ne": "Outliers"}}},
+        async for stat in source.aggregate(
+            pipeline + [
+                {"$match": {tag_field: {"$ne": "Outliers"}}},
                 {
                     "$group": {
-                        "_id": "$sessions.requests.request_url",
+                        "_id": "$" + url_field,
                         "Qte": {"$count": {}},
                     }
                 },
@@ -209,6 +225,29 @@ async def get_number_of_request(collection: str, quantity: int, current_user: An
     return stats[0]
 
 
+# Get all the statistics of a collection
+@router.get("/profile/", status_code=status.HTTP_200_OK, description="Get all the trace and action statistics of a collection, computed in a single pass")
+async def get_collection_profile_statistics(
+    collection: str, current_user: Annotated[User_Model, Depends(get_current_active_user)], number: int | None = 5)->dict:
+    """This route allows to get every statistic of a collection at once: the trace and action counts,
+        the popularity of the traces (variants) and actions, the most and less (number) popular ones,
+        the frequency and percentage of each request and the duration of each client's traces
+        The other statistics routes are views over the same result
+
+    Args:
+        collection (str): name of the target collection
+        number: the target (limit) number of most and less popular traces and actions
+
+    Returns:
+        dict: The profile of the collection
+        code: 200
+    """
+    collection_db = await collection_exists(current_user.username, collection)
+    events_db = await get_events_collection(current_user.username, collection)
+    profile = await get_collection_profile(collection_db, events_db)
+    return profile.summary(number)
+
+
 # Get a specific client's traces
 @router.get("/client_trace/", status_code=status.HTTP_200_OK, description="Get the traces for a giving client")
 async def get_client_trace(collection: str, client_id: str, current_user: Annotated[User_Model, Depends(get_current_active_user)])->list:
@@ -269,7 +308,8 @@ async def get_clients_traces(collection: str, current_user: Annotated[User_Model
         code: 200
     """
     collection_db = await collection_exists(current_user.username, collection)
-    return await get_traces(collection_db)
+    events_db = await get_events_collection(current_user.username, collection)
+    return await get_traces(collection_db, events_db)
 
 
 # Get unique trace number
@@ -286,13 +326,9 @@ async def get_unique_trace_number(collection: str, current_user: Annotated[User_
         code: 200
     """
     collection_db = await collection_exists(current_user.username, collection)
-    trace_list = await get_traces(collection_db)
-    unique_trace = list()
-    for trace in trace_list:
-        trace_tags = trace.split(";")[1]
-        if not unique_trace.__contains__(trace_tags):
-            unique_trace.append(trace_tags)
-    return {"Trace number": len(trace_list), "Unique Trace Number": len(unique_trace)}
+    events_db = await get_events_collection(current_user.username, collection)
+    trace_len, unique_trace = await unique_trace_number(collection_db, events_db)
+    return {"Trace number": trace_len, "Unique Trace Number": unique_trace}
 
 
 # Get popularity trace
@@ -308,8 +344,9 @@ async def get_popularity_trace(collection: str, current_user: Annotated[User_Mod
         code: 200
     """
     collection_db = await collection_exists(current_user.username, collection)
-    trace_list = await get_traces(collection_db)
-    return await get_popularity(trace_list)    
+    events_db = await get_events_collection(current_user.username, collection)
+    statistics = await get_trace_statistics(collection_db, events_db)
+    return statistics.trace_popularity()
 
 
 # Get most popular trace
@@ -327,8 +364,9 @@ async def get_most_popular_trace(
         code: 200
     """
     collection_db = await collection_exists(current_user.username, collection)
-    trace_list = await get_traces(collection_db)
-    popularity = await get_popularity(trace_list)
+    events_db = await get_events_collection(current_user.username, collection)
+    statistics = await get_trace_statistics(collection_db, events_db)
+    popularity = statistics.trace_popularity()
     return nlargest(number, popularity, key=popularity.get)
 
 
@@ -347,8 +385,9 @@ async def get_less_popular_trace(
         code: 200
     """
     collection_db = await collection_exists(current_user.username, collection)
-    trace_list = await get_traces(collection_db)
-    popularity = await get_popularity(trace_list)
+    events_db = await get_events_collection(current_user.username, collection)
+    statistics = await get_trace_statistics(collection_db, events_db)
+    popularity = statistics.trace_popularity()
     return nsmallest(number, popularity, key=popularity.get)
 
 
@@ -365,7 +404,8 @@ async def get_average_trace(collection: str, current_user: Annotated[User_Model,
         code: 200
     """
     collection_db = await collection_exists(current_user.username, collection)
-    trace_len, unique_trace = await unique_trace_number(collection_db)
+    events_db = await get_events_collection(current_user.username, collection)
+    trace_len, unique_trace = await unique_trace_number(collection_db, events_db)
     return {"Average ": trace_len / unique_trace}
 
 
@@ -382,7 +422,8 @@ async def get_stat_trace_string(collection: str, current_user: Annotated[User_Mo
         code: 200
     """
     collection_db = await collection_exists(current_user.username, collection)
-    trace_len, unique_trace = await unique_trace_number(collection_db)
+    events_db = await get_events_collection(current_user.username, collection)
+    trace_len, unique_trace = await unique_trace_number(collection_db, events_db)
     average = trace_len / unique_trace
     return {
         "Total": trace_len.__str__(),
@@ -404,7 +445,8 @@ async def get_clients_actions(collection: str, filename: str, current_user: Anno
         code: 200
     """
     collection_db = await collection_exists(current_user.username, collection)
-    clients_action = await get_clients_action(collection_db)
+    events_db = await get_events_collection(current_user.username, collection)
+    clients_action = await get_clients_action(collection_db, events_db)
     csv_file = await create_csv_file(clients_action,filename)
     response = FileResponse(csv_file, media_type="text/csv")
     response.headers["Content-Disposition"] = f"attachment; filename={filename}.csv"
@@ -425,7 +467,8 @@ async def get_unique_action_number(collection: str, current_user: Annotated[User
         code: 200
     """
     collection_db = await collection_exists(current_user.username, collection)
-    act_number, unique_action = await unique_action_infos(collection_db)
+    events_db = await get_events_collection(current_user.username, collection)
+    act_number, unique_action = await unique_action_infos(collection_db, events_db)
     return {"Action number": act_number, "Unique action Number": len(unique_action)}
 
 
@@ -442,8 +485,9 @@ async def get_popularity_action(collection: str, current_user: Annotated[User_Mo
         code: 200
     """
     collection_db = await collection_exists(current_user.username, collection)
-    action_list = await get_actions(collection_db)
-    return await popularity_action(action_list)
+    events_db = await get_events_collection(current_user.username, collection)
+    statistics = await get_trace_statistics(collection_db, events_db)
+    return statistics.action_popularity()
 
 
 # Get most popular action
@@ -461,8 +505,9 @@ async def get_most_popular_action(
         code: 200
     """
     collection_db = await collection_exists(current_user.username, collection)
-    action_list = await get_actions(collection_db)
-    popularity = await popularity_action(action_list)
+    events_db = await get_events_collection(current_user.username, collection)
+    statistics = await get_trace_statistics(collection_db, events_db)
+    popularity = statistics.action_popularity()
     return nlargest(number, popularity, key=popularity.get)
 
 
@@ -481,8 +526,9 @@ async def get_less_popular_action(
         code: 200
     """
     collection_db = await collection_exists(current_user.username, collection)
-    action_list = await get_actions(collection_db)
-    popularity = await popularity_action(action_list)
+    events_db = await get_events_collection(current_user.username, collection)
+    statistics = await get_trace_statistics(collection_db, events_db)
+    popularity = statistics.action_popularity()
     return nsmallest(number, popularity, key=popularity.get)
 
 # Get average action
@@ -498,7 +544,8 @@ async def get_average_action(collection: str, current_user: Annotated[User_Model
         code: 200
     """
     collection_db = await collection_exists(current_user.username, collection)
-    act_number, unique_action = await unique_action_infos(collection_db)
+    events_db = await get_events_collection(current_user.username, collection)
+    act_number, unique_action = await unique_action_infos(collection_db, events_db)
     return {"Average ": act_number / len(unique_action)}
 
 # Get action's number
@@ -514,7 +561,8 @@ async def get_action_number(collection: str, current_user: Annotated[User_Model,
         code: 200
     """
     collection_db = await collection_exists(current_user.username, collection)
-    act_number = await action_number(collection_db)
+    events_db = await get_events_collection(current_user.username, collection)
+    act_number = await action_number(collection_db, events_db)
     if act_number <= 0:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="No action found")
@@ -533,7 +581,8 @@ async def get_stat_action_string(collection: str, current_user: Annotated[User_M
         code: 200
     """
     collection_db = await collection_exists(current_user.username, collection)
-    act_number, unique_action = await unique_action_infos(collection_db)
+    events_db = await get_events_collection(current_user.username, collection)
+    act_number, unique_action = await unique_action_infos(collection_db, events_db)
     average = act_number / len(unique_action)
     return {
         "Total": act_number.__str__(),
@@ -4,6 +4,8 @@ import os
 from ..models.users import User_Model
 from ..security import get_current_active_user
 from ..collection_utils import collection_exists
+from ..cache_utils import bump_generation
+from ..events_utils import maintain_events
 from ..tags_utils import load_tag_config, save_tagged_logs
 from tagging.main import generate
 from tagging.utils import validate_json_content
@@ -39,6 +41,8 @@ async def generate_tags(tag_collection: str, log_collection: str, current_user:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_ERROR, detail="Error while generating the tags")
     await save_tagged_logs(logs_tagged, log_db)
+    await maintain_events(current_user.username, log_collection)
+    await bump_generation(log_collection)
 
     return {"message": "Tags successfully generated"}
 
@@ -1,39 +1,100 @@
 from fastapi import APIRouter, HTTPException, status, Depends
-from .tags_utils import trace_handler, trace_handler_action
+from .cache_utils import cached_statistic
+from .models.response_parameters import ClientSessionDurationResponse
+from .tags_utils import trace_handler_action
 from heapq import nlargest
 from heapq import nsmallest
+from collections import Counter
 import csv
+from .utils import to_utc_datetime
 
-async def get_traces(collection_db):
-    traces = [
-        trace_handler(trace)
-        async for trace in collection_db.aggregate(
+async def iter_traces(collection_db, events_db=None):
+    """Iterate over the traces (the tags of each session, without the outliers and the untagged requests)
+        of a collection
+
+    Yields:
+        tuple: the client_id and the list of the tags of a session
+    """
+    if events_db is not None:
+        # The events are sorted by the (client_id, session_id, position) index, $push keeps that order
+        async for trace in events_db.aggregate(
             [
-                {"$unwind": "$sessions"},
+                {"$match": {"tag": {"$nin": ["Outliers", None]}}},
+                {"$sort": {"client_id": 1, "session_id": 1, "position": 1}},
                 {
-                    "$project": {
-                        "_id": 0,
-                        "client_id": 1,
-                        "sessions.requests": {
-                            "$filter": {
-                                "input": "$sessions.requests",
-                                "as": "request",
-                                "cond": {"$ne": ["$$request.request_tag", "Outliers"]},
-                            }
-                        },
+                    "$group": {
+                        "_id": {"client_id": "$client_id", "session_id": "$session_id"},
+                        "tags": {"$push": "$tag"},
                     }
                 },
-                {"$match": {"sessions.requests": {"$ne": []}}},
-            ]
-        )
+            ],
+            allowDiskUse=True,
+        ):
+            yield trace["_id"]["client_id"], trace["tags"]
+        return
+    async for trace in collection_db.aggregate(
+        [
+            {"$unwind": "$sessions"},
+            {
+                "$project": {
+                    "_id": 0,
+                    "client_id": 1,
+                    "sessions.requests.request_tag": 1,
+                }
+            },
+            {
+                "$project": {
+                    "client_id": 1,
+                    "tags": {
+                        "$filter": {
+                            "input": "$sessions.requests.request_tag",
+                            "as": "tag",
+                            "cond": {"$not": {"$in": ["$$tag", ["Outliers", None]]}},
+                        }
+                    },
+                }
+            },
+            {"$match": {"tags": {"$ne": []}}},
+        ],
+        allowDiskUse=True,
+    ):
+        yield trace["client_id"], trace["tags"]
+
+async def get_traces(collection_db, events_db=None):
+    async def compute():
+        traces = [
+            f"{client_id};{','.join(tags)}"
+            async for client_id, tags in iter_traces(collection_db, events_db)
+        ]
+        if not traces:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="No data found"
+            )
+        return traces
+    return await cached_statistic(collection_db.name, "traces", (), compute)
+
+async def get_clients_action_from_events(events_db):
+    actions = [
+        [
+            event["client_id"],
+            event["tag"] if event.get("tag") is not None else event["action"],
+            event["time"],
+        ]
+        async for event in events_db.find(
+            {"tag": {"$ne": "Outliers"}},
+            {"_id": 0, "client_id": 1, "tag": 1, "action": 1, "time": 1},
+        ).sort([("client_id", 1), ("session_id", 1), ("position", 1)])
     ]
-    if not traces:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="No data found"
-        )
-    return traces
+    return [actions] if actions else []
 
-async def get_clients_action(collection_db):
+async def get_clients_action(collection_db, events_db=None):
+    if events_db is not None:
+        clients_action = await get_clients_action_from_events(events_db)
+        if not clients_action:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="No data found"
+            )
+        return clients_action
     clients_action = [
         trace_handler_action(trace)
         async for trace in collection_db.aggregate(
@@ -78,55 +139,182 @@ async def create_csv_file(clients_action:list(),filename:str):
                 writer.writerow(act)
     return file_path
 
-async def get_popularity(trace_list):
-    popularity = dict()
-    for trace in trace_list:
-        trace_tags = trace.split(";")[1]
-        if not popularity.keys().__contains__(trace_tags):
-            popularity[trace_tags] = 1
-        else:
-            popularity[trace_tags] += 1
-    return popularity
-
-async def unique_trace_number(collection_db):
-    trace_list = await get_traces(collection_db)
-    unique_trace = list()
-    for trace in trace_list:
-        trace_tags = trace.split(";")[1]
-        if not unique_trace.__contains__(trace_tags):
-            unique_trace.append(trace_tags)
-    return len(trace_list), len(unique_trace)
-
-async def get_actions(collection_db):
-    trace_list = await get_traces(collection_db)
-    action_list = list()
-    for trace in trace_list:
-        action_list.extend(trace.split(";")[1].split(","))
-    return action_list
-        
+class TraceStatistics:
+    """Counts of the traces and the actions of a collection, computed in a single pass
+        Each action is interned once as an integer id and each trace is encoded as a tuple of ids,
+        so counting the variants and the actions only hashes tuples and small integers
+    """
+
+    def __init__(self):
+        self.actions = []
+        self.action_ids = {}
+        self.action_counts = []
+        self.variants = Counter()
+        self.trace_number = 0
+        self.action_number = 0
+
+    def add_trace(self, actions) -> None:
+        encoded = []
+        for action in actions:
+            action_id = self.action_ids.get(action)
+            if action_id is None:
+                action_id = self.action_ids[action] = len(self.actions)
+                self.actions.append(action)
+                self.action_counts.append(0)
+            self.action_counts[action_id] += 1
+            encoded.append(action_id)
+        self.variants[tuple(encoded)] += 1
+        self.trace_number += 1
+        self.action_number += len(encoded)
+
+    def decode(self, variant: tuple) -> str:
+        return ",".join(self.actions[action_id] for action_id in variant)
+
+    def trace_popularity(self) -> dict:
+        return {self.decode(variant): count for variant, count in self.variants.items()}
+
+    def action_popularity(self) -> dict:
+        return dict(zip(self.actions, self.action_counts))
+
+
+class CollectionProfile(TraceStatistics):
+    """Every statistic of a collection, computed in a single pass over its requests
+        The traces of tags (without the outliers) are counted by TraceStatistics, the requests urls
+        and the first and last request time of each client are counted alongside
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.request_counts = Counter()
+        self.client_times = {}
+
+    def add_session(self, client_id, requests) -> None:
+        tags = []
+        times = self.client_times.get(client_id)
+        for request in requests:
+            tag = request.get("request_tag")
+            if tag is not None and tag != "Outliers":
+                tags.append(tag)
+            self.request_counts[request.get("request_url")] += 1
+            request_time = to_utc_datetime(request.get("request_time"))
+            if request_time is None:
+                continue
+            if times is None:
+                times = self.client_times[client_id] = [request_time, request_time]
+            elif request_time < times[0]:
+                times[0] = request_time
+            elif request_time > times[1]:
+                times[1] = request_time
+        if tags:
+            self.add_trace(tags)
+
+    def client_durations(self) -> list[ClientSessionDurationResponse]:
+        client_total_durations = []
+        for client_id, (first, last) in self.client_times.items():
+            total_duration_seconds = (last - first).total_seconds()
+            client_total_durations.append(
+                ClientSessionDurationResponse(
+                    client_id=client_id,
+                    total_duration_seconds=total_duration_seconds,
+                    total_duration_days=total_duration_seconds / (24 * 3600),
+                    total_duration_weeks=total_duration_seconds / (7 * 24 * 3600),
+                )
+            )
+        return client_total_durations
+
+    def summary(self, number: int = 5) -> dict:
+        trace_popularity = self.trace_popularity()
+        action_popularity = self.action_popularity()
+        total_requests = sum(self.request_counts.values())
+        request_frequencies = dict(self.request_counts.most_common())
+        return {
+            "Trace number": self.trace_number,
+            "Unique trace number": len(self.variants),
+            "Average trace": self.trace_number / len(self.variants) if self.variants else 0,
+            "Trace popularity": trace_popularity,
+            "Most popular traces": nlargest(number, trace_popularity, key=trace_popularity.get),
+            "Less popular traces": nsmallest(number, trace_popularity, key=trace_popularity.get),
+            "Action number": self.action_number,
+            "Unique action number": len(self.actions),
+            "Average action": self.action_number / len(self.actions) if self.actions else 0,
+            "Action popularity": action_popularity,
+            "Most popular actions": nlargest(number, action_popularity, key=action_popularity.get),
+            "Less popular actions": nsmallest(number, action_popularity, key=action_popularity.get),
+            "Request number": total_requests,
+            "Request frequencies": request_frequencies,
+            "Request percentages": {
+                url: f"{(count / total_requests) * 100:.2f}%" for url, count in request_frequencies.items()
+            },
+            "Client durations": self.client_durations(),
+        }
+
+
+async def iter_sessions(collection_db, events_db=None):
+    """Iterate over the sessions of a collection, reading only the fields of the requests used by the statistics
+
+    Yields:
+        tuple: the client_id and the list of the requests of a session
+    """
+    if events_db is not None:
+        key, requests = None, []
+        async for event in events_db.find(
+                {}, {"_id": 0, "client_id": 1, "session_id": 1, "action": 1, "tag": 1, "time": 1}
+        ).sort([("client_id", 1), ("session_id", 1), ("position", 1)]):
+            if (event["client_id"], event.get("session_id")) != key:
+                if key is not None:
+                    yield key[0], requests
+                key, requests = (event["client_id"], event.get("session_id")), []
+            requests.append({
+                "request_url": event.get("action"),
+                "request_tag": event.get("tag"),
+                "request_time": event.get("time"),
+            })
+        if key is not None:
+            yield key[0], requests
+        return
+    async for client in collection_db.find(
+            {},
+            {
+                "_id": 0,
+                "client_id": 1,
+                "sessions.requests.request_url": 1,
+                "sessions.requests.request_tag": 1,
+                "sessions.requests.request_time": 1,
+            },
+    ):
+        for session in client.get("sessions") or []:
+            yield client["client_id"], session.get("requests") or []
+
+
+async def get_collection_profile(collection_db, events_db=None) -> CollectionProfile:
+    async def compute():
+        profile = CollectionProfile()
+        async for client_id, requests in iter_sessions(collection_db, events_db):
+            profile.add_session(client_id, requests)
+        if not profile.request_counts:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="No data found"
+            )
+        return profile
+    # All the statistics of a collection are served by the same scan
+    return await cached_statistic(collection_db.name, "profile", (), compute)
+
+async def get_trace_statistics(collection_db, events_db=None) -> TraceStatistics:
+    statistics = await get_collection_profile(collection_db, events_db)
+    if not statistics.trace_number:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="No data found"
+        )
+    return statistics
+
+async def unique_trace_number(collection_db, events_db=None):
+    statistics = await get_trace_statistics(collection_db, events_db)
+    return statistics.trace_number, len(statistics.variants)
+
+async def unique_action_infos(collection_db, events_db=None):
+    statistics = await get_trace_statistics(collection_db, events_db)
+    return statistics.action_number, statistics.actions
 
-async def unique_action_infos(collection_db):
-    action_list = await get_actions(collection_db)
-    unique_action = list()
-    for action in action_list:
-        if not unique_action.__contains__(action):
-            unique_action.append(action)
-            print(action)
-    return len(action_list), unique_action
-
-async def popularity_action(action_list):
-    popularity = dict()
-    for action in action_list:
-        if not popularity.keys().__contains__(action):
-            popularity[action] = 1
-        else:
-            popularity[action] += 1
-    return popularity
-
-async def action_number(collection_db):
-    trace_list = await get_traces(collection_db)
-    cpt = 0
-    for trace in trace_list:
-        actions = trace.split(";")[1].split(",")
-        cpt += len(actions)
-    return cpt
\ No newline at end of file
+async def action_number(collection_db, events_db=None):
+    statistics = await get_trace_statistics(collection_db, events_db)
+    return statistics.action_number
@@ -1,5 +1,17 @@
 import hashlib
 import os
+import stat
+from datetime import date, datetime, time, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import aiofiles
+
+# Size of the chunks read from an uploaded file when it is written on the disk
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Root directory of the caches on disk (parsed logs, models, distance matrices...), private to the user of the API
+CACHE_DIR = os.getenv("CACHE_DIR", os.path.join(os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+                                                "trace4pm"))
+
 
 # Function to get the list of files in a directory
 # Return a list of files
@@ -17,4 +29,54 @@ async def compute_sha256(file_name):
     with open(file_name, "rb") as f:
         for chunk in iter(lambda: f.read(4096), b""):
             hash_sha256.update(chunk)
-    return hash_sha256.hexdigest()
\ No newline at end of file
+    return hash_sha256.hexdigest()
+
+
+# A utility function that streams an uploaded file on the disk
+# The SHA256 of the file is computed while it is written, so the file is never held in memory nor read twice
+# Return the hash of the file
+async def save_upload_file(upload_file, file_path: str, chunk_size: int = UPLOAD_CHUNK_SIZE) -> str:
+    hash_sha256 = hashlib.sha256()
+    async with aiofiles.open(file_path, "wb") as f:
+        while chunk := await upload_file.read(chunk_size):
+            hash_sha256.update(chunk)
+            await f.write(chunk)
+    return hash_sha256.hexdigest()
+
+
+# A utility function that converts a request time (ISO 8601 string or datetime) to a naive UTC datetime,
+# which is how MongoDB stores dates
+def to_utc_datetime(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+# A utility function that converts an interval of days, in a timezone, to UTC datetime bounds [start, end[
+# Raise a ValueError if the timezone is unknown
+def day_interval_to_utc(start_day: date, end_day: date, timezone_name: str = "UTC") -> tuple[datetime, datetime]:
+    try:
+        tz = timezone.utc if timezone_name.upper() == "UTC" else ZoneInfo(timezone_name)
+    except Exception:
+        raise ValueError(f"Unknown timezone {timezone_name}")
+    start = datetime.combine(start_day, time.min, tzinfo=tz)
+    end = datetime.combine(end_day + timedelta(days=1), time.min, tzinfo=tz)
+    return to_utc_datetime(start), to_utc_datetime(end)
+
+
+# A utility function that creates a cache directory only the user of the API can access (mode 0700)
+# The caches load their files back, some of them are pickled: a directory of another user, e.g. planted in a
+# shared temporary directory, would let this user run code in the API
+# Raise a PermissionError if the path is a directory (or a link) of another user
+def private_directory(path: str) -> str:
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    status = os.lstat(path)
+    if not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid():
+        raise PermissionError(f"The cache directory {path} is not a directory of the user of the API")
+    if stat.S_IMODE(status.st_mode) != 0o700:
+        os.chmod(path, 0o700)
+    return path
@@ -0,0 +1,401 @@
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.spatial.distance import squareform
+from sklearn.cluster import DBSCAN, Birch, MiniBatchKMeans
+from sklearn.preprocessing import normalize
+
+from .distance_utils import load_distance_matrix, log_items, read_cluster_log, sparse_distances
+
+# Linkage criteria of the agglomerative clustering
+LINKAGE_CRITERIA = ("single", "complete", "average", "ward")
+# Maximum number of settings evaluated by a parameter sweep of the clustering
+CLUSTERING_SWEEP_MAX_SETTINGS = int(os.getenv("CLUSTERING_SWEEP_MAX_SETTINGS", "200"))
+# Maximum number of groups of settings of a parameter sweep clustered at the same time, each one holds
+# the square distance matrix of the log
+CLUSTERING_SWEEP_WORKERS = int(os.getenv("CLUSTERING_SWEEP_WORKERS", "2"))
+# Default number of traces sampled to compute the scores of the scalable clustering
+SCORES_SAMPLE_SIZE = int(os.getenv("SCORES_SAMPLE_SIZE", "2000"))
+# Number of distances held in memory at once while the neighbor graph of the scalable DBSCAN is built
+NEIGHBOR_CHUNK_DISTANCES = 8 * 1024 * 1024
+# Number of vectors of a mini-batch of MiniBatchKMeans
+KMEANS_BATCH_SIZE = 4096
+# Number of traces inserted at once in the CF tree of Birch
+BIRCH_BATCH_SIZE = 4096
+# Distances between the vectors of MiniBatchKMeans and Birch
+CENTROID_DISTANCES = ("euclidean", "cosine")
+
+
+def square_distances(condensed: np.ndarray) -> np.ndarray:
+    """Square float32 matrix of a condensed distance matrix (of the variants, not of the traces)"""
+    return squareform(np.asarray(condensed, dtype=np.float32), checks=False)
+
+
+def merged_distances(linkage: str, to_a: np.ndarray, to_b: np.ndarray, a_b: float, size_a: float, size_b: float,
+                     sizes: np.ndarray) -> np.ndarray:
+    """Lance-Williams update: distances between the cluster merging a and b and the other clusters"""
+    if linkage == "single":
+        return np.minimum(to_a, to_b)
+    if linkage == "complete":
+        return np.maximum(to_a, to_b)
+    if linkage == "average":
+        return (size_a * to_a + size_b * to_b) / (size_a + size_b)
+    # Ward, as scipy computes it on any distance
+    with np.errstate(invalid="ignore"):
+        return np.sqrt(((sizes + size_a) * to_a ** 2 + (sizes + size_b) * to_b ** 2 - sizes * a_b ** 2)
+                       / (sizes + size_a + size_b))
+
+
+def weighted_linkage(distances: np.ndarray, counts: np.ndarray, linkage: str) -> list[tuple[int, int, float]]:
+    """Agglomerative clustering of the variants, each variant starting as a cluster of its traces
+        The traces of a variant are at distance 0, so they are the first ones merged by a clustering of the traces:
+        starting from clusters weighted by the number of traces gives the same dendrogram above height 0,
+        for O(n_variants²) memory. The merges are found with the nearest-neighbor chain algorithm
+
+    Args:
+        distances (np.ndarray): square distance matrix of the variants
+        counts (np.ndarray): number of traces of each variant
+        linkage (str): single, complete, average or ward
+
+    Returns:
+        list[tuple[int, int, float]]: the merges (the merged cluster keeps the index of its first variant) and their
+            heights, in the order of the algorithm
+    """
+    n = len(counts)
+    matrix = np.array(distances, dtype=np.float64)
+    sizes = counts.astype(np.float64)
+    if linkage == "ward":
+        # Ward distance between two clusters of duplicated traces, the ones of single traces are unchanged
+        matrix *= np.sqrt(2 * np.outer(sizes, sizes) / np.add.outer(sizes, sizes))
+    np.fill_diagonal(matrix, np.inf)
+    merges = []
+    chain = []
+    for _ in range(n - 1):
+        while True:
+            if not chain:
+                chain.append(int(np.argmax(sizes > 0)))
+            a = chain[-1]
+            b = int(np.argmin(matrix[a]))
+            # The previous cluster of the chain wins the ties, so the chain always ends on reciprocal neighbors
+            if len(chain) > 1 and matrix[a, chain[-2]] <= matrix[a, b]:
+                b = chain[-2]
+            if len(chain) > 1 and b == chain[-2]:
+                break
+            chain.append(b)
+        chain = chain[:-2]
+        keep, other = min(a, b), max(a, b)
+        height = matrix[a, b]
+        row = merged_distances(linkage, matrix[keep], matrix[other], height, sizes[keep], sizes[other], sizes)
+        matrix[keep, :] = row
+        matrix[:, keep] = row
+        matrix[other, :] = np.inf
+        matrix[:, other] = np.inf
+        matrix[keep, keep] = np.inf
+        sizes[keep] += sizes[other]
+        sizes[other] = 0
+        merges.append((keep, other, float(height)))
+    return merges
+
+
+def cut_linkage(merges: list[tuple[int, int, float]], n: int, nbr_clusters: int) -> np.ndarray:
+    """Cluster of each variant when the dendrogram is cut into nbr_clusters clusters
+        (at most one cluster per variant)
+    """
+    parents = np.arange(n)
+
+    def root(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    merges = sorted(merges, key=lambda merge: merge[2])
+    for a, b, _ in merges[:max(n - nbr_clusters, 0)]:
+        parents[root(b)] = root(a)
+    roots = np.array([root(i) for i in range(n)])
+    # Clusters numbered in the order of their first variant
+    return np.unique(roots, return_inverse=True)[1] if n else roots
+
+
+def cluster_variants(distances: np.ndarray, counts: np.ndarray, algorithm: str, params: dict) -> np.ndarray:
+    """Cluster the variants of a log, weighted by their number of traces, which is the same as clustering its traces
+
+    Args:
+        distances (np.ndarray): square distance matrix of the variants
+        counts (np.ndarray): number of traces of each variant
+        algorithm (str): DBSCAN (epsilon and min_samples) or Agglomerative (nbr_clusters and linkage)
+        params (dict): the ClusteringParams
+
+    Returns:
+        np.ndarray: the cluster of each variant, -1 for the noise of DBSCAN
+    """
+    if algorithm == "DBSCAN":
+        # The weights count the duplicated traces in the neighborhoods, as if they were all there
+        return DBSCAN(eps=params["epsilon"], min_samples=params["min_samples"], metric="precomputed").fit_predict(
+            distances, sample_weight=counts)
+    merges = weighted_linkage(distances, counts, params["linkage"])
+    return cut_linkage(merges, len(counts), params["nbr_clusters"])
+
+
+def clustering_scores(distances: np.ndarray, counts: np.ndarray, labels: np.ndarray) -> dict:
+    """Silhouette and Davies-Bouldin scores of a clustering of the traces, computed on the variants
+        Each variant counts for its number of traces, the noise of DBSCAN is left out. There are no centroids
+        for edit distances, so the Davies-Bouldin score takes the medoid of each cluster as its center
+
+    Returns:
+        dict: number of clusters and of noise traces, silhouette score of the clustering and of each cluster,
+            Davies-Bouldin score (None with less than two clusters)
+    """
+    clustered = labels >= 0
+    clusters = np.unique(labels[clustered])
+    result = {
+        "Number of clusters": int(len(clusters)),
+        "Number of noise traces": int(counts[~clustered].sum()),
+        "Silhouette score": None,
+        "Silhouette of each cluster": {},
+        "Davies bouldin score": None,
+    }
+    if len(clusters) < 2:
+        return result
+
+    members = np.flatnonzero(clustered)
+    column = np.searchsorted(clusters, labels[members])
+    weights = np.zeros((len(counts), len(clusters)), dtype=np.float32)
+    weights[members, column] = counts[members]
+    # Sum of the distances between each variant and the traces of each cluster
+    sums = (distances @ weights).astype(np.float64)
+    sizes = weights.sum(axis=0).astype(np.float64)
+
+    own = sums[members, column] / np.maximum(sizes[column] - 1, 1)
+    others = sums[members] / sizes
+    others[np.arange(len(members)), column] = np.inf
+    nearest = others.min(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        silhouettes = np.where(sizes[column] > 1, (nearest - own) / np.maximum(own, nearest), 0)
+    silhouettes = np.nan_to_num(silhouettes)
+    member_counts = counts[members]
+    result["Silhouette score"] = float(np.average(silhouettes, weights=member_counts))
+    result["Silhouette of each cluster"] = {
+        str(cluster): float(np.average(silhouettes[column == c], weights=member_counts[column == c]))
+        for c, cluster in enumerate(clusters)
+    }
+
+    medoids = np.array([members[column == c][np.argmin(sums[members[column == c], c])] for c in range(len(clusters))])
+    scatters = sums[medoids, np.arange(len(clusters))] / sizes
+    separations = distances[np.ix_(medoids, medoids)].astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratios = (scatters[:, None] + scatters[None, :]) / separations
+    np.fill_diagonal(ratios, -np.inf)
+    result["Davies bouldin score"] = float(np.mean(np.nan_to_num(ratios, posinf=0).max(axis=1)))
+    return result
+
+
+def write_cluster_logs(log: pd.DataFrame, labels: np.ndarray, output_dir: str) -> list[str]:
+    """Write the events of each cluster in a cluster_log_<cluster>.csv file, with their cluster_id column
+
+    Args:
+        log (pd.DataFrame): the log, as read by read_cluster_log
+        labels (np.ndarray): cluster of each event
+        output_dir (str): directory of the files
+
+    Returns:
+        list[str]: paths of the files
+    """
+    log = log[["client_id", "action", "timestamp"]].assign(cluster_id=labels)
+    file_paths = []
+    for cluster_id, events in log.groupby("cluster_id", sort=True):
+        file_path = os.path.join(output_dir, f"cluster_log_{cluster_id}.csv")
+        events.to_csv(file_path, sep=";", index=False)
+        file_paths.append(file_path)
+    return file_paths
+
+
+def cached_distance_matrix(matrix_key: str, n: int) -> np.ndarray:
+    condensed = load_distance_matrix(matrix_key, n)
+    if condensed is None:
+        raise RuntimeError("The distance matrix of the log is not cached anymore, please retry")
+    return condensed
+
+
+def sweep_groups(algorithm: str, grid: dict) -> list[dict]:
+    """Split the settings of a parameter sweep in groups sharing their most expensive step:
+        the dendrogram of a linkage (cut into each number of clusters), or the neighborhoods of an epsilon
+        (with each min_samples)
+
+    Args:
+        algorithm (str): DBSCAN or Agglomerative
+        grid (dict): lists of epsilon and min_samples (DBSCAN), or of linkage and nbr_clusters (Agglomerative)
+
+    Returns:
+        list[dict]: the shared parameter of each group and the values of the other one
+    """
+    if algorithm == "DBSCAN":
+        return [{"epsilon": epsilon, "min_samples": grid["min_samples"]} for epsilon in grid["epsilon"]]
+    return [{"linkage": linkage, "nbr_clusters": grid["nbr_clusters"]} for linkage in grid["linkage"]]
+
+
+def sweep_group(matrix_key: str, counts: np.ndarray, algorithm: str, group: dict) -> list[dict]:
+    """Cluster the items of a log with each setting of a group of a parameter sweep, run in a discovery process
+        The cached distance matrix is expanded once for the whole group (about 12 * n_items² bytes)
+
+    Returns:
+        list[dict]: the parameters of each setting and the scores of its clustering
+    """
+    distances = square_distances(cached_distance_matrix(matrix_key, len(counts)))
+    results = []
+    if algorithm == "DBSCAN":
+        for min_samples in group["min_samples"]:
+            params = {"epsilon": group["epsilon"], "min_samples": min_samples}
+            labels = cluster_variants(distances, counts, algorithm, params)
+            results.append({**params, **clustering_scores(distances, counts, labels)})
+    else:
+        merges = weighted_linkage(distances, counts, group["linkage"])
+        for nbr_clusters in group["nbr_clusters"]:
+            labels = cut_linkage(merges, len(counts), nbr_clusters)
+            results.append({"linkage": group["linkage"], "nbr_clusters": nbr_clusters,
+                            **clustering_scores(distances, counts, labels)})
+    return results
+
+
+def cluster_log(file_path: str, matrix_key: str, output_dir: str, algorithm: str, params: dict,
+                representation: str | None = None) -> tuple[dict, list[str]]:
+    """Cluster the traces of a log with its cached distance matrix, run in a discovery process
+        The distinct items of the log (variants or vectors) are clustered, weighted by their number of traces,
+        then each event gets the cluster of its item
+
+    Args:
+        file_path (str): the log file (client_id;action;timestamp csv file)
+        matrix_key (str): key of the distance matrix of the items of the log, computed by compute_distance_matrix
+        output_dir (str): directory of the cluster logs
+        algorithm (str): DBSCAN or Agglomerative
+        params (dict): the ClusteringParams
+        representation (str): vector representation of the traces, None for the trace based clustering
+
+    Returns:
+        dict: the scores of the clustering, its number of traces and of distinct items
+        list[str]: paths of the cluster logs
+    """
+    log = read_cluster_log(file_path)
+    items, counts, event_item = log_items(log, representation)
+    condensed = cached_distance_matrix(matrix_key, len(counts))
+    distances = square_distances(condensed)
+    labels = cluster_variants(distances, counts, algorithm, params)
+    result = clustering_scores(distances, counts, labels)
+    result["Number of traces"] = int(counts.sum())
+    result["Number of variants" if representation is None else "Number of distinct vectors"] = len(counts)
+    return result, write_cluster_logs(log, labels[event_item], output_dir)
+
+
+def neighbor_graph(vectors: sparse.csr_matrix, measure: str, epsilon: float) -> sparse.csr_matrix:
+    """Sparse graph of the distances up to epsilon between the vectors, the neighbor index of the scalable DBSCAN
+        It is built by chunks of rows holding NEIGHBOR_CHUNK_DISTANCES distances: its memory grows with the size
+        of the neighborhoods and not with n². The distances of each row are sorted, as sklearn expects them
+    """
+    n = vectors.shape[0]
+    chunk = max(1, NEIGHBOR_CHUNK_DISTANCES // max(n, 1))
+    indices, data, sizes = [], [], []
+    for start in range(0, n, chunk):
+        block = sparse_distances(vectors, measure, slice(start, start + chunk), slice(None))
+        rows, columns = np.nonzero(block <= epsilon)
+        distances = block[rows, columns]
+        order = np.lexsort((distances, rows))
+        indices.append(columns[order])
+        data.append(distances[order])
+        sizes.append(np.bincount(rows, minlength=block.shape[0]))
+    indptr = np.r_[0, np.cumsum(np.concatenate(sizes))] if sizes else np.zeros(1, dtype=np.int64)
+    # The zero distances are kept as explicit entries, they are neighbors too
+    return sparse.csr_matrix((np.concatenate(data) if data else [], np.concatenate(indices) if indices else [],
+                              indptr), shape=(n, n))
+
+
+def scalable_labels(vectors: sparse.csr_matrix, counts: np.ndarray, algorithm: str, params: dict,
+                    measure: str) -> np.ndarray:
+    """Cluster the distinct vectors of a log without their distance matrix
+
+    Args:
+        vectors (sparse.csr_matrix): the distinct vectors
+        counts (np.ndarray): number of traces of each vector
+        algorithm (str): MiniBatchKMeans or Birch (nbr_clusters, epsilon is the threshold of Birch),
+            or DBSCAN (epsilon and min_samples) over the neighbor graph of the vectors
+        params (dict): the ClusteringParams
+        measure (str): distance between the vectors. MiniBatchKMeans and Birch are euclidean,
+            the vectors are normalized for the cosine distance (see CENTROID_DISTANCES)
+
+    Returns:
+        np.ndarray: the cluster of each vector, -1 for the noise of DBSCAN
+    """
+    if algorithm == "DBSCAN":
+        graph = neighbor_graph(vectors, measure, params["epsilon"])
+        return DBSCAN(eps=params["epsilon"], min_samples=params["min_samples"], metric="precomputed").fit_predict(
+            graph, sample_weight=counts)
+    if measure == "cosine":
+        vectors = normalize(vectors)
+    if algorithm == "MiniBatchKMeans":
+        return MiniBatchKMeans(n_clusters=params["nbr_clusters"], batch_size=KMEANS_BATCH_SIZE, n_init=3,
+                               random_state=0).fit_predict(vectors, sample_weight=counts)
+    # Birch has no sample weights: the CF tree is built from the traces, inserted by batches of BIRCH_BATCH_SIZE
+    # (as fit inserts them one by one), then the subclusters are clustered once and each vector gets the cluster
+    # of its nearest subcluster (the duplicated traces share their subcluster)
+    birch = Birch(n_clusters=None, threshold=params.get("epsilon") or 0.5)
+    ends = np.cumsum(counts)
+    for start in range(0, int(ends[-1]) if len(ends) else 0, BIRCH_BATCH_SIZE):
+        traces = np.arange(start, min(start + BIRCH_BATCH_SIZE, int(ends[-1])))
+        birch.partial_fit(vectors[np.searchsorted(ends, traces, side="right")])
+    birch.set_params(n_clusters=params["nbr_clusters"])
+    birch.partial_fit()
+    return birch.predict(vectors)
+
+
+def sampled_scores(vectors: sparse.csr_matrix, counts: np.ndarray, labels: np.ndarray, measure: str,
+                   sample_size: int = SCORES_SAMPLE_SIZE, seed: int = 0) -> dict:
+    """Silhouette and Davies-Bouldin scores of a clustering, computed on a uniform sample of its traces
+        (the distinct vectors of the sample are weighted by their number of sampled traces)
+
+    Returns:
+        dict: the clustering_scores of the sample, with the number of clusters and of noise traces of the whole log
+    """
+    total = int(counts.sum())
+    if total <= sample_size:
+        sample_counts = counts
+    else:
+        traces = np.random.default_rng(seed).choice(total, size=sample_size, replace=False)
+        sample_counts = np.bincount(np.searchsorted(np.cumsum(counts), traces, side="right"), minlength=len(counts))
+    sampled = np.flatnonzero(sample_counts)
+    distances = sparse_distances(vectors, measure, sampled, sampled).astype(np.float32)
+    np.fill_diagonal(distances, 0)
+    result = clustering_scores(distances, sample_counts[sampled], labels[sampled])
+    result["Number of clusters"] = int(len(np.unique(labels[labels >= 0])))
+    result["Number of noise traces"] = int(counts[labels < 0].sum())
+    result["Number of sampled traces"] = int(sample_counts.sum())
+    return result
+
+
+def cluster_log_scalable(file_path: str, output_dir: str, algorithm: str, params: dict, representation: str,
+                         sample_size: int = SCORES_SAMPLE_SIZE, vocabulary: str | None = None
+                         ) -> tuple[dict, list[str]]:
+    """Feature based clustering of a large log, run in a discovery process
+        No distance matrix is computed: the distinct vectors of the traces are clustered by MiniBatchKMeans,
+        Birch or DBSCAN over their neighbor graph, and the scores are computed on a sample of the traces
+
+    Args:
+        file_path (str): the log file (client_id;action;timestamp csv file)
+        output_dir (str): directory of the cluster logs
+        algorithm (str): MiniBatchKMeans, Birch or DBSCAN
+        params (dict): the ClusteringParams, its distance is the distance between the vectors
+        representation (str): vector representation of the traces
+        sample_size (int): number of traces sampled for the scores
+        vocabulary (str): collection whose interned vocabulary gives the ids of the actions
+
+    Returns:
+        dict: the scores of the clustering, its number of traces and of distinct vectors
+        list[str]: paths of the cluster logs
+    """
+    log = read_cluster_log(file_path)
+    vectors, counts, event_item = log_items(log, representation, vocabulary)
+    labels = scalable_labels(vectors, counts, algorithm, params, params["distance"])
+    result = sampled_scores(vectors, counts, labels, params["distance"], sample_size)
+    result["Number of traces"] = int(counts.sum())
+    result["Number of distinct vectors"] = len(counts)
+    return result, write_cluster_logs(log, labels[event_item], output_dir)
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from contextlib import asynccontextmanager
+
+from fastapi import HTTPException, status
+
+# Directory of the request workspaces (uploads, outputs of the discovery processes, zips...)
+WORKSPACE_DIR = os.getenv("WORKSPACE_DIR", os.path.join(tempfile.gettempdir(), "trace4pm_workspaces"))
+# Disk quota of the workspaces in bytes, a request needing a workspace beyond it answers 507
+WORKSPACE_QUOTA_BYTES = int(os.getenv("WORKSPACE_QUOTA_BYTES", str(10 * 1024 * 1024 * 1024)))
+# Age (in seconds) after which the janitor deletes a workspace left behind (e.g. by a crash of the API)
+# and the files of the scratch directories
+WORKSPACE_MAX_AGE = int(os.getenv("WORKSPACE_MAX_AGE", str(6 * 3600)))
+# Time (in seconds) between two runs of the janitor
+JANITOR_INTERVAL = int(os.getenv("JANITOR_INTERVAL", "600"))
+# Time (in seconds) during which a measure of the size of the workspaces is reused by the new workspaces
+WORKSPACE_SIZE_TTL = 10
+# Directories written by the discovery and clustering packages, relative to the working directory of the API
+# (their own directories are kept, only their old files are deleted)
+SCRATCH_DIRS = ("temp", "src/temp")
+
+logger = logging.getLogger(__name__)
+
+_workspaces = {}
+# Files of the SCRATCH_DIRS still needed by this API process (e.g. the uploads queued by the ingestion jobs)
+_held_files = set()
+_janitor_tasks = set()
+# Last measure of the size of the workspaces (bytes, loop time), taken by one request at a time
+_workspaces_size = [0, None]
+_workspaces_size_lock = asyncio.Lock()
+
+
+class Workspace:
+    """Scratch directory of a request, deleted when it is released once its response is sent"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def file(self, name: str) -> str:
+        """Path of a file in the workspace, only the base name of the (uploaded) name is kept"""
+        return os.path.join(self.path, os.path.basename(name) or uuid.uuid4().hex)
+
+    def release(self) -> None:
+        _workspaces.pop(self.path, None)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def directory_size(directory: str) -> int:
+    size = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+async def workspaces_size(refresh: bool = False) -> int:
+    """Size of the workspaces in bytes, measured in a thread at most every WORKSPACE_SIZE_TTL seconds
+        (walking the workspaces in the event loop would block every request)
+    """
+    loop = asyncio.get_running_loop()
+    async with _workspaces_size_lock:
+        size, measured_at = _workspaces_size
+        if refresh or measured_at is None or loop.time() - measured_at > WORKSPACE_SIZE_TTL:
+            _workspaces_size[:] = [await loop.run_in_executor(None, directory_size, WORKSPACE_DIR), loop.time()]
+        return _workspaces_size[0]
+
+
+async def create_workspace() -> Workspace:
+    """Create a workspace, the stale workspaces are swept first when the quota is reached
+        The quota is checked against a recent measure of the workspaces, it can be exceeded by the files
+        written since
+
+    Raises:
+        HTTPException: 507 if the workspaces still use more than WORKSPACE_QUOTA_BYTES
+    """
+    if await workspaces_size() >= WORKSPACE_QUOTA_BYTES:
+        await asyncio.get_running_loop().run_in_executor(None, sweep_scratch_space)
+        if await workspaces_size(refresh=True) >= WORKSPACE_QUOTA_BYTES:
+            raise HTTPException(
+                status_code=status.HTTP_507_INSUFFICIENT_STORAGE,
+                detail="The server has no scratch space left, please retry later",
+            )
+    os.makedirs(WORKSPACE_DIR, exist_ok=True)
+    workspace = Workspace(tempfile.mkdtemp(dir=WORKSPACE_DIR))
+    _workspaces[workspace.path] = workspace
+    return workspace
+
+
+@asynccontextmanager
+async def workspace():
+    """Workspace of a block of code, released at its end"""
+    scratch = await create_workspace()
+    try:
+        yield scratch
+    finally:
+        scratch.release()
+
+
+async def request_workspace():
+    """Dependency giving a workspace to a route, released once the response (e.g. a zip file) is sent"""
+    scratch = await create_workspace()
+    try:
+        yield scratch
+    finally:
+        scratch.release()
+
+
+def hold_scratch_file(path: str) -> None:
+    """Keep a file of the SCRATCH_DIRS from the janitor until it is released"""
+    _held_files.add(os.path.abspath(path))
+
+
+def release_scratch_file(path: str) -> None:
+    _held_files.discard(os.path.abspath(path))
+
+
+def sweep_scratch_space(max_age: int = WORKSPACE_MAX_AGE) -> int:
+    """Delete the workspaces older than max_age which are not used by this API process
+        (left behind by a crash, or by a request of another API process which would have ended long ago),
+        and the files of the SCRATCH_DIRS older than max_age which are not held by this API process
+
+    Returns:
+        int: number of workspaces and files deleted
+    """
+    oldest = time.time() - max_age
+    deleted = 0
+    if os.path.isdir(WORKSPACE_DIR):
+        with os.scandir(WORKSPACE_DIR) as scan:
+            for entry in scan:
+                try:
+                    if entry.path in _workspaces or entry.stat(follow_symlinks=False).st_mtime >= oldest:
+                        continue
+                except FileNotFoundError:
+                    continue
+                shutil.rmtree(entry.path, ignore_errors=True)
+                deleted += 1
+    for directory in SCRATCH_DIRS:
+        for root, _, files in os.walk(directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if os.path.abspath(path) in _held_files:
+                    continue
+                try:
+                    if os.lstat(path).st_mtime < oldest:
+                        os.remove(path)
+                        deleted += 1
+                except FileNotFoundError:
+                    pass
+    return deleted
+
+
+async def run_janitor(*cleanups, interval: int = JANITOR_INTERVAL) -> None:
+    """Sweep the scratch space every interval seconds, then run the other cleanups (coroutine functions)"""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, sweep_scratch_space)
+            for cleanup in cleanups:
+                await cleanup()
+        except Exception as e:
+            # The janitor must survive e.g. a MongoDB outage, it retries at its next run
+            logger.error(f"Janitor error: {e}")
+        await asyncio.sleep(interval)
+
+
+def start_janitor(*cleanups) -> None:
+    task = asyncio.create_task(run_janitor(*cleanups))
+    _janitor_tasks.add(task)
+    task.add_done_callback(_janitor_tasks.discard)
@@ -0,0 +1,117 @@
+import asyncio
+import pickle
+
+import pytest
+
+from src import cache_utils
+from src.cache_utils import StatisticsCache, cached_statistic
+
+VALUE = b"x" * 1000
+VALUE_SIZE = len(pickle.dumps(VALUE, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def test_cache_evicts_the_least_recently_used_statistics():
+    cache = StatisticsCache(max_bytes=2 * VALUE_SIZE)
+    cache.set("a", VALUE)
+    cache.set("b", VALUE)
+    # a is used again, b is the least recently used
+    assert cache.get("a") == (VALUE, VALUE_SIZE)
+    cache.set("c", VALUE)
+    assert list(cache.entries) == ["a", "c"]
+    assert cache.get("b") is None
+    assert cache.size == 2 * VALUE_SIZE
+
+
+def test_cache_replaces_a_statistic():
+    cache = StatisticsCache(max_bytes=2 * VALUE_SIZE)
+    cache.set("a", VALUE)
+    cache.set("a", VALUE)
+    assert cache.size == VALUE_SIZE
+
+
+def test_cache_skips_the_statistics_larger_than_the_cache():
+    cache = StatisticsCache(max_bytes=2 * VALUE_SIZE)
+    cache.set("a", VALUE)
+    cache.set("large", VALUE * 3)
+    assert list(cache.entries) == ["a"]
+    assert cache.size == VALUE_SIZE
+
+
+def test_invalidate_drops_the_statistics_of_a_collection():
+    cache = StatisticsCache(max_bytes=10 * VALUE_SIZE)
+    cache.set(("logs", 0, "trace_number", ()), VALUE)
+    cache.set(("logs", 1, "variants", ()), VALUE)
+    cache.set(("other", 0, "trace_number", ()), VALUE)
+    cache.invalidate("logs")
+    assert list(cache.entries) == [("other", 0, "trace_number", ())]
+    assert cache.size == VALUE_SIZE
+
+
+@pytest.fixture
+def generations(monkeypatch):
+    monkeypatch.setattr(cache_utils, "statistics_cache", StatisticsCache(max_bytes=10 * VALUE_SIZE))
+    generations = {}
+
+    async def get_generation(collection):
+        return generations.get(collection, 0)
+
+    monkeypatch.setattr(cache_utils, "get_generation", get_generation)
+    return generations
+
+
+@pytest.mark.anyio
+async def test_cached_statistic_is_computed_once_per_generation(generations):
+    calls = []
+
+    async def compute():
+        calls.append(generations.get("logs", 0))
+        return len(calls)
+
+    assert await cached_statistic("logs", "trace_number", (), compute) == 1
+    assert await cached_statistic("logs", "trace_number", (), compute) == 1
+    # The collection changed, the statistic is computed again
+    generations["logs"] = 1
+    assert await cached_statistic("logs", "trace_number", (), compute) == 2
+    assert calls == [0, 1]
+
+
+@pytest.mark.anyio
+async def test_concurrent_requests_share_one_computation(generations):
+    calls = []
+    release = asyncio.Event()
+
+    async def compute():
+        calls.append(None)
+        await release.wait()
+        return "statistic"
+
+    first = asyncio.create_task(cached_statistic("logs", "variants", (), compute))
+    second = asyncio.create_task(cached_statistic("logs", "variants", (), compute))
+    await asyncio.sleep(0)
+    release.set()
+    assert await asyncio.gather(first, second) == ["statistic", "statistic"]
+    assert len(calls) == 1
+    assert cache_utils.statistics_cache.pending == {}
+
+
+@pytest.mark.anyio
+async def test_concurrent_requests_share_the_error_of_the_computation(generations):
+    release = asyncio.Event()
+
+    async def compute():
+        await release.wait()
+        raise ValueError("unknown collection")
+
+    first = asyncio.create_task(cached_statistic("logs", "variants", (), compute))
+    second = asyncio.create_task(cached_statistic("logs", "variants", (), compute))
+    await asyncio.sleep(0)
+    release.set()
+    results = await asyncio.gather(first, second, return_exceptions=True)
+    assert [type(result) for result in results] == [ValueError, ValueError]
+    # The error is not cached
+    assert cache_utils.statistics_cache.entries == {}
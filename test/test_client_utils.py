@@ -0,0 +1,106 @@
+from types import SimpleNamespace
+
+import pytest
+
+from src.client_utils import merge_clients, renumber_sessions, upsert_clients_in_collection
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def session(session_id, *urls):
+    return {"session_id": session_id,
+            "requests": [{"request_id": f"{session_id}.{position}", "request_url": url}
+                         for position, url in enumerate(urls, start=1)]}
+
+
+def test_merge_clients_concatenates_sessions_in_file_order():
+    first = [
+        {"client_id": "a", "country": "France", "sessions": [{"session_id": 1}]},
+        {"client_id": "b", "sessions": [{"session_id": 1}]},
+    ]
+    second = [
+        {"client_id": "a", "country": "Spain", "sessions": [{"session_id": 2}, {"session_id": 3}]},
+        {"client_id": "c", "sessions": None},
+    ]
+    merged = {client["client_id"]: client for client in merge_clients([first, second])}
+
+    assert list(merged) == ["a", "b", "c"]
+    assert [session["session_id"] for session in merged["a"]["sessions"]] == [1, 2, 3]
+    # The other fields come from the first file where the client appears
+    assert merged["a"]["country"] == "France"
+    assert merged["c"]["sessions"] == []
+
+
+def test_merge_clients_numbers_the_sessions_of_each_file_after_the_previous_ones():
+    # The parser numbers the sessions of each file from 1
+    first = [{"client_id": "a", "sessions": [session(1, "/login", "/search"), session(2, "/logout")]}]
+    second = [{"client_id": "a", "sessions": [session(1, "/home", "/logout")]}]
+    third = [{"client_id": "a", "sessions": [session(1, "/login")]}]
+    sessions = merge_clients([first, second, third])[0]["sessions"]
+
+    assert [session["session_id"] for session in sessions] == [1, 2, 3, 4]
+    assert [request["request_id"] for session in sessions for request in session["requests"]] == [
+        "1.1", "1.2", "2.1", "3.1", "3.2", "4.1"]
+    assert [request["request_url"] for request in sessions[2]["requests"]] == ["/home", "/logout"]
+
+
+def test_merge_clients_does_not_modify_the_parsed_clients():
+    first = [{"client_id": "a", "sessions": [{"session_id": 1}]}]
+    second = [{"client_id": "a", "sessions": [{"session_id": 1}]}]
+    merge_clients([first, second])
+    assert first[0]["sessions"] == [{"session_id": 1}]
+    assert second[0]["sessions"] == [{"session_id": 1}]
+
+
+def test_renumber_sessions_keeps_the_type_of_the_request_ids():
+    sessions = renumber_sessions([{"session_id": 1, "requests": [{"request_id": 1.1}, {"request_id": 1.2}]}], 4)
+    assert sessions == [{"session_id": 5, "requests": [{"request_id": 5.1}, {"request_id": 5.2}]}]
+
+
+class Collection:
+    """The stored clients of a collection and the writes sent to it"""
+
+    def __init__(self, clients):
+        self.clients = clients
+        self.operations = []
+
+    async def create_index(self, keys):
+        pass
+
+    async def aggregate(self, pipeline):
+        client_ids = pipeline[0]["$match"]["client_id"]["$in"]
+        for client in self.clients:
+            if client["client_id"] in client_ids:
+                yield {"client_id": client["client_id"],
+                       "last": max((session["session_id"] for session in client["sessions"]), default=None)}
+
+    async def bulk_write(self, operations, ordered):
+        self.operations.extend(operations)
+        stored = {client["client_id"] for client in self.clients}
+        return SimpleNamespace(upserted_count=sum(operation._filter["client_id"] not in stored
+                                                  for operation in operations))
+
+
+def request_ids(sessions):
+    return [(session["session_id"], [request["request_id"] for request in session["requests"]])
+            for session in sessions]
+
+
+@pytest.mark.anyio
+async def test_upsert_numbers_the_sessions_after_the_stored_ones():
+    collection = Collection([{"client_id": "a", "sessions": [session(1, "/login"), session(2, "/search")]}])
+    clients = [
+        {"client_id": "a", "sessions": [session(1, "/home", "/logout")]},
+        {"client_id": "b", "sessions": [session(1, "/login")]},
+    ]
+    assert await upsert_clients_in_collection(clients, collection) == 1
+
+    pushed = {operation._filter["client_id"]: operation._doc["$push"]["sessions"]["$each"]
+              for operation in collection.operations}
+    assert request_ids(pushed["a"]) == [(3, ["3.1", "3.2"])]
+    assert request_ids(pushed["b"]) == [(1, ["1.1"])]
+    # The clients are renumbered in place, their events get the same session ids
+    assert clients[0]["sessions"] == [session(3, "/home", "/logout")]
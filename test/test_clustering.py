@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+from fastapi import FastAPI
+from httpx import ASGITransport, AsyncClient
+
+from src import distance_utils, workspace_utils
+from src.models.users import User_Model
+from src.routers import clustering
+from src.security import get_current_active_user
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def discoveries(tmp_path, monkeypatch):
+    monkeypatch.setattr(distance_utils, "DISTANCE_CACHE_DIR", str(tmp_path / "distance_matrices"))
+    monkeypatch.setattr(workspace_utils, "WORKSPACE_DIR", str(tmp_path / "workspaces"))
+    calls = []
+
+    # The discoveries run in the test process, so they see its cache directory
+    async def run_discovery(username, function, *args, result_index=None, wait=False, **kwargs):
+        calls.append((username, function.__name__, wait))
+        result = function(*args, **kwargs)
+        return result if result_index is None else result[result_index]
+
+    monkeypatch.setattr(clustering, "run_discovery", run_discovery)
+    return calls
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.include_router(clustering.router)
+    app.dependency_overrides[get_current_active_user] = lambda: User_Model(username="user")
+    return AsyncClient(transport=ASGITransport(app=app), base_url="http://test")
+
+
+@pytest.fixture
+def log_file():
+    rng = np.random.default_rng(0)
+    lines = ["client_id;action;timestamp"]
+    for client in range(60):
+        for second, action in enumerate(rng.integers(0, 5, size=rng.integers(1, 6))):
+            lines.append(f"{client};action {action};2024-03-01 10:00:{second:02d}")
+    return ("log.csv", "\n".join(lines).encode(), "text/csv")
+
+
+@pytest.mark.anyio
+async def test_clustering_sweep(client, discoveries, log_file):
+    async with client:
+        response = await client.post("/clustering/sweep/", params={
+            "algorithm": "Agglomerative", "linkage": ["Average", "Ward"], "nbr_clusters": [2, 3, 4],
+        }, files={"file": log_file})
+    assert response.status_code == 200
+    result = response.json()
+    assert result["Number of traces"] == 60
+    assert [(setting["linkage"], setting["nbr_clusters"]) for setting in result["settings"]] == [
+        ("average", 2), ("average", 3), ("average", 4), ("ward", 2), ("ward", 3), ("ward", 4),
+    ]
+    assert result["best"]["Silhouette score"] == max(setting["Silhouette score"] for setting in result["settings"])
+    # The groups of settings run as discoveries of the user, waiting for its slots
+    assert discoveries.count(("user", "sweep_group", True)) == 2
+
+
+@pytest.mark.anyio
+async def test_clustering_sweep_of_the_vectors(client, discoveries, log_file):
+    async with client:
+        response = await client.post("/clustering/sweep/", params={
+            "algorithm": "DBSCAN", "epsilon": [0.2, 0.5], "min_samples": [1, 5],
+            "vector_representation": "Binary Representation", "distance": "Jaccard",
+        }, files={"file": log_file})
+    assert response.status_code == 200
+    result = response.json()
+    assert len(result["settings"]) == 4
+    assert result["Number of distinct vectors"] <= 2 ** 5
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("params", [
+    {"algorithm": "DBSCAN", "epsilon": [0.5, 0], "min_samples": [2]},
+    {"algorithm": "DBSCAN", "epsilon": [0.5], "min_samples": [0, 2]},
+    {"algorithm": "DBSCAN", "epsilon": [0.5]},
+    {"algorithm": "Agglomerative", "linkage": ["Single"], "nbr_clusters": [-1]},
+])
+async def test_clustering_sweep_refuses_invalid_grids(client, discoveries, log_file, params):
+    async with client:
+        response = await client.post("/clustering/sweep/", params=params, files={"file": log_file})
+    assert response.status_code == 400
+    assert discoveries == []
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("algorithm", ["MiniBatchKMeans", "Birch"])
+async def test_scalable_clustering_refuses_the_distances_without_centroids(client, discoveries, log_file, algorithm):
+    async with client:
+        response = await client.post("/clustering/feature_based/scalable", params={
+            "algorithm": algorithm, "vector_representation": "Binary Representation", "distance": "Jaccard",
+            "nbr_clusters": 3,
+        }, files={"file": log_file})
+    assert response.status_code == 400
+    assert discoveries == []
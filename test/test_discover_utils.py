@@ -0,0 +1,171 @@
+import math
+import os
+import re
+from collections import Counter
+
+import pm4py
+import pytest
+from pm4py.algo.discovery.footprints import algorithm as footprints_discovery
+
+from src.discover_utils import (LogAbstraction, compute_fitness, compute_generalization, compute_precision,
+                                dfg_model, discover_heuristics_net, estimate_quality, heuristics_net_model,
+                                model_graph, petri_net_model, prune_arcs, replay_variants)
+from src.models.discover import Quality_Type
+
+LOG_PATH = os.path.join(os.path.dirname(__file__), "running-example.xes")
+
+
+@pytest.fixture(scope="module")
+def log():
+    return pm4py.read_xes(LOG_PATH)
+
+
+def test_log_abstraction_matches_pm4py(log):
+    abstraction = LogAbstraction(log)
+    dfg, start_activities, end_activities = pm4py.discover_dfg(log)
+    assert abstraction.dfg == dfg
+    assert abstraction.start_activities == start_activities
+    assert abstraction.end_activities == end_activities
+    assert abstraction.activities == pm4py.get_event_attribute_values(log, "concept:name")
+    assert abstraction.variants == {
+        variant: count if isinstance(count, int) else len(count) for variant, count in pm4py.get_variants(log).items()
+    }
+
+
+def test_log_abstraction_performance_matches_pm4py(log):
+    abstraction = LogAbstraction(log)
+    performance_dfg = pm4py.discover_performance_dfg(log)[0]
+    assert abstraction.performance_dfg.keys() == performance_dfg.keys()
+    for arc, performance in performance_dfg.items():
+        for measure in ("mean", "median", "max", "min", "sum"):
+            assert abstraction.performance_dfg[arc][measure] == pytest.approx(performance[measure])
+        # pm4py gives no deviation (nan) to the arcs seen once, the abstraction gives them 0 to stay JSON compliant
+        stdev = 0 if math.isnan(performance["stdev"]) else performance["stdev"]
+        assert abstraction.performance_dfg[arc]["stdev"] == pytest.approx(stdev)
+
+
+def test_log_abstraction_footprints_match_pm4py(log):
+    abstraction = LogAbstraction(log)
+    footprints = footprints_discovery.apply(log, variant=footprints_discovery.Variants.ENTIRE_EVENT_LOG)
+    for key, value in abstraction.footprints.items():
+        assert value == footprints[key]
+
+
+@pytest.fixture(scope="module")
+def model(log):
+    return pm4py.discover_petri_net_inductive(log)
+
+
+@pytest.mark.parametrize("approach", [Quality_Type.token.value, Quality_Type.align.value])
+def test_variant_quality_matches_pm4py(log, model, approach):
+    net, initial_marking, final_marking = model
+    variants = LogAbstraction(log).variants
+    event_log = pm4py.convert_to_event_log(log)
+    if approach == Quality_Type.token.value:
+        fitness = pm4py.fitness_token_based_replay(event_log, net, initial_marking, final_marking)
+        precision = pm4py.precision_token_based_replay(event_log, net, initial_marking, final_marking)
+    else:
+        fitness = pm4py.fitness_alignments(event_log, net, initial_marking, final_marking)
+        precision = pm4py.precision_alignments(event_log, net, initial_marking, final_marking)
+    assert compute_fitness(variants, net, initial_marking, final_marking, approach) == pytest.approx(fitness)
+    assert compute_precision(variants, net, initial_marking, final_marking, approach) == pytest.approx(precision)
+
+
+def test_estimate_quality_is_exact_when_the_sample_covers_the_log(log, model):
+    net, initial_marking, final_marking = model
+    variants = LogAbstraction(log).variants
+    approach = Quality_Type.token.value
+    estimate = estimate_quality(variants, net, initial_marking, final_marking, approach, approach,
+                                sample_variants=len(variants))
+    replayed = replay_variants(variants, net, initial_marking, final_marking)
+    fitness = compute_fitness(variants, net, initial_marking, final_marking, approach, replayed=replayed)
+    for measure in ("log_fitness", "average_trace_fitness", "percentage_of_fitting_traces"):
+        assert estimate["Fitness"][measure] == pytest.approx(fitness[measure])
+    assert estimate["Precision"] == pytest.approx(compute_precision(variants, net, initial_marking, final_marking,
+                                                                    approach))
+    assert estimate["Generalization"] == pytest.approx(compute_generalization(variants, net, replayed))
+    assert estimate["Approximation"]["sampled_variants"] == len(variants)
+    assert estimate["Approximation"]["exact_traces"] == sum(variants.values())
+
+
+def test_estimate_quality_samples_the_rare_variants(log, model):
+    net, initial_marking, final_marking = model
+    # Many variants of a few traces each: the frequent ones are exact, the others are drawn
+    variants = Counter({
+        variant[:length] + (f"activity {i}",): i + 1
+        for variant in LogAbstraction(log).variants for length in range(1, len(variant)) for i in range(5)
+    })
+    approach = Quality_Type.token.value
+    estimate = estimate_quality(variants, net, initial_marking, final_marking, approach, approach, sample_variants=40)
+    approximation = estimate["Approximation"]
+    assert approximation["sampled_variants"] <= 40 < approximation["variants"]
+    assert approximation["exact_traces"] < approximation["sampled_traces"] < approximation["traces"]
+    low, high = approximation["intervals"]["log_fitness"]
+    assert low <= estimate["Fitness"]["log_fitness"] <= high
+    exact = compute_fitness(variants, net, initial_marking, final_marking, approach)["log_fitness"]
+    assert low <= exact <= high
+    # The same log gives the same sample
+    assert estimate_quality(variants, net, initial_marking, final_marking, approach, approach,
+                            sample_variants=40) == estimate
+
+
+def test_dfg_model_matches_pm4py(log):
+    model = dfg_model(LogAbstraction(log))
+    dfg, start_activities, end_activities = pm4py.discover_dfg(log)
+    assert {(arc["source"], arc["target"]): arc["frequency"] for arc in model["arcs"]} == dfg
+    activities = pm4py.get_event_attribute_values(log, "concept:name")
+    assert {node["id"]: (node["frequency"], node["start"], node["end"]) for node in model["nodes"]} == {
+        activity: (count, start_activities.get(activity, 0), end_activities.get(activity, 0))
+        for activity, count in activities.items()
+    }
+
+
+def test_heuristics_net_model_matches_pm4py(log):
+    model = heuristics_net_model(discover_heuristics_net(LogAbstraction(log)))
+    heuristics_net = pm4py.discover_heuristics_net(log)
+    assert sorted((arc["source"], arc["target"], arc["frequency"]) for arc in model["arcs"]) == sorted(
+        (name, target.node_name, edge.dfg_value) for name, node in heuristics_net.nodes.items()
+        for target, edges in node.output_connections.items() for edge in edges
+    )
+
+
+def test_petri_net_model(log, model):
+    net, initial_marking, final_marking = model
+    petri_net = petri_net_model(net, initial_marking, final_marking, LogAbstraction(log).activities)
+    assert len(petri_net["nodes"]) == len(net.places) + len(net.transitions)
+    assert len(petri_net["arcs"]) == len(net.arcs)
+    assert sum(node.get("initial", 0) for node in petri_net["nodes"]) == 1
+    assert {node["label"]: node["frequency"] for node in petri_net["nodes"]
+            if node["type"] == "transition" and node["label"]} == pm4py.get_event_attribute_values(log, "concept:name")
+
+
+def test_prune_arcs(log):
+    model = dfg_model(LogAbstraction(log))
+    frequencies = sorted((arc["frequency"] for arc in model["arcs"]), reverse=True)
+    assert prune_arcs(model, min_frequency=3)["arcs"] == [arc for arc in model["arcs"] if arc["frequency"] >= 3]
+    pruned = prune_arcs(model, max_arcs=4)
+    assert sorted((arc["frequency"] for arc in pruned["arcs"]), reverse=True) == frequencies[:4]
+    assert prune_arcs(model, min_frequency=100)["arcs"] == []
+    # The nodes are kept
+    assert pruned["nodes"] == model["nodes"]
+
+
+def test_prune_arcs_keeps_the_arcs_of_a_petri_net(log, model):
+    petri_net = petri_net_model(*model, LogAbstraction(log).activities)
+    assert prune_arcs(petri_net, min_frequency=100, max_arcs=1)["arcs"] == petri_net["arcs"]
+
+
+def graph_arcs(graph) -> list[tuple[str, str]]:
+    """Edges of a graph between the nodes of the model (not the start and end nodes of a DFG)"""
+    return [match.groups() for line in graph.body if (match := re.match(r"\t(n\d+) -> (n\d+)", line))]
+
+
+@pytest.mark.parametrize("performance", [False, True])
+def test_model_graph_draws_one_edge_per_kept_arc(log, model, performance):
+    abstraction = LogAbstraction(log)
+    for graph_model in (prune_arcs(dfg_model(abstraction), min_frequency=2, max_arcs=5),
+                        heuristics_net_model(discover_heuristics_net(abstraction)),
+                        petri_net_model(*model, abstraction.activities)):
+        names = {node["id"]: f"n{i}" for i, node in enumerate(graph_model["nodes"])}
+        assert sorted(graph_arcs(model_graph(graph_model, performance))) == sorted(
+            (names[arc["source"]], names[arc["target"]]) for arc in graph_model["arcs"])
@@ -0,0 +1,120 @@
+import asyncio
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.spatial.distance import cdist, pdist
+
+from src import distance_utils
+from src.distance_utils import (VECTOR_REPRESENTATIONS, compute_distance_matrix, evict_distance_matrices,
+                                intern_actions, load_distance_matrix, log_items, read_items, sparse_distances,
+                                write_items)
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(distance_utils, "DISTANCE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(distance_utils, "VOCABULARY_DIR", str(tmp_path / "vocabularies"))
+    return tmp_path
+
+
+@pytest.fixture
+def log():
+    rng = np.random.default_rng(0)
+    # Traces of a few actions among the 8 first ones, the vocabulary has 10 actions
+    return pd.DataFrame([
+        {"client_id": str(client), "action": f"action {action}", "timestamp": "2024-03-01T10:00:00"}
+        for client in range(40) for action in rng.integers(0, 8, size=rng.integers(1, 6))
+    ])
+
+
+def dense(vectors, vocabulary_size=10):
+    return vectors.toarray()[:, :vocabulary_size]
+
+
+@pytest.mark.parametrize("representation", VECTOR_REPRESENTATIONS)
+@pytest.mark.parametrize("measure", ["cosine", "euclidean"])
+def test_sparse_distances_match_scipy(log, representation, measure):
+    vectors = log_items(log, representation)[0]
+    rows, columns = slice(2, 9), np.array([0, 4, 3, 11])
+    expected = cdist(dense(vectors)[rows], dense(vectors)[columns], metric=measure)
+    assert sparse_distances(vectors, measure, rows, columns) == pytest.approx(expected, abs=1e-9)
+
+
+@pytest.mark.parametrize("representation", VECTOR_REPRESENTATIONS)
+def test_sparse_jaccard_matches_scipy_on_the_actions(log, representation):
+    vectors = log_items(log, representation)[0]
+    expected = cdist(dense(vectors) > 0, dense(vectors) > 0, metric="jaccard")
+    assert sparse_distances(vectors, "jaccard", slice(None), slice(None)) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("representation", VECTOR_REPRESENTATIONS)
+def test_sparse_hamming_matches_scipy_on_the_actions_of_the_log(log, representation, cache_dir):
+    # The vocabulary of the collection has actions the log does not have, they are not compared
+    intern_actions("collection", [f"action {action}" for action in range(10)])
+    vectors = log_items(log, representation, "collection")[0]
+    assert vectors.shape[1] == 10
+    used = np.unique(vectors.indices)
+    expected = cdist(vectors.toarray()[:, used], vectors.toarray()[:, used], metric="hamming")
+    assert sparse_distances(vectors, "hamming", slice(None), slice(None)) == pytest.approx(expected)
+
+
+def test_intern_actions_appends_the_new_actions(cache_dir):
+    assert intern_actions("collection", ["b", "a"]) == {"b": 0, "a": 1}
+    assert intern_actions("collection", ["c", "a"]) == {"b": 0, "a": 1, "c": 2}
+    assert intern_actions("other", ["c"]) == {"c": 0}
+    vocabulary_dir = cache_dir / "vocabularies"
+    assert os.stat(vocabulary_dir).st_mode & 0o777 == 0o700
+    # The vocabularies are data only
+    paths = [vocabulary_dir / name for name in os.listdir(vocabulary_dir)]
+    assert sorted(json.loads(path.read_text()) for path in paths) == [["b", "a", "c"], ["c"]]
+
+
+@pytest.mark.parametrize("representation", [None, "frequency representation"])
+def test_items_files(log, representation, tmp_path):
+    items = log_items(log, representation)[0]
+    with open(tmp_path / "items", "wb") as items_file:
+        write_items(items, items_file)
+    read = read_items(str(tmp_path / "items"))
+    if representation is None:
+        assert read == items
+    else:
+        assert (read != items).nnz == 0
+
+
+@pytest.mark.parametrize("representation, measure", [(None, "levenshtein"), ("binary representation", "jaccard")])
+def test_compute_distance_matrix(log, representation, measure, cache_dir):
+    items = log_items(log, representation)[0]
+    asyncio.run(compute_distance_matrix("key", items, measure))
+    n = len(items) if representation is None else items.shape[0]
+    condensed = load_distance_matrix("key", n)
+    if representation is None:
+        strings = distance_utils.variant_strings(items)
+        expected = pdist(np.arange(n)[:, None], lambda i, j: distance_utils.Levenshtein.distance(
+            strings[int(i[0])], strings[int(j[0])]))
+    else:
+        expected = pdist(dense(items) > 0, metric="jaccard")
+    assert condensed == pytest.approx(expected, abs=1e-6)
+    assert os.listdir(cache_dir) == ["key.f32"]
+
+
+def cache_file(path, size, age):
+    path.write_bytes(b"\0" * size)
+    modified = time.time() - age
+    os.utime(path, (modified, modified))
+
+
+def test_evict_distance_matrices(cache_dir):
+    cache_file(cache_dir / "old.f32", 100, age=30)
+    cache_file(cache_dir / "new.f32", 100, age=10)
+    # The matrix being computed counts in the size of the cache, the one of a computation that never finished
+    # is deleted
+    cache_file(cache_dir / "running.tmp", 50, age=0)
+    cache_file(cache_dir / "running.tmp.items", 10, age=0)
+    cache_file(cache_dir / "left.tmp", 1000, age=100)
+    cache_file(cache_dir / "left.tmp.items", 10, age=100)
+    evict_distance_matrices(max_bytes=200, max_tmp_age=60)
+    assert sorted(os.listdir(cache_dir)) == ["new.f32", "running.tmp", "running.tmp.items"]
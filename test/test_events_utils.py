@@ -0,0 +1,45 @@
+from itertools import groupby
+
+from src.client_utils import last_session_id, merge_clients, renumber_sessions
+from src.events_utils import client_to_events
+
+
+def parsed_client(*sessions):
+    # The parser numbers the sessions of each client from 1 on every parse
+    return {"client_id": "a", "sessions": [
+        {"session_id": session_id, "requests": [
+            {"request_id": f"{session_id}.{position}", "request_url": url, "request_time": None}
+            for position, url in enumerate(urls, start=1)
+        ]}
+        for session_id, urls in enumerate(sessions, start=1)
+    ]}
+
+
+def nested_traces(clients):
+    return [[request["request_url"] for request in session["requests"]]
+            for client in clients for session in client["sessions"]]
+
+
+def event_traces(clients):
+    # As the event layout reads them: sorted by (client_id, session_id, position), one trace per session
+    events = sorted((event for client in clients for event in client_to_events(client)),
+                    key=lambda event: (event["client_id"], event["session_id"], event["position"]))
+    return [[event["action"] for event in session]
+            for _, session in groupby(events, key=lambda event: (event["client_id"], event["session_id"]))]
+
+
+def test_layouts_agree_for_a_client_split_across_the_files_of_an_upload():
+    clients = merge_clients([[parsed_client(["/login", "/search"])], [parsed_client(["/home", "/logout"])]])
+    assert nested_traces(clients) == [["/login", "/search"], ["/home", "/logout"]]
+    assert event_traces(clients) == nested_traces(clients)
+
+
+def test_layouts_agree_for_a_client_split_across_two_uploads():
+    stored = parsed_client(["/login", "/search"], ["/search"])
+    # The sessions of the second upload are numbered after the stored ones, as the upsert does
+    appended = parsed_client(["/home", "/logout"])
+    appended["sessions"] = renumber_sessions(appended["sessions"], last_session_id(stored["sessions"]))
+    client = {**stored, "sessions": stored["sessions"] + appended["sessions"]}
+    assert nested_traces([client]) == [["/login", "/search"], ["/search"], ["/home", "/logout"]]
+    # The events of each upload are inserted separately
+    assert event_traces([stored, appended]) == nested_traces([client])
@@ -0,0 +1,52 @@
+import asyncio
+import operator
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from src.executor_utils import DiscoveryExecutor
+
+
+@pytest.fixture
+def anyio_backend():
+    # The executor runs in the asyncio loop of the API
+    return "asyncio"
+
+
+@pytest.mark.anyio
+async def test_run_returns_the_result_of_the_process():
+    executor = DiscoveryExecutor(max_workers=2, user_limit=1, timeout=60)
+    # A large result is read from the pipe by the reader thread
+    result = await executor.run("user", operator.mul, b"x", 64 * 1024 * 1024)
+    assert len(result) == 64 * 1024 * 1024
+    assert await executor.run("user", divmod, 7, 2, result_index=1) == 1
+
+
+@pytest.mark.anyio
+async def test_run_raises_the_error_of_the_process():
+    executor = DiscoveryExecutor(max_workers=2, user_limit=1, timeout=60)
+    with pytest.raises(ZeroDivisionError):
+        await executor.run("user", operator.truediv, 1, 0)
+
+
+@pytest.mark.anyio
+async def test_run_stops_the_process_after_its_timeout():
+    executor = DiscoveryExecutor(max_workers=2, user_limit=1, timeout=60)
+    with pytest.raises(HTTPException) as error:
+        await executor.run("user", time.sleep, 30, timeout=1)
+    assert error.value.status_code == 504
+
+
+@pytest.mark.anyio
+async def test_user_limit():
+    executor = DiscoveryExecutor(max_workers=2, user_limit=1, timeout=60)
+    running = asyncio.create_task(executor.run("user", time.sleep, 2))
+    await asyncio.sleep(0.1)
+    with pytest.raises(HTTPException) as error:
+        await executor.run("user", time.sleep, 0)
+    assert error.value.status_code == 429
+    # The other users and the waiting calls are not refused
+    await asyncio.gather(running, executor.run("other", time.sleep, 0), executor.run("user", time.sleep, 0, wait=True))
+    # The semaphores of the users without call are dropped
+    assert executor.user_slots == {} and executor.user_calls == {}
@@ -0,0 +1,66 @@
+from collections import Counter
+from datetime import datetime
+
+from src.stats_utils import CollectionProfile, TraceStatistics
+
+
+TRACES = [
+    ["login", "search", "logout"],
+    ["login", "search", "logout"],
+    ["login", "download"],
+    ["search"],
+]
+
+
+def trace_statistics(traces) -> TraceStatistics:
+    statistics = TraceStatistics()
+    for trace in traces:
+        statistics.add_trace(trace)
+    return statistics
+
+
+def test_trace_statistics_counts():
+    statistics = trace_statistics(TRACES)
+    assert statistics.trace_number == 4
+    assert statistics.action_number == 9
+    assert len(statistics.variants) == 3
+    assert statistics.actions == ["login", "search", "logout", "download"]
+
+
+def test_trace_statistics_popularity_matches_counter():
+    statistics = trace_statistics(TRACES)
+    assert statistics.trace_popularity() == Counter(",".join(trace) for trace in TRACES)
+    assert statistics.action_popularity() == Counter(action for trace in TRACES for action in trace)
+
+
+def test_trace_statistics_empty():
+    statistics = TraceStatistics()
+    assert statistics.trace_number == 0
+    assert statistics.trace_popularity() == {}
+    assert statistics.action_popularity() == {}
+
+
+def test_collection_profile_summary():
+    profile = CollectionProfile()
+    profile.add_session("a", [
+        {"request_url": "/login", "request_tag": "login", "request_time": "2024-03-01T10:00:00+00:00"},
+        {"request_url": "/search", "request_tag": "Outliers", "request_time": "2024-03-01T10:05:00+00:00"},
+        {"request_url": "/logout", "request_tag": "logout", "request_time": "2024-03-01T09:00:00+00:00"},
+    ])
+    profile.add_session("a", [
+        {"request_url": "/login", "request_tag": "login", "request_time": datetime(2024, 3, 2, 10)},
+    ])
+    # A session without tags counts its requests but no trace
+    profile.add_session("b", [{"request_url": "/login", "request_tag": None, "request_time": None}])
+
+    summary = profile.summary()
+    assert summary["Trace number"] == 2
+    assert summary["Trace popularity"] == {"login,logout": 1, "login": 1}
+    assert summary["Action popularity"] == {"login": 2, "logout": 1}
+    assert summary["Request number"] == 5
+    assert summary["Request frequencies"] == {"/login": 3, "/search": 1, "/logout": 1}
+    assert summary["Request percentages"]["/login"] == "60.00%"
+
+    durations = {duration.client_id: duration for duration in summary["Client durations"]}
+    assert list(durations) == ["a"]
+    assert durations["a"].total_duration_seconds == 25 * 3600
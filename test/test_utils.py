@@ -0,0 +1,44 @@
+import os
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+from src.utils import day_interval_to_utc, private_directory, to_utc_datetime
+
+
+def test_to_utc_datetime_converts_aware_values():
+    assert to_utc_datetime("2024-03-01T10:00:00+02:00") == datetime(2024, 3, 1, 8, 0)
+    assert to_utc_datetime(datetime(2024, 3, 1, 10, tzinfo=timezone(timedelta(hours=-5)))) == datetime(2024, 3, 1, 15)
+
+
+def test_to_utc_datetime_keeps_naive_values():
+    assert to_utc_datetime("2024-03-01 10:00:00") == datetime(2024, 3, 1, 10, 0)
+    assert to_utc_datetime(datetime(2024, 3, 1, 10)) == datetime(2024, 3, 1, 10)
+    assert to_utc_datetime(None) is None
+
+
+def test_day_interval_to_utc():
+    assert day_interval_to_utc(date(2024, 3, 1), date(2024, 3, 2)) == (datetime(2024, 3, 1), datetime(2024, 3, 3))
+    # Paris is UTC+1 in winter and UTC+2 in summer
+    assert day_interval_to_utc(date(2024, 1, 10), date(2024, 7, 10), "Europe/Paris") == (
+        datetime(2024, 1, 9, 23), datetime(2024, 7, 10, 22))
+
+
+def test_day_interval_to_utc_unknown_timezone():
+    with pytest.raises(ValueError):
+        day_interval_to_utc(date(2024, 3, 1), date(2024, 3, 1), "Mars/Olympus")
+
+
+def test_private_directory(tmp_path):
+    path = private_directory(str(tmp_path / "cache" / "parsed_logs"))
+    assert os.stat(path).st_mode & 0o777 == 0o700
+    # A directory of the API left readable by the other users is made private
+    os.chmod(path, 0o755)
+    private_directory(path)
+    assert os.stat(path).st_mode & 0o777 == 0o700
+
+
+def test_private_directory_refuses_links(tmp_path):
+    os.symlink(tmp_path, tmp_path / "link")
+    with pytest.raises(PermissionError):
+        private_directory(str(tmp_path / "link"))
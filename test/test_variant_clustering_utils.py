@@ -0,0 +1,125 @@
+import numpy as np
+import pytest
+from scipy import sparse
+from scipy.cluster.hierarchy import fcluster, linkage
+from scipy.spatial.distance import pdist, squareform
+from sklearn.cluster import DBSCAN, Birch
+from sklearn.metrics import adjusted_rand_score, silhouette_samples, silhouette_score
+
+from src import variant_clustering_utils
+from src.distance_utils import sparse_distances
+from src.variant_clustering_utils import (LINKAGE_CRITERIA, cluster_variants, clustering_scores, cut_linkage,
+                                          neighbor_graph, scalable_labels, square_distances, weighted_linkage)
+
+
+@pytest.fixture
+def variants():
+    # Distinct points stand for the variants, each one repeated by its number of traces
+    rng = np.random.default_rng(0)
+    points = rng.random((30, 2))
+    counts = rng.integers(1, 5, size=len(points))
+    return square_distances(pdist(points)), counts
+
+
+def expanded(distances, counts):
+    """Distance matrix of the traces: the traces of a variant are at distance 0"""
+    traces = np.repeat(np.arange(len(counts)), counts)
+    return distances[np.ix_(traces, traces)], traces
+
+
+@pytest.mark.parametrize("criterion", LINKAGE_CRITERIA)
+def test_weighted_linkage_matches_scipy_on_the_traces(variants, criterion):
+    distances, counts = variants
+    trace_distances, traces = expanded(distances, counts)
+    dendrogram = linkage(squareform(trace_distances.astype(np.float64), checks=False), method=criterion)
+    merges = weighted_linkage(distances, counts, criterion)
+    # The merges of the duplicated traces are at height 0, the other ones are the merges of the variants
+    heights = dendrogram[:, 2][dendrogram[:, 2] > 0]
+    assert sorted(height for _, _, height in merges) == pytest.approx(sorted(heights), rel=1e-5)
+    for nbr_clusters in (1, 2, 5, 12):
+        labels = cut_linkage(merges, len(counts), nbr_clusters)
+        assert len(np.unique(labels)) == nbr_clusters
+        expected = fcluster(dendrogram, t=nbr_clusters, criterion="maxclust")
+        assert adjusted_rand_score(expected, labels[traces]) == 1
+
+
+@pytest.mark.parametrize("min_samples", [2, 5, 9])
+def test_weighted_dbscan_matches_dbscan_on_the_traces(variants, min_samples):
+    distances, counts = variants
+    trace_distances, traces = expanded(distances, counts)
+    params = {"epsilon": 0.15, "min_samples": min_samples}
+    labels = cluster_variants(distances, counts, "DBSCAN", params)
+    expected = DBSCAN(eps=0.15, min_samples=min_samples, metric="precomputed").fit_predict(trace_distances)
+    assert np.array_equal(labels[traces] < 0, expected < 0)
+    assert adjusted_rand_score(expected, labels[traces]) == 1
+
+
+def test_clustering_scores_match_sklearn_on_the_traces(variants):
+    distances, counts = variants
+    trace_distances, traces = expanded(distances, counts)
+    labels = cluster_variants(distances, counts, "Agglomerative", {"linkage": "average", "nbr_clusters": 4})
+    scores = clustering_scores(distances, counts, labels)
+    assert scores["Number of clusters"] == 4
+    assert scores["Number of noise traces"] == 0
+    assert scores["Silhouette score"] == pytest.approx(
+        silhouette_score(trace_distances, labels[traces], metric="precomputed"), rel=1e-5)
+    samples = silhouette_samples(trace_distances, labels[traces], metric="precomputed")
+    for cluster, silhouette in scores["Silhouette of each cluster"].items():
+        assert silhouette == pytest.approx(samples[labels[traces] == int(cluster)].mean(), rel=1e-5)
+    assert scores["Davies bouldin score"] > 0
+
+
+def test_clustering_scores_leave_the_noise_out(variants):
+    distances, counts = variants
+    labels = np.zeros(len(counts), dtype=np.int64)
+    labels[:3] = -1
+    scores = clustering_scores(distances, counts, labels)
+    assert scores["Number of clusters"] == 1
+    assert scores["Number of noise traces"] == counts[:3].sum()
+    assert scores["Silhouette score"] is None and scores["Davies bouldin score"] is None
+
+
+@pytest.fixture
+def vectors():
+    rng = np.random.default_rng(0)
+    counts = rng.integers(1, 5, size=50)
+    return sparse.csr_matrix(rng.integers(0, 3, size=(50, 12)).astype(np.float64)), counts
+
+
+@pytest.mark.parametrize("measure", ["jaccard", "hamming", "cosine", "euclidean"])
+def test_neighbor_graph(vectors, measure, monkeypatch):
+    vectors, _ = vectors
+    # Several chunks of rows
+    monkeypatch.setattr(variant_clustering_utils, "NEIGHBOR_CHUNK_DISTANCES", 400)
+    distances = sparse_distances(vectors, measure, slice(None), slice(None))
+    epsilon = np.quantile(distances, 0.2)
+    graph = neighbor_graph(vectors, measure, epsilon)
+    for row in range(vectors.shape[0]):
+        neighbors = graph.indices[graph.indptr[row]:graph.indptr[row + 1]]
+        row_distances = graph.data[graph.indptr[row]:graph.indptr[row + 1]]
+        assert set(neighbors) == set(np.flatnonzero(distances[row] <= epsilon))
+        assert row_distances == pytest.approx(distances[row, neighbors])
+        assert np.all(np.diff(row_distances) >= 0)
+
+
+@pytest.mark.parametrize("measure", ["jaccard", "euclidean"])
+def test_scalable_dbscan_matches_dbscan_on_the_distance_matrix(vectors, measure):
+    vectors, counts = vectors
+    distances = sparse_distances(vectors, measure, slice(None), slice(None))
+    params = {"epsilon": np.quantile(distances, 0.1), "min_samples": 6}
+    labels = scalable_labels(vectors, counts, "DBSCAN", params, measure)
+    assert np.array_equal(labels, cluster_variants(distances, counts, "DBSCAN", params))
+
+
+@pytest.mark.parametrize("measure, threshold", [("euclidean", 0.8), ("cosine", 0.3)])
+def test_scalable_birch_matches_birch_on_the_traces(vectors, measure, threshold, monkeypatch):
+    vectors, counts = vectors
+    # The traces are inserted by batches cutting the traces of a vector
+    monkeypatch.setattr(variant_clustering_utils, "BIRCH_BATCH_SIZE", 7)
+    labels = scalable_labels(vectors, counts, "Birch", {"nbr_clusters": 4, "epsilon": threshold}, measure)
+    points = vectors.toarray()
+    if measure == "cosine":
+        points /= np.linalg.norm(points, axis=1, keepdims=True)
+    birch = Birch(n_clusters=4, threshold=threshold).fit(np.repeat(points, counts, axis=0))
+    assert np.array_equal(labels, birch.predict(points))
+    assert len(np.unique(labels)) == 4
@@ -0,0 +1,57 @@
+import os
+
+import pytest
+from fastapi import HTTPException
+
+from src import workspace_utils
+from src.workspace_utils import hold_scratch_file, release_scratch_file, sweep_scratch_space, workspace
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def scratch_space(tmp_path, monkeypatch):
+    monkeypatch.setattr(workspace_utils, "WORKSPACE_DIR", str(tmp_path / "workspaces"))
+    monkeypatch.setattr(workspace_utils, "SCRATCH_DIRS", (str(tmp_path / "temp"),))
+    monkeypatch.setattr(workspace_utils, "_workspaces_size", [0, None])
+    os.makedirs(tmp_path / "temp")
+    return tmp_path
+
+
+@pytest.mark.anyio
+async def test_workspace_is_deleted_when_released(scratch_space):
+    async with workspace() as scratch:
+        with open(scratch.file("log.csv"), "w") as log_file:
+            log_file.write("client_id;action;timestamp\n")
+        assert os.listdir(scratch.path) == ["log.csv"]
+    assert not os.path.exists(scratch.path)
+
+
+@pytest.mark.anyio
+async def test_workspace_quota(scratch_space, monkeypatch):
+    monkeypatch.setattr(workspace_utils, "WORKSPACE_QUOTA_BYTES", 10)
+    async with workspace() as scratch:
+        with open(scratch.file("log.csv"), "w") as log_file:
+            log_file.write("client_id;action;timestamp\n")
+        # The size of the workspaces is measured again once the last measure is stale
+        monkeypatch.setattr(workspace_utils, "_workspaces_size", [0, None])
+        with pytest.raises(HTTPException) as error:
+            async with workspace():
+                pass
+        assert error.value.status_code == 507
+
+
+def test_sweep_keeps_the_held_files(scratch_space):
+    queued, left = str(scratch_space / "temp" / "queued.csv"), str(scratch_space / "temp" / "left.csv")
+    for path in (queued, left):
+        open(path, "w").close()
+    hold_scratch_file(queued)
+    try:
+        assert sweep_scratch_space(max_age=-1) == 1
+        assert os.listdir(scratch_space / "temp") == ["queued.csv"]
+    finally:
+        release_scratch_file(queued)
+    assert sweep_scratch_space(max_age=-1) == 1